@@ -0,0 +1,300 @@
+"""Fuzz corpus and microbenchmarks for json_scan.scan_json against the regex repair cascade it replaced.
+
+    python scripts/bench_json_scan.py                      # fuzz 3000 cases + timings
+    python scripts/bench_json_scan.py --cases 20000 --seed 7 --sizes 1000,100000,1000000
+    python scripts/bench_json_scan.py --dump /tmp/json_corpus   # also write the corpus, one file per case
+
+The fuzz part builds LLM-style replies from doc-generator-shaped objects. Some mutations keep the payload
+(prose around it, a fence, trailing commas, raw newlines, smart-quote delimiters, Python literals) and some
+break it (truncation, random edits, adversarial bracket runs). It checks that scan_json decodes every
+payload-preserving case to the original object and never raises anything but JsonScanError, and exits
+non-zero otherwise. The table also counts the cases where the old cascade returned a wrong value (usually a
+fragment nested inside a value it could not repair) and where the two implementations disagree.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import string
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from json_scan import JsonScanError, scan_json
+
+
+# --- The previous implementation (DocGenerator._sanitize_json_like + _try_parse_json), kept for comparison ---
+
+def _legacy_escape_newlines_in_json_strings(s: str) -> str:
+    out: List[str] = []
+    in_string = False
+    escape = False
+    for ch in s:
+        if in_string:
+            if escape:
+                out.append(ch)
+                escape = False
+                continue
+            if ch == "\\":
+                out.append(ch)
+                escape = True
+                continue
+            if ch == '"':
+                out.append(ch)
+                in_string = False
+                continue
+            if ch == "\n":
+                out.append("\\n")
+                continue
+            if ch == "\r":
+                out.append("\\r")
+                continue
+            out.append(ch)
+            continue
+        if ch == '"':
+            out.append(ch)
+            in_string = True
+            continue
+        out.append(ch)
+    return "".join(out)
+
+
+def _legacy_sanitize(s: str) -> str:
+    s = s.strip()
+    if not s:
+        return s
+    s = s.replace("\u201c", '"').replace("\u201d", '"').replace("\u2018", "'").replace("\u2019", "'")
+    s = _legacy_escape_newlines_in_json_strings(s)
+    for _ in range(5):
+        new = re.sub(r",\s*([}\]])", r"\1", s)
+        if new == s:
+            break
+        s = new
+    return s
+
+
+def _legacy_raw_decode(s: str) -> Any:
+    s = (s or "").lstrip()
+    if not s:
+        raise ValueError("Empty response")
+    return json.JSONDecoder().raw_decode(s)[0]
+
+
+def legacy_parse(s: str) -> Any:
+    s = _legacy_sanitize(s)
+    if not s:
+        raise ValueError("Empty response after sanitize")
+    try:
+        return json.loads(s)
+    except Exception:
+        pass
+    try:
+        return _legacy_raw_decode(s)
+    except Exception:
+        pass
+    for pos in [m.start() for m in re.finditer(r"[\[{]", s)][:50]:
+        try:
+            return _legacy_raw_decode(s[pos:])
+        except Exception:
+            continue
+    raise ValueError("Failed to parse JSON from model output")
+
+
+# --- Fuzz corpus ---
+
+_WORDS = ["消息", "插件", "配置", "适配器", "接口", "“引号”", "message", "plugin_system", "send_api", "C:\\tmp"]
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def make_payload(rng: random.Random, size: int = 1) -> Any:
+    """A doc-generator-shaped object; `size` scales the number of list items and the content length."""
+    content = "---\ntitle: " + _text(rng, 3) + "\n---\n\n## 概述\n" + "\n".join(_text(rng, 12) for _ in range(3 * size))
+    return {
+        "target_category": rng.choice(["modules", "plugin_system/api", "design_standards"]),
+        "file_name": f"{rng.choice(['chat', 'config', 'send_api'])}.md",
+        "content": content,
+        "evidence": [f"src/{rng.choice(['chat', 'config'])}/{w}.py" for w in rng.sample(string.ascii_lowercase, 3)],
+        "public_contracts": [
+            {"name": f"fn_{i}", "kind": "function", "signature": f"def fn_{i}(x: int = {i}) -> None", "optional": i % 2 == 0}
+            for i in range(2 * size)
+        ],
+        "score": rng.choice([0, 1.5, -3, 2e10]),
+        "limitations": None,
+    }
+
+
+def _dumps(obj: Any, rng: random.Random) -> str:
+    return json.dumps(obj, ensure_ascii=rng.random() < 0.2, indent=rng.choice([None, 2]))
+
+
+def _trailing_commas(text: str) -> str:
+    return re.sub(r"(\S)(\s*[}\]])", r"\1,\2", text, count=3)
+
+
+def _raw_newlines(text: str) -> str:
+    return text.replace("\\n", "\n")
+
+
+def _smart_quote_delimiters(text: str) -> str:
+    # Only structural quotes (keys): values keep their straight quotes, as models mix them.
+    return re.sub(r'"([A-Za-z_]+)":', "\u201c\\1\u201d:", text)
+
+
+# name -> (mutation, whether the payload survives it)
+MUTATIONS: Dict[str, Tuple[Callable[[str, random.Random], str], bool]] = {
+    "clean": (lambda t, r: t, True),
+    "prose": (lambda t, r: f"好的，以下是结果（参考 [注] 与 {{dir}}）：\n{t}\n如需调整请告诉我。", True),
+    "fence": (lambda t, r: f"```json\n{t}\n```\n", True),
+    "trailing_comma": (lambda t, r: _trailing_commas(t), True),
+    "raw_newline": (lambda t, r: _raw_newlines(t), True),
+    "smart_quote_keys": (lambda t, r: _smart_quote_delimiters(t), True),
+    "mixed": (lambda t, r: "结果：" + _trailing_commas(_raw_newlines(t)) + "\n", True),
+    "truncated": (lambda t, r: t[: r.randrange(1, max(2, len(t) - 1))], False),
+    "deleted_chars": (lambda t, r: "".join(c for c in t if r.random() > 0.01), False),
+    "inserted_brackets": (lambda t, r: "".join(c + (r.choice("[]{}\",:") if r.random() < 0.01 else "") for c in t), False),
+}
+
+
+def adversarial_cases(n: int) -> Dict[str, str]:
+    return {
+        "open_brackets": "[" * n,
+        "open_objects": '{"a":' * (n // 5),
+        "unterminated_string": '{"a": "' + "x" * n,
+        "bracket_pairs": "[{" * (n // 2),
+        "bare_keys": "{a" * (n // 2),
+        "commas": "[" + ", " * (n // 2),
+        "quotes": '"' * n,
+        "prose_brackets": "see [note] and {ref} " * (n // 20) + '{"ok": true}',
+    }
+
+
+def build_corpus(seed: int, count: int) -> List[Tuple[str, str, Optional[Any]]]:
+    """(kind, text, expected object or None when the payload did not survive) for `count` random cases."""
+    rng = random.Random(seed)
+    corpus: List[Tuple[str, str, Optional[Any]]] = []
+    names = sorted(MUTATIONS)
+    for _ in range(count):
+        payload = make_payload(rng)
+        if rng.random() < 0.3:
+            payload = [payload, make_payload(rng)]
+        kind = rng.choice(names)
+        mutate, survives = MUTATIONS[kind]
+        corpus.append((kind, mutate(_dumps(payload, rng), rng), payload if survives else None))
+    # A Python repr is only a faithful literal when it contains no float exponents etc.; build it from scratch.
+    for _ in range(max(1, count // 20)):
+        payload = {"name": _text(rng, 2), "ok": rng.random() < 0.5, "value": None, "items": [1, 2, {"k": "v"}]}
+        corpus.append(("python_literal", repr(payload), payload))
+    for kind, text in adversarial_cases(2000).items():
+        corpus.append((f"adversarial:{kind}", text, {"ok": True} if kind == "prose_brackets" else None))
+    return corpus
+
+
+def run_fuzz(corpus: List[Tuple[str, str, Optional[Any]]]) -> bool:
+    stats: Dict[str, Dict[str, int]] = {}
+    failures: List[str] = []
+    for kind, text, expected in corpus:
+        row = stats.setdefault(kind, {"cases": 0, "legacy_ok": 0, "legacy_wrong": 0, "scan_ok": 0, "disagree": 0})
+        row["cases"] += 1
+        try:
+            legacy: Any = legacy_parse(text)
+            row["legacy_ok"] += 1
+            legacy_ok = True
+            if expected is not None and legacy != expected:
+                row["legacy_wrong"] += 1
+        except Exception:
+            legacy, legacy_ok = None, False
+        try:
+            scanned = scan_json(text)
+            row["scan_ok"] += 1
+        except JsonScanError:
+            if expected is not None:
+                failures.append(f"{kind}: not decoded: {text[:120]!r}")
+            continue
+        except Exception as e:
+            failures.append(f"{kind}: crashed with {type(e).__name__}: {e}")
+            continue
+        if expected is not None and scanned != expected:
+            failures.append(f"{kind}: decoded to a different value: {text[:120]!r}")
+        if legacy_ok and legacy != scanned:
+            row["disagree"] += 1
+
+    print(f"{'case':<34}{'cases':>7}{'legacy ok':>11}{'legacy wrong':>14}{'scan ok':>9}{'disagree':>10}")
+    for kind, row in sorted(stats.items()):
+        print(
+            f"{kind:<34}{row['cases']:>7}{row['legacy_ok']:>11}{row['legacy_wrong']:>14}"
+            f"{row['scan_ok']:>9}{row['disagree']:>10}"
+        )
+    for line in failures[:20]:
+        print(f"FAIL {line}")
+    if failures:
+        print(f"{len(failures)} failures")
+    return not failures
+
+
+# --- Microbenchmarks ---
+
+def _best_of(fn: Callable[[], Any], *, repeat: int, max_seconds: float = 5.0) -> float:
+    best = float("inf")
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            pass
+        best = min(best, time.perf_counter() - t0)
+        if time.perf_counter() - started > max_seconds:
+            break
+    return best
+
+
+def run_bench(sizes: List[int], seed: int) -> None:
+    rng = random.Random(seed)
+    print(f"\n{'input':<34}{'chars':>9}{'legacy ms':>11}{'scan ms':>9}{'speedup':>9}")
+    for size in sizes:
+        payload = make_payload(rng, size=max(1, size // 1000))
+        clean = _dumps(payload, rng)
+        inputs = {
+            "prose+json": "好的，以下是结果：\n" + clean + "\n以上。",
+            "trailing_comma+raw_newline": _trailing_commas(_raw_newlines(clean)),
+            "prose_brackets": "see [note] and {ref} " * (size // 20) + clean,
+            "adversarial:open_brackets": "[" * size,
+            "adversarial:bare_keys": "{a" * (size // 2),
+        }
+        for name, text in inputs.items():
+            repeat = 20 if len(text) < 200_000 else 3
+            legacy_s = _best_of(lambda: legacy_parse(text), repeat=repeat)
+            scan_s = _best_of(lambda: scan_json(text), repeat=repeat)
+            speedup = legacy_s / scan_s if scan_s > 0 else float("inf")
+            print(f"{name:<34}{len(text):>9}{legacy_s * 1000:>11.2f}{scan_s * 1000:>9.2f}{speedup:>8.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cases", type=int, default=3000)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated benchmark input sizes (chars)")
+    parser.add_argument("--dump", default="", help="Write the fuzz corpus to this directory")
+    parser.add_argument("--no-bench", action="store_true")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.seed, args.cases)
+    if args.dump:
+        os.makedirs(args.dump, exist_ok=True)
+        for i, (kind, text, _) in enumerate(corpus):
+            name = re.sub(r"[^\w-]+", "_", kind)
+            with open(os.path.join(args.dump, f"{i:05d}_{name}.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+    ok = run_fuzz(corpus)
+    if not args.no_bench:
+        run_bench([int(x) for x in args.sizes.split(",") if x.strip()], args.seed)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
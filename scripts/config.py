@@ -23,6 +23,12 @@ class Config:
     LLM_API_STYLE = os.getenv("LLM_API_STYLE", "auto").strip()
     SHOW_BASE_URL_IN_LOGS = os.getenv("SHOW_BASE_URL_IN_LOGS", "0").strip() == "1"
 
+    # LLM HTTP transport (pooled httpx by default; curl kept as a fallback)
+    LLM_HTTP_TRANSPORT = os.getenv("LLM_HTTP_TRANSPORT", "httpx").strip().lower()
+    LLM_HTTP2 = os.getenv("LLM_HTTP2", "0").strip() == "1"
+    LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "10") or "10")
+    LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10") or "10")
+
     # Sync behavior
     STATE_FILE = os.getenv("STATE_FILE", "scripts/state.json").strip()
     DOCS_ROOT = os.getenv("DOCS_ROOT", "develop/llm/maibot/main").strip()
@@ -1,16 +1,179 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
 import json
+import math
 import os
 import re
+import threading
 import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
 from config import config
-from llm_client import HttpError, detect_api_style, generate_text
+from llm_client import (
+    HttpError,
+    LLMResponse,
+    aclose_http_pool,
+    agenerate_response,
+    configure_http_pool,
+    create_gemini_cached_content,
+    detect_api_style,
+    generate_response,
+)
+from evidence_index import EvidenceIndex
+from json_scan import JsonScanError, scan_json
+from llm_batch import OpenAIBatchRunner, build_batch_line
+from llm_cache import ResponseCache
+from llm_endpoints import Endpoint, EndpointPool, load_endpoints
+from llm_hedge import HedgeCancelled, HedgePolicy
+from llm_metrics import LLMMetrics, _percentile
+from llm_profile import LLMProfileStore, default_profile_path, input_size_bucket, parse_limits_from_error
+from llm_resilience import (
+    FALLBACK,
+    RETRYABLE,
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceeded,
+    FormatRejected,
+    RetryPolicy,
+    classify_error,
+    format_rejection,
+)
+from output_rules import (
+    OutputRules,
+    RuleContext,
+    RuleViolation,
+    compile_rules,
+    error_list,
+    is_safe_category_path,
+    normalize_category_path,
+)
+from rate_governor import RateGovernor, default_governor_path, parse_retry_after
+from llm_tasks import TaskRoute, load_task_profile
+from token_estimator import TokenEstimator, resolve_token_budget
+
+# Cache key of the response most recently returned by _call_llm/_acall_llm in this thread/task,
+# so callers that reject the output can evict it instead of replaying it on the next run.
+_LAST_CACHE_KEY: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("_LAST_CACHE_KEY", default=None)
+# Whether that response came from a billed call (not the cache); rejecting it counts as a wasted call.
+_LAST_CALL_LIVE: contextvars.ContextVar[bool] = contextvars.ContextVar("_LAST_CALL_LIVE", default=False)
+
+# Gemini rejects cachedContents below a model-dependent minimum; don't try for smaller prefixes.
+_GEMINI_CACHE_MIN_TOKENS = 2048
+
+# Output sizes needed before a task's max_tokens is learned, and how far above its static value it may grow.
+_ADAPTIVE_MIN_SAMPLES = 20
+_ADAPTIVE_MAX_GROWTH = 4
+
+_CONTINUE_PROMPT = (
+    "你的上一条回复因达到输出长度上限被截断。请从截断处继续输出剩余部分："
+    "不要重复已输出的内容，不要添加任何解释、前言或代码块标记，直接接着最后一个字符写，直到完整结束。"
+)
+
+# Follow-up for an output that parsed but failed validation: only the errors and the output go back, not the task.
+_REPAIR_PROMPT = """你上一次输出的 JSON 未通过校验，请修正后重新输出。
+
+--- 校验错误 ---
+{errors}
+{hint}
+--- 上一次的输出 ---
+{previous}
+
+--- 要求 ---
+只修正上述错误，其余内容尽量保持不变；输出修正后的完整 JSON（不是差异），不要输出任何解释文字。
+"""
+_REPAIR_HINT = """
+--- 可作为 evidence 的原样子串（节选） ---
+{candidates}
+"""
+# File paths and top-level signatures: the verbatim strings validators accept as evidence.
+_EVIDENCE_PATH_RE = re.compile(r"(?<![\w./-])(?:[\w.-]+/)+[\w.-]*\w(?![\w/])")
+
+
+def _stitch_continuation(text: str, part: str) -> str:
+    """Append a continuation to a truncated output, dropping an opening code fence and any repeated overlap."""
+    part = re.sub(r"^\s*```(?:json)?[ \t]*\n", "", part or "")
+    head = part.lstrip()[:64]
+    if len(head) >= 16 and text.lstrip().startswith(head):
+        # The model started over instead of continuing; the new attempt supersedes the old one.
+        return part
+    for k in range(min(len(text), len(part), 400), 11, -1):
+        if text.endswith(part[:k]):
+            return text + part[k:]
+    return text + part
+
+
+class _Continuation:
+    """A max_tokens-truncated response and the continuations stitched onto it so far."""
+
+    def __init__(self, response: LLMResponse):
+        self.response = response
+        self.text = response.text
+        self.completion_tokens = response.usage.get("completion_tokens") or 0
+
+    def add(self, part: LLMResponse) -> bool:
+        """Stitch on one continuation; returns whether the output is still truncated."""
+        self.text = _stitch_continuation(self.text, part.text)
+        self.completion_tokens += part.usage.get("completion_tokens") or 0
+        self.response = part
+        return part.truncated
+
+    def result(self) -> LLMResponse:
+        """The last part's response carrying the stitched text; its completion_tokens count every part."""
+        response = self.response
+        response.text = self.text
+        if self.completion_tokens:
+            response.usage = {**response.usage, "completion_tokens": self.completion_tokens}
+        return response
 
 
 class DocGenerator:
+    # Shared by every JSON-producing stage; keep it byte-identical so it stays inside the provider-cached prefix.
+    _JSON_ONLY_SYSTEM_INSTRUCTION = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
+    # Wall time of one stage-2 chunk including repairs, reported as a histogram with these upper bounds (seconds).
+    _DIR_CHUNK_METRIC = "bootstrap_dir_chunk_seconds"
+    _DIR_CHUNK_BUCKETS = (1, 2, 5, 10, 30, 60, 120)
+    # Stage-2 instructions that follow the shared RepoMap prefix. Together with the schema, system instruction and task
+    # model they version the analysis store; bump _DIR_ANALYSIS_PROMPT_VERSION when the task-parameter layout changes.
+    _DIR_ANALYSIS_RULES = """
+	你是一个资深软件工程师。请基于 RepoMap 与 files_block，对“任务参数”中指定目录的这一个“分片”做结构化分析。
+
+	重要规则：
+	- 禁止编造：只能引用 files_block 中出现的内容（路径/符号/字面量）。
+	- 每个结论必须可追溯：evidence 至少 2 条，且必须是 files_block 中出现的原样子串（建议用文件路径/类名/函数名）。
+	- 严格输出纯 JSON：不要使用 ```json 代码块，不要输出任何解释文字。
+	- 控制输出体积：不要枚举大量文件/符号。除 `files` 外，所有数组最多保留 5 个元素。
+	- `files` 字段固定输出为空数组 `[]`（脚本会从 files_block 自动填充真实文件列表，避免输出过长导致截断）。
+
+	输出必须是 JSON 对象，且 key 必须严格等于下面列表（不得多、不得少）：
+	- dir: string
+	- chunk_index: number
+	- chunk_total: number
+- files: array[string]
+- summary: string
+- public_contracts: array[{name, kind, defined_in, signature, notes}]
+- key_components: array[{name, defined_in, responsibility}]
+- configs: array[{name, defined_in, type, notes}]
+- dependencies: array[string]
+- risks: array[string]
+- limitations: string
+- evidence: array[string]
+"""
+    _DIR_ANALYSIS_PROMPT_VERSION = 1
+    # Per-file mode packs several files into one stage-2 call; appended to the rules above, and part of the
+    # version of the per-file store entries.
+    _FILE_ANALYSIS_RULES = """
+--- 按文件分析 ---
+本分片的 files_block 含多个文件，请逐个文件分析，不要把它们合并成一个结论：
+- 输出 JSON 数组：files_block 中的每个文件对应一个上述格式的对象，按文件出现的顺序排列，不得遗漏；
+- 每个对象的 `files` 只填该文件的路径（一个元素，取代上面“固定输出为空数组”的规则），evidence 只引用该文件的内容。
+"""
+
     def __init__(self):
         if not config.GEMINI_API_KEY:
             raise ValueError("GEMINI_API_KEY (or OPENAI_API_KEY) is not set in environment variables.")
@@ -21,6 +184,102 @@ class DocGenerator:
         self.api_style = config.LLM_API_STYLE
         self.docs_root = config.DOCS_ROOT
         self.show_base_url_in_logs = config.SHOW_BASE_URL_IN_LOGS
+        self.transport = config.LLM_HTTP_TRANSPORT
+        self.stream = (os.getenv("LLM_STREAM") or "0").strip().lower() in {"1", "true", "yes"}
+        if self.stream and self.transport == "curl":
+            print("警告: LLM_STREAM=1 仅支持 httpx 传输，当前 LLM_HTTP_TRANSPORT=curl，将以非流式模式请求。")
+            self.stream = False
+        self.stream_idle_timeout = self._get_float_env("LLM_STREAM_IDLE_TIMEOUT", 120.0)
+        self.batch_mode = (os.getenv("LLM_BATCH_MODE") or "0").strip().lower() in {"1", "true", "yes"}
+        self.endpoints = EndpointPool(
+            load_endpoints(
+                os.getenv("LLM_ENDPOINTS") or "",
+                default_base_url=self.base_url,
+                default_api_key=self.__api_key,
+                default_api_style=self.api_style,
+            )
+        )
+        # Per-step model / endpoint / max_tokens (cheap steps on a small model, pages on MODEL_NAME).
+        self.task_routes = load_task_profile(
+            os.getenv("LLM_TASK_PROFILE") or "", endpoint_names=[e.name for e in self.endpoints.endpoints]
+        )
+        self.metrics = LLMMetrics()
+        self.hedge: Optional[HedgePolicy] = None
+        if (os.getenv("LLM_HEDGE") or "0").strip().lower() in {"1", "true", "yes"}:
+            self.hedge = HedgePolicy(
+                percentile=self._get_float_env("LLM_HEDGE_PERCENTILE", 90.0) / 100.0,
+                min_seconds=self._get_float_env("LLM_HEDGE_MIN_SECONDS", 5.0),
+                max_ratio=self._get_float_env("LLM_HEDGE_MAX_RATIO", 0.1),
+            )
+        self.retry_policy = RetryPolicy(
+            base_seconds=self._get_float_env("LLM_RETRY_BASE_SECONDS", 1.0),
+            max_seconds=self._get_float_env("LLM_RETRY_MAX_SECONDS", 60.0),
+        )
+        # Budget for one _call_llm (all attempts and waits) and for every LLM call of the run (0 = unlimited).
+        self.call_deadline_seconds = self._get_int_env("LLM_CALL_DEADLINE_SECONDS", 900)
+        # Follow-up requests for an output cut off at max_tokens (0 = give up on truncated outputs).
+        self.max_continuations = self._get_int_env("LLM_MAX_CONTINUATIONS", 2)
+        # Follow-up requests that send validator errors back for an output that failed validation (0 = drop it).
+        self.max_repairs = self._get_int_env("LLM_MAX_REPAIRS", 1)
+        # Evidence is also checked against the checked-out repo once build_evidence_index() has run (bootstrap).
+        self.use_evidence_index = (os.getenv("LLM_EVIDENCE_INDEX") or "1").strip().lower() not in {"0", "false", "no"}
+        self.evidence_index: Optional[EvidenceIndex] = None
+        # max_tokens from a quantile of the output sizes recorded per task and input size, plus headroom.
+        adaptive = (os.getenv("LLM_ADAPTIVE_MAX_TOKENS") or "1").strip().lower()
+        self.adaptive_max_tokens = adaptive not in {"0", "false", "no"}
+        self.max_tokens_quantile = min(1.0, self._get_float_env("LLM_MAX_TOKENS_QUANTILE", 0.99))
+        self.max_tokens_headroom = max(1.0, self._get_float_env("LLM_MAX_TOKENS_HEADROOM", 1.3))
+        # task -> (learned max_tokens, static max_tokens, samples) of its latest request, for the report.
+        self._learned_max_tokens: Dict[str, Tuple[int, int, int]] = {}
+        self.run_deadline = Deadline(self._get_int_env("LLM_RUN_DEADLINE_SECONDS", 0))
+        self.breaker: Optional[CircuitBreaker] = None
+        circuit_failures = self._get_int_env("LLM_CIRCUIT_FAILURES", 5)
+        if circuit_failures > 0:
+            self.breaker = CircuitBreaker(
+                failure_threshold=circuit_failures,
+                reset_seconds=self._get_float_env("LLM_CIRCUIT_RESET_SECONDS", 60.0),
+            )
+        self.profile = LLMProfileStore(default_profile_path(config.STATE_FILE))
+        self.tokens = TokenEstimator(
+            self.model_name, scale=self.profile.capability(self.base_url, self.model_name).get("token_scale") or 1.0
+        )
+        self.cache: Optional[ResponseCache] = None
+        if (os.getenv("LLM_CACHE") or "1").strip().lower() not in {"0", "false", "no"}:
+            self.cache = ResponseCache(
+                (os.getenv("LLM_CACHE_DIR") or ".cache/llm_responses").strip(),
+                max_bytes=int(self._get_float_env("LLM_CACHE_MAX_MB", 200) * 1024 * 1024),
+                ttl_seconds=self._get_float_env("LLM_CACHE_TTL_HOURS", 168) * 3600,
+            )
+        # Stage-2 analyses by file/directory content (git blob shas) and prompt/model version, shared across branches.
+        self.dir_analysis_cache: Optional[ResponseCache] = None
+        if (os.getenv("BOOTSTRAP_ANALYSIS_CACHE") or "1").strip().lower() not in {"0", "false", "no"}:
+            self.dir_analysis_cache = ResponseCache(
+                (os.getenv("BOOTSTRAP_ANALYSIS_CACHE_DIR") or ".cache/dir_analyses").strip(),
+                max_bytes=int(self._get_float_env("BOOTSTRAP_ANALYSIS_CACHE_MAX_MB", 100) * 1024 * 1024),
+                ttl_seconds=0,
+            )
+        self._dir_analysis_versions: Dict[str, str] = {}
+        # One rate governor per endpoint (keyed by its API key + base URL).
+        self.governors: Dict[str, RateGovernor] = {}
+        if (os.getenv("LLM_RATE_GOVERNOR") or "1").strip().lower() not in {"0", "false", "no"}:
+            try:
+                for endpoint in self.endpoints.endpoints:
+                    self.governors[endpoint.name] = RateGovernor(
+                        (os.getenv("LLM_RATE_DB") or "").strip() or default_governor_path(),
+                        api_key=endpoint.api_key,
+                        base_url=endpoint.base_url,
+                        rpm=endpoint.rpm or self._get_int_env("LLM_RPM", 0),
+                        tpm=endpoint.tpm or self._get_int_env("LLM_TPM", 0),
+                        max_concurrency=self._get_int_env("LLM_MAX_CONCURRENCY", 8) or 8,
+                    )
+            except Exception as e:
+                self.governors = {}
+                print(f"警告: 无法初始化限流协调器，将不做跨进程限流: {e}")
+        configure_http_pool(
+            http2=config.LLM_HTTP2,
+            max_connections=config.LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_POOL_MAX_KEEPALIVE,
+        )
 
         # LLM docs are organized into modular categories (AstrBot-docs-like).
         # For MaiBot / maim_message we do NOT predefine categories; the LLM will decide them during bootstrap/update.
@@ -42,7 +301,17 @@ class DocGenerator:
             ]
             self.default_category = "design_standards"
 
-        self._category_segment_re = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9_-]*$")
+        # Explicit provider prompt caching for the shared prefix (Gemini cachedContents / OpenAI prompt_cache_key).
+        self.prompt_cache = (os.getenv("LLM_PROMPT_CACHE") or "0").strip().lower() in {"1", "true", "yes"}
+        self.prompt_cache_ttl = int(self._get_float_env("LLM_PROMPT_CACHE_TTL_SECONDS", 1800))
+        # (endpoint name, prefix hash) -> (cachedContents name or "" when creation failed, expiry timestamp)
+        self._gemini_caches: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._gemini_cache_lock = threading.Lock()
+        # (event loop, cache key) -> creation in flight, shared by the async callers that need the same prefix
+        self._gemini_cache_pending: Dict[Tuple[Any, Tuple[str, str]], "asyncio.Future[Optional[str]]"] = {}
+
+        # Validation rules for every structured output, compiled once from the _schema_* definitions.
+        self.output_rules = self._compile_output_rules()
 
     def _get_max_tokens(self, per_call_env: str, default: int) -> int:
         """Resolve max_tokens from env, prioritizing a single global knob."""
@@ -62,6 +331,69 @@ class DocGenerator:
             v = int(default)
         return max(1, v)
 
+    def _get_float_env(self, env_var: str, default: float) -> float:
+        raw = (os.getenv(env_var) or "").strip()
+        try:
+            v = float(raw) if raw else float(default)
+        except Exception:
+            v = float(default)
+        return v if v > 0 else float(default)
+
+    def _get_int_env(self, env_var: str, default: int) -> int:
+        raw = (os.getenv(env_var) or "").strip()
+        try:
+            v = int(raw) if raw else int(default)
+        except Exception:
+            v = int(default)
+        return max(0, v)
+
+    def _task_route(self, task: str) -> TaskRoute:
+        return self.task_routes.get(task) or self.task_routes.get("default") or TaskRoute()
+
+    def _task_model(self, task: str) -> str:
+        return self._task_route(task).model or self.model_name
+
+    def _task_max_tokens(self, task: str, max_tokens: int) -> int:
+        return self._task_route(task).max_tokens or int(max_tokens)
+
+    def _adaptive_max_tokens(self, task: str, model_name: str, static: int, prompt_tokens: int) -> int:
+        """max_tokens for `task` learned from recorded output sizes; `static` until there are enough samples.
+
+        Samples of the same input size class are preferred, then the task's samples of any size. A max_tokens
+        pinned in LLM_TASK_PROFILE is kept as is.
+        """
+        if not self.adaptive_max_tokens or not task or self._task_route(task).max_tokens:
+            return static
+        samples = self.profile.output_sizes(model_name, task, input_size_bucket(prompt_tokens))
+        if len(samples) < _ADAPTIVE_MIN_SAMPLES:
+            samples = self.profile.output_sizes(model_name, task)
+        if len(samples) < _ADAPTIVE_MIN_SAMPLES:
+            return static
+        learned = math.ceil(_percentile(sorted(samples), self.max_tokens_quantile) * self.max_tokens_headroom)
+        learned = max(min(static, 256), min(learned, static * _ADAPTIVE_MAX_GROWTH))
+        self._learned_max_tokens[task] = (learned, static, len(samples))
+        return learned
+
+    def _observe_output_size(self, call_args: Dict[str, Any], response: LLMResponse) -> None:
+        """Record the size of a finished output (continuation parts included) for _adaptive_max_tokens."""
+        task = call_args.get("task") or ""
+        if not task:
+            return
+        completion_tokens = response.usage.get("completion_tokens") or self.tokens.count(response.text)
+        bucket = input_size_bucket(self._estimate_prompt_tokens(call_args))
+        self.profile.observe_output(self._task_model(task), task, bucket, completion_tokens)
+
+    def _model_targets(self) -> List[Tuple[Endpoint, str]]:
+        """Every (endpoint, model) pair the task profile can send calls to."""
+        targets = [(e, self.model_name) for e in self.endpoints.endpoints]
+        for route in self.task_routes.values():
+            endpoints = [self.endpoints.get(route.endpoint)] if route.endpoint else self.endpoints.endpoints
+            targets.extend((e, route.model or self.model_name) for e in endpoints)
+        unique: Dict[Tuple[str, str], Tuple[Endpoint, str]] = {}
+        for endpoint, model in targets:
+            unique.setdefault((endpoint.name, model), (endpoint, model))
+        return list(unique.values())
+
     def _get_temperature(self, env_var: str = "LLM_TEMPERATURE", default: float = 0.2) -> float:
         """Resolve temperature from env with clamping to a safe range."""
         raw = (os.getenv(env_var) or "").strip()
@@ -284,6 +616,9 @@ class DocGenerator:
             ],
         }
 
+    def _schema_file_analyses(self) -> Dict[str, Any]:
+        return {"type": "array", "items": self._schema_dir_analysis()}
+
     def _schema_bootstrap_doc_plan(self) -> Dict[str, Any]:
         return {
             "type": "array",
@@ -321,7 +656,7 @@ class DocGenerator:
             "type": "object",
             "additionalProperties": False,
             "properties": {
-                "action": {"type": "string"},
+                "action": {"type": "string", "enum": ["create", "update", "noop"]},
                 "target_category": {"type": "string"},
                 "file_name": {"type": "string"},
                 "content": {"type": "string"},
@@ -348,31 +683,54 @@ class DocGenerator:
             },
         }
 
+    def _compile_output_rules(self) -> Dict[str, OutputRules]:
+        page = dict(frontmatter=True, check_category=True, check_file_name=True, min_evidence=2)
+        doc_update = self._schema_doc_update()
+        return {
+            "repo_map": compile_rules("repo_map", self._schema_repo_map(), min_evidence=3),
+            "dir_analysis": compile_rules("dir_analysis", self._schema_dir_analysis(), min_evidence=2, max_evidence=10),
+            "doc_plan": compile_rules(
+                "doc_plan", self._schema_bootstrap_doc_plan(), check_category=True, check_file_name=True, min_evidence=2
+            ),
+            "doc_page": compile_rules(
+                "doc_page",
+                self._schema_doc_page(),
+                sections=("## 概述", "## 目录/结构", "## 适用范围", "## 变更影响分析", "## 证据"),
+                **page,
+            ),
+            "api_page": compile_rules(
+                "api_page",
+                self._schema_doc_page(),
+                sections=("## 概述", "## API 列表", "## 调用约定", "## 变更影响分析", "## 证据"),
+                **page,
+            ),
+            "bootstrap_doc": compile_rules(
+                "bootstrap_doc",
+                self._schema_bootstrap_docs(),
+                sections=("## 概述", "## 目录/结构", "## 适用范围", "## 变更影响分析"),
+                allow_index=False,
+                **page,
+            ),
+            # doc_update is checked by action: create needs a new safe path, update finds the page by name.
+            "doc_update": compile_rules("doc_update", doc_update),
+            "doc_update:create": compile_rules("doc_update", doc_update, allow_index=False, **page),
+            "doc_update:update": compile_rules(
+                "doc_update", doc_update, frontmatter=True, check_file_name=True, min_evidence=2
+            ),
+        }
+
+    def build_evidence_index(self, repo_dir: str) -> None:
+        """Index the checkout so evidence quoting the real repo is accepted (and located) by the validators."""
+        if not self.use_evidence_index:
+            return
+        self.evidence_index = EvidenceIndex.from_repo(repo_dir)
+        print(f"证据索引已建立: {self.evidence_index.summary()}")
+
     def _is_safe_category_path(self, category: str) -> bool:
-        category = (category or "").strip().strip("/")
-        if not category:
-            return False
-        if category.startswith(("/", "\\")):
-            return False
-        if "\\" in category or ":" in category:
-            return False
-        parts = [p for p in category.split("/") if p]
-        if not parts:
-            return False
-        for part in parts:
-            if part in {".", ".."}:
-                return False
-            if part.startswith("."):
-                return False
-            if part == "snapshots":
-                return False
-            if not self._category_segment_re.match(part):
-                return False
-        return True
+        return is_safe_category_path(category)
 
     def _normalize_category_path(self, category: str) -> str:
-        category = (category or "").strip().replace("\\", "/").strip("/")
-        return category
+        return normalize_category_path(category)
 
     def _get_base_context(self) -> str:
         """递归读取 docs_root 下的 md 文件作为上下文（排除 snapshots/，并做长度限制）。"""
@@ -380,11 +738,11 @@ class DocGenerator:
             return ""
 
         max_files = int(os.getenv("DOC_CONTEXT_MAX_FILES", "40") or "40")
-        max_chars_per_file = int(os.getenv("DOC_CONTEXT_MAX_CHARS_PER_FILE", "2000") or "2000")
-        max_total_chars = int(os.getenv("DOC_CONTEXT_MAX_TOTAL_CHARS", "40000") or "40000")
+        max_tokens_per_file = resolve_token_budget("DOC_CONTEXT_MAX_TOKENS_PER_FILE", "DOC_CONTEXT_MAX_CHARS_PER_FILE", 1200)
+        max_total_tokens = resolve_token_budget("DOC_CONTEXT_MAX_TOTAL_TOKENS", "DOC_CONTEXT_MAX_TOTAL_CHARS", 24000)
 
         context: List[str] = []
-        total_chars = 0
+        total_tokens = 0
         included = 0
         for root, _, files in os.walk(self.docs_root):
             if "snapshots" in root.split(os.sep):
@@ -396,13 +754,15 @@ class DocGenerator:
                 rel_path = os.path.relpath(full_path, self.docs_root)
                 with open(full_path, "r", encoding="utf-8") as f:
                     text = f.read() or ""
-                    if len(text) > max_chars_per_file:
-                        text = text[:max_chars_per_file] + "\n\n...[truncated]..."
+                    truncated = self.tokens.truncate(text, max_tokens_per_file)
+                    if len(truncated) < len(text):
+                        text = truncated + "\n\n...[truncated]..."
                     chunk = f"--- Doc: {rel_path} ---\n{text}"
-                    if total_chars + len(chunk) > max_total_chars:
+                    chunk_tokens = self.tokens.count(chunk)
+                    if total_tokens + chunk_tokens > max_total_tokens:
                         return "\n\n".join(context)
                     context.append(chunk)
-                    total_chars += len(chunk)
+                    total_tokens += chunk_tokens
                     included += 1
                     if included >= max_files:
                         return "\n\n".join(context)
@@ -410,9 +770,11 @@ class DocGenerator:
         return "\n\n".join(context)
 
     def _mask_sensitive(self, text: str) -> str:
-        if not self.__api_key:
-            return text
-        return (text or "").replace(self.__api_key, "***")
+        text = text or ""
+        for api_key in {self.__api_key, *(e.api_key for e in self.endpoints.endpoints)}:
+            if api_key:
+                text = text.replace(api_key, "***")
+        return text
 
     def _handle_exception(self, e: Exception, context: str) -> None:
         error_msg = self._mask_sensitive(str(e))
@@ -430,23 +792,173 @@ class DocGenerator:
                 print("诊断建议: 上游服务端错误，请稍后重试。")
 
         print("提示: 如需排查连通性，可运行 `python scripts/test_api.py`。")
+        self._discard_last_llm_response()
+
+    def report_llm_metrics(self) -> None:
+        lines = self.metrics.summary_lines()
+        if self.cache is not None and (self.cache.hits or self.cache.misses):
+            lines.append(f"- llm_response_cache: {self.cache.summary()}")
+        if len(self.endpoints) > 1:
+            lines.append(f"- llm_endpoints: {self.endpoints.summary()}")
+        prompt_tokens = self.metrics.counter("llm_prompt_tokens")
+        if prompt_tokens:
+            cached = self.metrics.counter("llm_cached_prompt_tokens")
+            lines.append(f"- llm_prompt_cache: cached={cached}/{prompt_tokens} prompt tokens ({cached / prompt_tokens:.1%})")
+        outputs = self.metrics.counter("llm_json_outputs")
+        if outputs:
+            failed = self.metrics.counter("llm_json_parse_failures")
+            lines.append(
+                f"- llm_json: outputs={outputs} repaired={self.metrics.counter('llm_json_repaired')} "
+                f"parse_failures={failed} ({failed / outputs:.1%}) wasted_calls={self.metrics.counter('llm_wasted_calls')}"
+            )
+        repairs = self.metrics.counter("llm_repairs")
+        if repairs:
+            succeeded = self.metrics.counter("llm_repairs_succeeded")
+            lines.append(
+                f"- llm_repair: attempts={repairs} succeeded={succeeded} ({succeeded / repairs:.1%}) "
+                f"prompt_tokens_saved={self.metrics.counter('llm_repair_tokens_saved')}"
+            )
+        for task, (learned, static, samples) in sorted(self._learned_max_tokens.items()):
+            lines.append(f"- llm_max_tokens[{task}]: learned={learned} static={static} samples={samples}")
+        if self.dir_analysis_cache is not None and (self.dir_analysis_cache.hits or self.dir_analysis_cache.misses):
+            lines.append(f"- dir_analysis_cache: {self.dir_analysis_cache.summary()}")
+        if self.metrics.samples(self._DIR_CHUNK_METRIC):
+            histogram = self.metrics.histogram(self._DIR_CHUNK_METRIC, self._DIR_CHUNK_BUCKETS)
+            lines.append(f"- {self._DIR_CHUNK_METRIC}_histogram: {histogram}")
+        if self.evidence_index is not None:
+            lines.append(f"- evidence_index: {self.evidence_index.summary()}")
+        if self.hedge is not None and self.hedge.calls:
+            lines.append(f"- llm_hedge: {self.hedge.summary()}")
+        if self.breaker is not None and self.breaker.opened:
+            lines.append(f"- llm_circuit_breaker: {self.breaker.summary()}")
+        if not lines:
+            return
+        print("\n" + "=" * 20 + " LLM 调用统计 " + "=" * 20)
+        for line in lines:
+            print(line)
+
+    def _cache_key(
+        self,
+        prompt: str,
+        system_instruction: Optional[str],
+        temperature: float,
+        max_tokens: int,
+        response_schema: Optional[Dict[str, Any]],
+        response_schema_name: str,
+        cache_prefix: Optional[str] = None,
+        task: str = "",
+    ) -> Optional[str]:
+        # cache_prefix only changes how the prompt is sent, not what is asked, so it is not part of the key.
+        if self.cache is None:
+            return None
+        try:
+            style = detect_api_style(self.base_url, self.api_style)
+        except Exception:
+            style = "auto"
+        today = datetime.now().strftime("%Y-%m-%d")
+        return ResponseCache.make_key(
+            {
+                "model": self._task_model(task),
+                "style": style,
+                "system_instruction": (system_instruction or "").replace(today, "{today}"),
+                "prompt": (prompt or "").replace(today, "{today}"),
+                "temperature": float(temperature),
+                "max_tokens": self._task_max_tokens(task, max_tokens),
+                "schema": [response_schema_name, response_schema] if response_schema is not None else None,
+            }
+        )
 
-    def _call_llm(
+    def _cache_lookup(self, key: Optional[str]) -> Optional[str]:
+        _LAST_CACHE_KEY.set(None)
+        _LAST_CALL_LIVE.set(False)
+        if not key or self.cache is None:
+            return None
+        entry = self.cache.get(key)
+        if entry is None or not isinstance(entry.get("text"), str):
+            return None
+        text = entry["text"]
+        today = datetime.now().strftime("%Y-%m-%d")
+        cached_today = entry.get("today") or ""
+        if cached_today and cached_today != today:
+            text = text.replace(cached_today, today)
+        _LAST_CACHE_KEY.set(key)
+        print(f"命中 LLM 响应缓存: {key[:12]}")
+        return text
+
+    def _cache_store(self, key: Optional[str], response: LLMResponse) -> None:
+        if not key or self.cache is None:
+            return
+        if response.truncated:
+            return
+        try:
+            self.cache.put(
+                key,
+                {"model": self.model_name, "today": datetime.now().strftime("%Y-%m-%d"), "text": response.text},
+            )
+            _LAST_CACHE_KEY.set(key)
+        except Exception as e:
+            print(f"警告: 写入 LLM 响应缓存失败: {e}")
+
+    def _discard_last_llm_response(self) -> None:
+        """Evict the cached response behind the last call in this context (its output was rejected)."""
+        if _LAST_CALL_LIVE.get():
+            self.metrics.incr("llm_wasted_calls")
+            _LAST_CALL_LIVE.set(False)
+        key = _LAST_CACHE_KEY.get()
+        if key and self.cache is not None:
+            self.cache.discard(key)
+            _LAST_CACHE_KEY.set(None)
+
+    def evict_llm_cache(self) -> None:
+        for cache, name in ((self.cache, "LLM 响应缓存"), (self.dir_analysis_cache, "目录分析缓存")):
+            if cache is None:
+                continue
+            try:
+                removed = cache.evict()
+                if removed:
+                    print(f"{name}已淘汰 {removed} 个条目。")
+            except Exception as e:
+                print(f"警告: 清理{name}失败: {e}")
+
+    def _prepare_llm_request(
         self,
         prompt: str,
-        system_instruction: Optional[str] = None,
-        temperature: float = 0.7,
-        max_tokens: int = 2048,
-        response_schema: Optional[Dict[str, Any]] = None,
-        response_schema_name: str = "output",
-    ) -> str:
-        print(f"发起请求: model={self.model_name}")
-        if self.show_base_url_in_logs:
-            print(f"  - Base URL: {self._mask_sensitive(self.base_url)}")
-        else:
-            print("  - Base URL: (hidden)")
-        print(f"  - API Style: {self.api_style}")
-        print(f"  - Temperature: {temperature}")
+        system_instruction: Optional[str],
+        temperature: float,
+        max_tokens: int,
+        response_schema: Optional[Dict[str, Any]],
+        response_schema_name: str,
+        cache_prefix: Optional[str] = None,
+        timeout_seconds: int = 600,
+        log: bool = True,
+        endpoint: Optional[Endpoint] = None,
+        task: str = "",
+        continue_from: Optional[str] = None,
+        prompt_cache: bool = True,
+    ) -> Dict[str, Any]:
+        """Log the request and resolve the keyword arguments shared by generate_response/agenerate_response.
+
+        `continue_from` turns the request into a continuation of that truncated output (sent without
+        response_format, since the remainder alone is not a valid JSON document). With prompt_cache=False the
+        shared prefix is left in the prompt; the async path applies it afterwards with _aapply_prompt_cache.
+        """
+        endpoint = endpoint or self.endpoints.primary
+        model_name = self._task_model(task)
+        max_tokens = self._task_max_tokens(task, max_tokens)
+        prompt_tokens = self.tokens.count(prompt) + self.tokens.count(system_instruction)
+        if continue_from is None:
+            max_tokens = self._adaptive_max_tokens(task, model_name, max_tokens, prompt_tokens)
+        if log:
+            print(f"发起请求: model={model_name}{f' ({task})' if task else ''}{' [续写]' if continue_from else ''}")
+            if len(self.endpoints) > 1:
+                print(f"  - Endpoint: {endpoint.name}")
+            if self.show_base_url_in_logs:
+                print(f"  - Base URL: {self._mask_sensitive(endpoint.base_url)}")
+            else:
+                print("  - Base URL: (hidden)")
+            print(f"  - API Style: {endpoint.api_style}")
+            print(f"  - Transport: {self.transport}{' (stream)' if self.stream else ''}")
+            print(f"  - Temperature: {temperature}")
 
         # Global output token cap (optional).
         raw_cap = os.getenv("LLM_MAX_OUTPUT_TOKENS") or os.getenv("LLM_MAX_TOKENS") or ""
@@ -457,15 +969,12 @@ class DocGenerator:
         if cap > 0:
             max_tokens = max(1, min(int(max_tokens), cap))
 
+        # Both styles take the OpenAI response_format shape; llm_client maps it to Gemini's
+        # responseSchema / responseMimeType.
         response_format = None
         structured_enabled = (os.getenv("LLM_STRUCTURED_OUTPUT") or "1").strip().lower() not in {"0", "false", "no"}
-        if structured_enabled:
-            try:
-                style = detect_api_style(self.base_url, self.api_style)
-            except Exception:
-                style = "auto"
-
-            if style == "openai" and response_schema is not None:
+        if structured_enabled and continue_from is None:
+            if response_schema is not None:
                 schema_name = (response_schema_name or "output").strip()
                 schema_name = re.sub(r"[^a-zA-Z0-9_-]+", "_", schema_name)[:64] or "output"
                 response_format = {
@@ -476,215 +985,1232 @@ class DocGenerator:
                         "schema": response_schema,
                     },
                 }
-            elif style == "openai" and response_schema is None and "json" in (prompt or "").lower():
+            elif "json" in (prompt or "").lower():
                 # Best-effort JSON mode when no schema is provided but the prompt expects JSON.
                 response_format = {"type": "json_object"}
 
-        max_retries = 3
-        for attempt in range(max_retries):
+        try:
+            style = detect_api_style(endpoint.base_url, endpoint.api_style)
+        except Exception:
+            style = "auto"
+        response_format, max_tokens = self._apply_capabilities(
+            response_format,
+            max_tokens,
+            prompt_tokens=prompt_tokens,
+            base_url=endpoint.base_url,
+            model_name=model_name,
+            style=style,
+        )
+
+        request = {
+            "api_key": endpoint.api_key,
+            "base_url": endpoint.base_url,
+            "model_name": model_name,
+            "prompt": prompt,
+            "system_instruction": system_instruction,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response_format": response_format,
+            "api_version": config.GEMINI_API_VERSION,
+            "api_style": endpoint.api_style,
+            "timeout_seconds": int(timeout_seconds),
+            "transport": self.transport,
+            "stream": self.stream,
+            "stream_idle_timeout": self.stream_idle_timeout,
+            # Rejected response_format modes surface as FormatRejected and are downgraded by the retry loop.
+            "format_fallback": False,
+        }
+        if continue_from is not None:
+            request["extra_messages"] = [
+                {"role": "assistant", "content": continue_from},
+                {"role": "user", "content": _CONTINUE_PROMPT},
+            ]
+        if prompt_cache and self._uses_prompt_cache(request, cache_prefix):
+            self._apply_prompt_cache(request, endpoint, cache_prefix or "")
+        return request
+
+    def _uses_prompt_cache(self, request: Dict[str, Any], cache_prefix: Optional[str]) -> bool:
+        return bool(self.prompt_cache and cache_prefix and (request.get("prompt") or "").startswith(cache_prefix))
+
+    def _prompt_cache_key(
+        self, request: Dict[str, Any], endpoint: Endpoint, cache_prefix: str
+    ) -> Optional[Tuple[str, str]]:
+        """Key of the Gemini cachedContents entry to use for this prefix, or None when there is none to create.
+
+        OpenAI-style endpoints cache prefixes on their own and only get a prompt_cache_key routing hint.
+        """
+        digest = hashlib.sha256(
+            f"{request['model_name']}\n{request.get('system_instruction') or ''}\n{cache_prefix}".encode("utf-8")
+        ).hexdigest()[:24]
+        try:
+            style = detect_api_style(endpoint.base_url, endpoint.api_style)
+        except Exception:
+            return None
+        if style == "openai":
+            request["prompt_cache_key"] = f"docgen-{digest}"
+            return None
+        if self.tokens.count(cache_prefix) < _GEMINI_CACHE_MIN_TOKENS:
+            return None
+        return (endpoint.name, digest)
+
+    @staticmethod
+    def _use_cached_content(request: Dict[str, Any], cache_prefix: str, name: Optional[str]) -> None:
+        if name:
+            request["cached_content"] = name
+            request["prompt"] = request["prompt"][len(cache_prefix) :]
+
+    def _apply_prompt_cache(self, request: Dict[str, Any], endpoint: Endpoint, cache_prefix: str) -> None:
+        key = self._prompt_cache_key(request, endpoint, cache_prefix)
+        if key is None:
+            return
+        name = self._gemini_cached_content(
+            endpoint, key, request["model_name"], request.get("system_instruction"), cache_prefix
+        )
+        self._use_cached_content(request, cache_prefix, name)
+
+    async def _aapply_prompt_cache(self, request: Dict[str, Any], endpoint: Endpoint, cache_prefix: str) -> None:
+        """_apply_prompt_cache without blocking the event loop on the cachedContents round-trip.
+
+        The first caller for a prefix creates the entry in a worker thread; concurrent callers on the same loop
+        await that same creation instead of starting their own.
+        """
+        key = self._prompt_cache_key(request, endpoint, cache_prefix)
+        if key is None:
+            return
+        name, expires = self._gemini_caches.get(key, ("", 0.0))
+        if time.time() >= expires:
+            pending_key = (asyncio.get_running_loop(), key)
+            pending = self._gemini_cache_pending.get(pending_key)
+            if pending is None:
+                pending = asyncio.ensure_future(
+                    asyncio.to_thread(
+                        self._gemini_cached_content,
+                        endpoint,
+                        key,
+                        request["model_name"],
+                        request.get("system_instruction"),
+                        cache_prefix,
+                    )
+                )
+                self._gemini_cache_pending[pending_key] = pending
+                pending.add_done_callback(lambda _f: self._gemini_cache_pending.pop(pending_key, None))
+            # Shielded: a cancelled caller must not cancel the creation the others are waiting on.
+            name = await asyncio.shield(pending)
+        self._use_cached_content(request, cache_prefix, name)
+
+    def _gemini_cached_content(
+        self,
+        endpoint: Endpoint,
+        key: Tuple[str, str],
+        model_name: str,
+        system_instruction: Optional[str],
+        text: str,
+    ) -> Optional[str]:
+        """Return a live cachedContents name for this prefix, creating it on first use (None when unavailable)."""
+        with self._gemini_cache_lock:
+            name, expires = self._gemini_caches.get(key, ("", 0.0))
+            if time.time() < expires:
+                return name or None
             try:
-                return generate_text(
-                    api_key=self.__api_key,
-                    base_url=self.base_url,
-                    model_name=self.model_name,
-                    prompt=prompt,
+                name, usage = create_gemini_cached_content(
+                    api_key=endpoint.api_key,
+                    base_url=endpoint.base_url,
+                    model_name=model_name,
+                    text=text,
                     system_instruction=system_instruction,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    response_format=response_format,
                     api_version=config.GEMINI_API_VERSION,
-                    api_style=self.api_style,
-                    timeout_seconds=600,
+                    ttl_seconds=self.prompt_cache_ttl,
+                    transport=self.transport,
                 )
-            except HttpError as e:
-                if e.status_code in [403, 429] and attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2
-                    print(f"收到 API 错误 {e.status_code}，正在进行第 {attempt + 1} 次重试，等待 {wait_time} 秒...")
-                    time.sleep(wait_time)
-                    continue
-                raise e
+                # Renew a minute early so no request races the expiry.
+                self._gemini_caches[key] = (name, time.time() + max(0, self.prompt_cache_ttl - 60))
+                self.metrics.incr("llm_prompt_cache_created")
+                print(f"  - 已创建 Gemini 上下文缓存（约 {usage.get('total_tokens', '?')} tokens，{self.prompt_cache_ttl}s）")
+                return name
             except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2
-                    print(f"请求发生异常: {self._mask_sensitive(str(e))}，正在进行第 {attempt + 1} 次重试...")
-                    time.sleep(wait_time)
-                    continue
-                raise e
+                # Typically "content too small" or caching unsupported by the model; don't retry this prefix.
+                self._gemini_caches[key] = ("", time.time() + self.prompt_cache_ttl)
+                print(f"  - 无法创建 Gemini 上下文缓存，改为完整发送: {self._mask_sensitive(str(e))[:200]}")
+                return None
 
-        raise RuntimeError("unreachable")
+    def _apply_capabilities(
+        self,
+        response_format: Optional[Dict[str, Any]],
+        max_tokens: int,
+        *,
+        prompt_tokens: int = 0,
+        base_url: Optional[str] = None,
+        model_name: Optional[str] = None,
+        style: str = "openai",
+    ) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Skip response_format modes the endpoint is known to reject and respect its known output/context limits."""
+        cap = self.profile.capability(base_url or self.base_url, model_name or self.model_name)
+        fmt_type = (response_format or {}).get("type")
+        if fmt_type == "json_schema" and cap.get("json_schema") is False:
+            schema = (response_format.get("json_schema") or {}).get("schema") or {}
+            # OpenAI's json_object only allows object roots; Gemini's JSON mime type takes arrays too.
+            json_mode_fits = schema.get("type") == "object" or style == "gemini"
+            if json_mode_fits and cap.get("json_object") is not False:
+                response_format = {"type": "json_object"}
+            else:
+                response_format = None
+        elif fmt_type == "json_object" and cap.get("json_object") is False:
+            response_format = None
+
+        limit = int(cap.get("max_output_tokens_limit") or 0)
+        if limit > 0 and int(max_tokens) > limit:
+            max_tokens = limit
+
+        context_limit = int(cap.get("context_limit_tokens") or 0)
+        if context_limit > 0 and prompt_tokens + int(max_tokens) > context_limit:
+            fitted = max(256, context_limit - prompt_tokens)
+            print(f"  - 预估输入约 {prompt_tokens} tokens，max_tokens {max_tokens} -> {fitted}（上下文窗口 {context_limit}）")
+            max_tokens = fitted
+        return response_format, max_tokens
+
+    def input_token_budget(self, requested: int) -> int:
+        """Clamp a prompt budget so that prompt + default output still fits the smallest learned context window."""
+        limits = [
+            int(self.profile.capability(endpoint.base_url, model).get("context_limit_tokens") or 0)
+            for endpoint, model in self._model_targets()
+        ]
+        context_limit = min([v for v in limits if v > 0], default=0)
+        if context_limit <= 0:
+            return int(requested)
+        return max(1000, min(int(requested), context_limit - self._get_max_tokens("", 8192)))
+
+    def _learn_capabilities(self, response: LLMResponse, base_url: str, model_name: str) -> None:
+        learned = {fmt: False for fmt in response.rejected_formats if fmt}
+        if response.response_format:
+            learned[response.response_format] = True
+        # Persist right away only when a capability actually changed; latency and output sizes wait for the
+        # save_llm_profile() at the end of the run.
+        if learned and self.profile.update_capability(base_url, model_name, **learned):
+            self.save_llm_profile()
+        self.profile.observe_call(
+            base_url,
+            model_name,
+            latency_seconds=response.latency_seconds,
+            completion_tokens=response.usage.get("completion_tokens"),
+        )
 
-    @dataclass
-    class _JsonParseError(Exception):
-        message: str
-        raw_preview: str = ""
+    def _learn_from_error(self, e: BaseException, base_url: str, request: Optional[Dict[str, Any]] = None) -> Optional[FormatRejected]:
+        """Record what an error says about the endpoint; returns FormatRejected for a rejected response_format."""
+        model_name = (request or {}).get("model_name") or self.model_name
+        if isinstance(e, HttpError) and e.status_code in {400, 413, 422}:
+            limits = parse_limits_from_error(e.body)
+            if limits and self.profile.update_capability(base_url, model_name, **limits):
+                self.save_llm_profile()
+        format_type = str(((request or {}).get("response_format") or {}).get("type") or "")
+        rejected = format_rejection(e, format_type)
+        if rejected is not None:
+            # _apply_capabilities picks the next weaker mode (json_schema -> json_object -> prompt-only JSON).
+            if self.profile.update_capability(base_url, model_name, **{format_type: False}):
+                self.save_llm_profile()
+        return rejected
+
+    def ensure_capability_profile(self) -> None:
+        """Probe structured-output support once per (base_url, model) when LLM_CAPABILITY_PROBE=1."""
+        if (os.getenv("LLM_CAPABILITY_PROBE") or "0").strip().lower() not in {"1", "true", "yes"}:
+            return
+        for endpoint, model_name in self._model_targets():
+            self._probe_endpoint_capabilities(endpoint, model_name)
+
+    def _probe_endpoint_capabilities(self, endpoint: Endpoint, model_name: str) -> None:
+        cap = self.profile.capability(endpoint.base_url, model_name)
+        if "json_schema" in cap and "json_object" in cap:
+            return
+
+        label = f" ({endpoint.name})" if len(self.endpoints) > 1 else ""
+        if model_name != self.model_name:
+            label += f" [{model_name}]"
+        print(f"正在探测 LLM 端点的结构化输出能力{label}...")
+        probe_schema = {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {"ok": {"type": "boolean"}},
+            "required": ["ok"],
+        }
+        formats = [
+            ("json_schema", {"type": "json_schema", "json_schema": {"name": "probe", "strict": True, "schema": probe_schema}}),
+            ("json_object", {"type": "json_object"}),
+        ]
+        for fmt_type, fmt in formats:
+            try:
+                response = generate_response(
+                    api_key=endpoint.api_key,
+                    base_url=endpoint.base_url,
+                    model_name=model_name,
+                    prompt='Reply with the JSON object {"ok": true} and nothing else.',
+                    temperature=0,
+                    max_tokens=16,
+                    response_format=fmt,
+                    api_version=config.GEMINI_API_VERSION,
+                    api_style=endpoint.api_style,
+                    timeout_seconds=60,
+                    transport=self.transport,
+                    format_fallback=False,
+                )
+                self.profile.update_capability(endpoint.base_url, model_name, **{fmt_type: True})
+                self.profile.observe_call(endpoint.base_url, model_name, latency_seconds=response.latency_seconds)
+            except HttpError as e:
+                # Same test as the retry path: only a 400/422 about response_format says the mode is unsupported.
+                # Anything else (a rejected max_tokens, a proxy failing every request) tells nothing about it.
+                if format_rejection(e, fmt_type) is None:
+                    print(f"能力探测中止: HTTP {e.status_code}")
+                    break
+                self.profile.update_capability(endpoint.base_url, model_name, **{fmt_type: False})
+            except Exception as e:
+                print(f"能力探测中止: {self._mask_sensitive(str(e))}")
+                break
+        self.profile.save()
+        cap = self.profile.capability(endpoint.base_url, model_name)
+        print(f"  - json_schema={cap.get('json_schema')} json_object={cap.get('json_object')}")
 
-        def __str__(self) -> str:  # pragma: no cover
-            if self.raw_preview:
-                return f"{self.message} | preview={self.raw_preview}"
-            return self.message
+    def save_llm_profile(self) -> None:
+        try:
+            self.profile.save()
+        except Exception as e:
+            print(f"警告: 保存 LLM 能力档案失败: {e}")
 
-    def _escape_newlines_in_json_strings(self, s: str) -> str:
-        """Escape raw newlines inside double-quoted JSON strings (LLM often outputs invalid JSON)."""
-        if not s:
-            return s
-
-        out: List[str] = []
-        in_string = False
-        escape = False
-        for ch in s:
-            if in_string:
-                if escape:
-                    out.append(ch)
-                    escape = False
-                    continue
-                if ch == "\\":
-                    out.append(ch)
-                    escape = True
-                    continue
-                if ch == '"':
-                    out.append(ch)
-                    in_string = False
-                    continue
-                if ch == "\n":
-                    out.append("\\n")
-                    continue
-                if ch == "\r":
-                    out.append("\\r")
-                    continue
-                out.append(ch)
-                continue
+    @staticmethod
+    def _is_endpoint_failure(e: BaseException) -> bool:
+        """Errors that say something about the endpoint/key rather than the request itself."""
+        if isinstance(e, HttpError):
+            return e.status_code in {401, 403, 429} or e.status_code >= 500
+        return classify_error(e) == RETRYABLE
+
+    def _before_attempt(self, deadline: Deadline) -> int:
+        """Enforce the run/call deadlines and the circuit breaker; returns the HTTP timeout for the next attempt."""
+        for budget, env in ((self.run_deadline, "LLM_RUN_DEADLINE_SECONDS"), (deadline, "LLM_CALL_DEADLINE_SECONDS")):
+            if budget.expired():
+                self.metrics.incr("llm_deadline_exceeded")
+                raise DeadlineExceeded(f"LLM time budget exhausted ({env}={budget.seconds:.0f})")
+        if self.breaker is not None:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.metrics.incr("llm_circuit_rejected")
+                raise
+        remaining = [r for r in (deadline.remaining(), self.run_deadline.remaining()) if r is not None]
+        return int(max(10.0, min([600.0] + remaining)))
+
+    def _record_attempt_error(self, e: BaseException) -> None:
+        if self.breaker is None:
+            return
+        if isinstance(e, HttpError) and e.status_code == 429:
+            # Throttled, not down: the rate governor paces these, they should not trip the breaker.
+            self.breaker.record_neutral()
+            return
+        if not self._is_endpoint_failure(e):
+            # The endpoint answered (e.g. 400): it is up.
+            self.breaker.record_success()
+            return
+        opened = self.breaker.record_failure()
+        if opened:
+            self.metrics.incr("llm_circuit_opened")
+            print(f"LLM 调用连续失败，熔断 {opened:.0f}s：期间的调用直接失败，到期后放行一次试探请求")
+
+    def _retry_delay(
+        self, e: Exception, attempt: int, max_retries: int, *, failover: bool = False, deadline: Optional[Deadline] = None
+    ) -> Optional[float]:
+        """Return how long to wait before retrying after `e`, or None if the error should be raised.
+
+        A rejected response_format retries at once with the next weaker mode. With `failover` (another healthy
+        endpoint exists) endpoint-level failures retry there immediately; other retryable errors back off with
+        jitter, as long as the wait fits the call and run deadlines.
+        """
+        self.metrics.incr("llm_call_errors")
+        self._record_attempt_error(e)
+        kind = classify_error(e)
+        if kind == FALLBACK:
+            self.metrics.incr("llm_format_fallbacks")
+            print(f"端点不支持 response_format={e.format_type}，已记录并降级后重试...")
+            return 0.0
+        if attempt >= max_retries - 1 or (self.breaker is not None and self.breaker.is_open):
+            return None
+        if failover and self._is_endpoint_failure(e):
+            self.metrics.incr("llm_endpoint_failovers")
+            detail = f"API 错误 {e.status_code}" if isinstance(e, HttpError) else self._mask_sensitive(str(e))
+            print(f"端点调用失败（{detail}），切换到其他端点进行第 {attempt + 1} 次重试...")
+            return 0.0
+        if kind != RETRYABLE:
+            return None
+        wait_time = self.retry_policy.backoff(
+            attempt, retry_after=parse_retry_after(e.headers) if isinstance(e, HttpError) else None
+        )
+        if not self.run_deadline.allows(wait_time) or (deadline is not None and not deadline.allows(wait_time)):
+            print(f"剩余时间预算不足以等待 {wait_time:.1f} 秒后重试，放弃本次调用")
+            return None
+        if isinstance(e, HttpError):
+            print(f"收到 API 错误 {e.status_code}，正在进行第 {attempt + 1} 次重试，等待 {wait_time:.1f} 秒...")
+        else:
+            print(f"请求发生异常: {self._mask_sensitive(str(e))}，正在进行第 {attempt + 1} 次重试，等待 {wait_time:.1f} 秒...")
+        return wait_time
 
-            if ch == '"':
-                out.append(ch)
-                in_string = True
-                continue
-            out.append(ch)
+    def _estimate_prompt_tokens(self, request: Dict[str, Any]) -> int:
+        extra = sum(self.tokens.count(m.get("content")) for m in request.get("extra_messages") or [])
+        return self.tokens.count(request.get("prompt")) + self.tokens.count(request.get("system_instruction")) + extra
 
-        return "".join(out)
+    def _estimate_request_tokens(self, request: Dict[str, Any]) -> int:
+        return self._estimate_prompt_tokens(request) + int(request.get("max_tokens") or 0)
 
-    def _sanitize_json_like(self, s: str) -> str:
-        """Best-effort sanitize common LLM JSON issues without changing semantics too much."""
-        if not isinstance(s, str):
-            return ""
-        s = s.strip()
-        if not s:
-            return s
-
-        # Normalize common smart quotes.
-        s = (
-            s.replace("\u201c", '"')
-            .replace("\u201d", '"')
-            .replace("\u2018", "'")
-            .replace("\u2019", "'")
-        )
+    def _governor_acquired(self, waited: float) -> None:
+        if waited > 0.05:
+            self.metrics.observe("llm_governor_wait_s", waited)
+            print(f"  - 限流协调: 等待 {waited:.1f}s")
 
-        # Escape raw newlines inside quoted strings (invalid JSON otherwise).
-        s = self._escape_newlines_in_json_strings(s)
+    def _governor_acquire(self, endpoint: Endpoint, est_tokens: int) -> Optional[str]:
+        governor = self.governors.get(endpoint.name)
+        if governor is None:
+            return None
+        try:
+            lease, waited = governor.acquire(est_tokens)
+        except Exception as e:
+            print(f"警告: 限流协调器不可用，已停用: {e}")
+            self.governors = {}
+            return None
+        self._governor_acquired(waited)
+        return lease
 
-        # Remove trailing commas before object/array close.
-        for _ in range(5):
-            new = re.sub(r",\s*([}\]])", r"\1", s)
-            if new == s:
-                break
-            s = new
+    async def _agovernor_acquire(self, endpoint: Endpoint, est_tokens: int) -> Optional[str]:
+        governor = self.governors.get(endpoint.name)
+        if governor is None:
+            return None
+        try:
+            lease, waited = await governor.aacquire(est_tokens)
+        except Exception as e:
+            print(f"警告: 限流协调器不可用，已停用: {e}")
+            self.governors = {}
+            return None
+        self._governor_acquired(waited)
+        return lease
 
-        return s
+    def _governor_release(
+        self,
+        endpoint: Endpoint,
+        lease: Optional[str],
+        est_tokens: int,
+        *,
+        response: Optional[LLMResponse] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        governor = self._governor_released(endpoint, response=response, error=error)
+        if governor is None:
+            return
+        try:
+            cooldown = governor.release(lease, **self._governor_outcome(est_tokens, response=response, error=error))
+        except Exception as e:
+            print(f"警告: 限流协调器不可用，已停用: {e}")
+            self.governors = {}
+            return
+        self._governor_cooled_down(cooldown)
 
-    def _raw_decode_first_json(self, s: str) -> Any:
-        """Decode the first JSON value from a string (allows trailing text)."""
-        decoder = json.JSONDecoder()
-        s = (s or "").lstrip()
-        if not s:
-            raise self._JsonParseError("Empty response", raw_preview="")
+    async def _agovernor_release(
+        self,
+        endpoint: Endpoint,
+        lease: Optional[str],
+        est_tokens: int,
+        *,
+        response: Optional[LLMResponse] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        governor = self._governor_released(endpoint, response=response, error=error)
+        if governor is None:
+            return
+        try:
+            cooldown = await governor.arelease(
+                lease, **self._governor_outcome(est_tokens, response=response, error=error)
+            )
+        except Exception as e:
+            print(f"警告: 限流协调器不可用，已停用: {e}")
+            self.governors = {}
+            return
+        self._governor_cooled_down(cooldown)
+
+    def _governor_released(
+        self, endpoint: Endpoint, *, response: Optional[LLMResponse], error: Optional[BaseException]
+    ) -> Optional[RateGovernor]:
+        """Endpoint-pool and metrics bookkeeping for a finished call; returns the governor to release, if any."""
+        if isinstance(error, HttpError) and error.status_code == 429:
+            self.metrics.incr("llm_rate_limited")
+        self._endpoint_release(endpoint, response=response, error=error)
+        return self.governors.get(endpoint.name)
+
+    @staticmethod
+    def _governor_outcome(
+        est_tokens: int, *, response: Optional[LLMResponse], error: Optional[BaseException]
+    ) -> Dict[str, Any]:
+        if error is None:
+            outcome, headers = "ok", (response.headers if response else {})
+        elif isinstance(error, HttpError):
+            outcome, headers = ("rate_limited" if error.status_code == 429 else "error"), error.headers
+        else:
+            outcome, headers = "error", {}
+        return {
+            "est_tokens": est_tokens,
+            "actual_tokens": (response.usage.get("total_tokens") if response else None),
+            "headers": headers,
+            "outcome": outcome,
+        }
 
-        obj, _ = decoder.raw_decode(s)
-        return obj
+    @staticmethod
+    def _governor_cooled_down(cooldown: float) -> None:
+        if cooldown > 0:
+            print(f"  - 触发限流，共享同一 Key 的调用暂停 {cooldown:.1f}s（并发窗口已减半）")
+
+    def _endpoint_release(
+        self, endpoint: Endpoint, *, response: Optional[LLMResponse] = None, error: Optional[BaseException] = None
+    ) -> None:
+        if error is None:
+            self.endpoints.release(
+                endpoint,
+                latency_seconds=response.latency_seconds if response else None,
+                headers=response.headers if response else None,
+            )
+            return
+        failed = self._is_endpoint_failure(error)
+        drained = self.endpoints.release(
+            endpoint,
+            headers=error.headers if isinstance(error, HttpError) else None,
+            status_code=error.status_code if isinstance(error, HttpError) else None,
+            failed=failed,
+        )
+        if failed and drained > 0 and len(self.endpoints) > 1:
+            print(f"  - 端点 {endpoint.name} 暂停接收请求 {drained:.0f}s，到期后试探恢复")
 
-    def _try_parse_json(self, s: str) -> Any:
-        s = self._sanitize_json_like(s)
-        if not s:
-            raise self._JsonParseError("Empty response after sanitize", raw_preview="")
+    def _observe_usage(self, usage: Dict[str, int]) -> None:
+        if usage.get("prompt_tokens"):
+            self.metrics.incr("llm_prompt_tokens", usage["prompt_tokens"])
+        if usage.get("cached_tokens"):
+            self.metrics.incr("llm_cached_prompt_tokens", usage["cached_tokens"])
 
-        # 1) strict loads
+    def _record_llm_response(
+        self,
+        response: LLMResponse,
+        *,
+        endpoint: Endpoint,
+        request: Dict[str, Any],
+        task: str = "",
+        prompt_tokens_estimate: int = 0,
+    ) -> str:
+        model_name = request["model_name"]
+        self._learn_capabilities(response, endpoint.base_url, model_name)
+        self._observe_usage(response.usage)
+        if self.hedge is not None:
+            self.hedge.observe(response.latency_seconds)
+        # The estimator is tuned for MODEL_NAME's tokenizer; other tiers would skew its scale.
+        if prompt_tokens_estimate and response.usage.get("prompt_tokens") and model_name == self.model_name:
+            self.tokens.observe(prompt_tokens_estimate, response.usage["prompt_tokens"])
+            self.profile.update_capability(self.base_url, self.model_name, token_scale=round(self.tokens.scale, 3))
+        self.metrics.observe("llm_call_latency_s", response.latency_seconds)
+        self.metrics.observe_task(
+            task or "other",
+            model=model_name,
+            latency_seconds=response.latency_seconds,
+            prompt_tokens=response.usage.get("prompt_tokens") or 0,
+            completion_tokens=response.usage.get("completion_tokens") or 0,
+        )
+        if response.ttft_seconds is not None:
+            self.metrics.observe("llm_ttft_s", response.ttft_seconds)
+            print(f"  - 耗时: {response.latency_seconds:.2f}s (首 token {response.ttft_seconds:.2f}s)")
+        else:
+            print(f"  - 耗时: {response.latency_seconds:.2f}s")
+        if response.truncated:
+            self.metrics.incr("llm_truncated_outputs")
+            print("  - 警告: 输出达到 max_tokens 上限被截断，JSON 可能不完整。")
+        _LAST_CALL_LIVE.set(True)
+        return response.text
+
+    def _call_endpoint(
+        self,
+        endpoint: Endpoint,
+        call_args: Dict[str, Any],
+        *,
+        log: bool,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Tuple[Endpoint, Dict[str, Any], LLMResponse]:
+        """One attempt against one endpoint (already acquired from the pool), with governor bookkeeping."""
+        request = self._prepare_llm_request(**call_args, log=log, endpoint=endpoint)
+        if cancel_event is not None and request.get("stream"):
+
+            def on_text(_delta: str) -> None:
+                if cancel_event.is_set():
+                    raise HedgeCancelled("hedged call lost the race")
+
+            request["on_text"] = on_text
+        est_tokens = self._estimate_request_tokens(request)
+        lease = self._governor_acquire(endpoint, est_tokens)
         try:
-            return json.loads(s)
-        except Exception:
-            pass
-
-        # 2) raw decode (tolerate trailing text)
+            response = generate_response(**request)
+        except Exception as e:
+            self._governor_release(endpoint, lease, est_tokens, error=e)
+            rejected = self._learn_from_error(e, endpoint.base_url, request)
+            if rejected is not None:
+                raise rejected from e
+            raise
+        self._governor_release(endpoint, lease, est_tokens, response=response)
+        return endpoint, request, response
+
+    async def _acall_endpoint(
+        self, endpoint: Endpoint, call_args: Dict[str, Any], *, log: bool
+    ) -> Tuple[Endpoint, Dict[str, Any], LLMResponse]:
+        """Async counterpart of _call_endpoint. The endpoint is released however the attempt ends, including a
+        cancellation while it waits for the prompt cache or the governor (a cancelled call is not a failure)."""
+        request: Dict[str, Any] = {}
+        est_tokens = 0
+        lease: Optional[str] = None
         try:
-            return self._raw_decode_first_json(s)
-        except Exception:
-            pass
-
-        # 3) scan for a plausible JSON start and raw decode from there
-        starts = [m.start() for m in re.finditer(r"[\[{]", s)]
-        for pos in starts[:50]:
+            request = self._prepare_llm_request(**call_args, log=log, endpoint=endpoint, prompt_cache=False)
+            cache_prefix = call_args.get("cache_prefix")
+            if self._uses_prompt_cache(request, cache_prefix):
+                await self._aapply_prompt_cache(request, endpoint, cache_prefix or "")
+            est_tokens = self._estimate_request_tokens(request)
+            lease = await self._agovernor_acquire(endpoint, est_tokens)
+            response = await agenerate_response(**request)
+        except (Exception, asyncio.CancelledError) as e:
+            await self._agovernor_release(endpoint, lease, est_tokens, error=e)
+            rejected = self._learn_from_error(e, endpoint.base_url, request)
+            if rejected is not None:
+                raise rejected from e
+            raise
+        await self._agovernor_release(endpoint, lease, est_tokens, response=response)
+        return endpoint, request, response
+
+    def _hedge_started(self, endpoint: Endpoint, deadline: float, call_args: Dict[str, Any]) -> Endpoint:
+        only = self._task_route(call_args.get("task") or "").endpoint
+        hedge_endpoint = self.endpoints.acquire(exclude=endpoint, only=only)
+        self.metrics.incr("llm_hedges_fired")
+        target = f"端点 {hedge_endpoint.name}" if len(self.endpoints) > 1 else "同一端点"
+        print(f"  - 请求超过 {deadline:.1f}s 未返回，向{target}发起对冲请求")
+        return hedge_endpoint
+
+    def _hedge_won(self) -> None:
+        self.hedge.record_win()
+        self.metrics.incr("llm_hedges_won")
+        print("  - 对冲请求先返回，已放弃原请求")
+
+    @staticmethod
+    def _submit_daemon(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> "concurrent.futures.Future[Any]":
+        # Daemon thread rather than an executor: an abandoned losing call must not hold up interpreter exit.
+        future: "concurrent.futures.Future[Any]" = concurrent.futures.Future()
+
+        def run() -> None:
             try:
-                return self._raw_decode_first_json(s[pos:])
-            except Exception:
-                continue
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
 
-        preview = s[:300].replace("\n", "\\n")
-        raise self._JsonParseError("Failed to parse JSON from model output", raw_preview=preview)
+        threading.Thread(target=run, name="llm-hedge", daemon=True).start()
+        return future
 
-    def _coerce_object_keys(
+    def _hedged_call(
+        self, endpoint: Endpoint, call_args: Dict[str, Any], *, log: bool
+    ) -> Tuple[Endpoint, Dict[str, Any], LLMResponse]:
+        """Run one attempt; if it outlives the hedge deadline, race a duplicate and keep the first success.
+
+        Sync HTTP calls cannot be interrupted: a losing streamed call is aborted at its next chunk, a losing
+        non-streamed call finishes in the background and its result is dropped.
+        """
+        deadline = self.hedge.deadline() if self.hedge is not None else None
+        if deadline is None:
+            return self._call_endpoint(endpoint, call_args, log=log)
+
+        cancel_primary, cancel_hedge = threading.Event(), threading.Event()
+        primary = self._submit_daemon(self._call_endpoint, endpoint, call_args, log=log, cancel_event=cancel_primary)
+        done, _ = concurrent.futures.wait({primary}, timeout=deadline)
+        if done or not self.hedge.try_fire():
+            return primary.result()
+
+        hedge_endpoint = self._hedge_started(endpoint, deadline, call_args)
+        hedge = self._submit_daemon(
+            self._call_endpoint, hedge_endpoint, call_args, log=False, cancel_event=cancel_hedge
+        )
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    (cancel_hedge if future is primary else cancel_primary).set()
+                    if future is hedge:
+                        self._hedge_won()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _ahedged_call(
+        self, endpoint: Endpoint, call_args: Dict[str, Any], *, log: bool
+    ) -> Tuple[Endpoint, Dict[str, Any], LLMResponse]:
+        """Async counterpart of _hedged_call; the losing call is cancelled."""
+        deadline = self.hedge.deadline() if self.hedge is not None else None
+        if deadline is None:
+            return await self._acall_endpoint(endpoint, call_args, log=log)
+
+        primary = asyncio.ensure_future(self._acall_endpoint(endpoint, call_args, log=log))
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if done or not self.hedge.try_fire():
+            return await primary
+
+        async def hedged() -> Tuple[Endpoint, Dict[str, Any], LLMResponse]:
+            # Acquired by the task itself: a hedge cancelled before its first step holds no endpoint.
+            return await self._acall_endpoint(self._hedge_started(endpoint, deadline, call_args), call_args, log=False)
+
+        hedge = asyncio.ensure_future(hedged())
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._hedge_won()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _call_llm(
         self,
-        obj: Dict[str, Any],
-        required_keys: List[str],
-        *,
-        defaults: Optional[Dict[str, Any]] = None,
-    ) -> Dict[str, Any]:
-        """Coerce near-miss keys into a fixed schema; drop unknown keys; fill missing with defaults."""
-        required = list(required_keys)
-        defaults = defaults or {}
+        prompt: str,
+        system_instruction: Optional[str] = None,
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        response_schema: Optional[Dict[str, Any]] = None,
+        response_schema_name: str = "output",
+        cache_prefix: Optional[str] = None,
+        task: str = "",
+    ) -> str:
+        call_args = {
+            "prompt": prompt,
+            "system_instruction": system_instruction,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response_schema": response_schema,
+            "response_schema_name": response_schema_name,
+            "cache_prefix": cache_prefix,
+            "task": task,
+        }
+        cache_key = self._call_cache_key(call_args)
+        cached = self._cache_lookup(cache_key)
+        if cached is not None:
+            return cached
 
-        def canon(k: str) -> str:
-            return re.sub(r"[^a-z0-9]", "", (k or "").lower())
+        response = self._call_with_retries(call_args)
+        if response.truncated and self.max_continuations:
+            response = self._continue_truncated(call_args, response)
+        return self._finish_call(cache_key, call_args, response)
 
-        required_canon_to_key = {canon(k): k for k in required}
-        out: Dict[str, Any] = {}
+    async def _acall_llm(
+        self,
+        prompt: str,
+        system_instruction: Optional[str] = None,
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        response_schema: Optional[Dict[str, Any]] = None,
+        response_schema_name: str = "output",
+        cache_prefix: Optional[str] = None,
+        task: str = "",
+    ) -> str:
+        """Async counterpart of _call_llm with the same retry semantics."""
+        call_args = {
+            "prompt": prompt,
+            "system_instruction": system_instruction,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response_schema": response_schema,
+            "response_schema_name": response_schema_name,
+            "cache_prefix": cache_prefix,
+            "task": task,
+        }
+        cache_key = self._call_cache_key(call_args)
+        cached = self._cache_lookup(cache_key)
+        if cached is not None:
+            return cached
+
+        response = await self._acall_with_retries(call_args)
+        if response.truncated and self.max_continuations:
+            response = await self._acontinue_truncated(call_args, response)
+        return self._finish_call(cache_key, call_args, response)
+
+    def _call_cache_key(self, call_args: Dict[str, Any]) -> Optional[str]:
+        return self._cache_key(
+            call_args["prompt"],
+            call_args["system_instruction"],
+            call_args["temperature"],
+            call_args["max_tokens"],
+            call_args["response_schema"],
+            call_args["response_schema_name"],
+            task=call_args["task"],
+        )
 
-        # First pass: exact key or canonical match
-        for k, v in (obj or {}).items():
-            if k in required:
-                out[k] = v
-                continue
-            ck = canon(str(k))
-            if ck in required_canon_to_key:
-                out[required_canon_to_key[ck]] = v
+    def _finish_call(self, cache_key: Optional[str], call_args: Dict[str, Any], response: LLMResponse) -> str:
+        self._observe_output_size(call_args, response)
+        self._cache_store(cache_key, response)
+        return response.text
+
+    class _Retries:
+        """Endpoint choice and retry bookkeeping of one logical call (_call_with_retries / _acall_with_retries)."""
+
+        def __init__(self, gen: "DocGenerator", call_args: Dict[str, Any]):
+            self.gen = gen
+            self.call_args = call_args
+            self.only = gen._task_route(call_args.get("task") or "").endpoint
+            self.max_retries = max(3, len(gen.endpoints) + 1)
+            self.deadline = Deadline(gen.call_deadline_seconds)
+            self.endpoint: Optional[Endpoint] = None
+            self.attempt = 0
+            self.sent = False
+
+        def next_endpoint(self) -> Endpoint:
+            """Check the deadlines and the breaker, then pick the endpoint of the next attempt (not the last one)."""
+            self.call_args["timeout_seconds"] = self.gen._before_attempt(self.deadline)
+            self.endpoint = self.gen.endpoints.acquire(exclude=self.endpoint, only=self.only)
+            return self.endpoint
+
+        def delay_after(self, e: Exception) -> float:
+            """Seconds to wait before the next attempt after `e`; re-raises `e` when it should not be retried."""
+            failover = self.gen.endpoints.has_alternative(self.endpoint, only=self.only)
+            wait_time = self.gen._retry_delay(e, self.attempt, self.max_retries, failover=failover, deadline=self.deadline)
+            if wait_time is None:
+                raise e
+            self.sent = True
+            # A format downgrade is a different request, not a retry of the same one.
+            if not isinstance(e, FormatRejected):
+                self.attempt += 1
+            return wait_time
+
+    def _call_with_retries(self, call_args: Dict[str, Any]) -> LLMResponse:
+        """One logical call: endpoint selection, hedging, retries/failover and format downgrades."""
+        retries = self._Retries(self, call_args)
+        while True:
+            endpoint = retries.next_endpoint()
+            try:
+                used_endpoint, request, response = self._hedged_call(endpoint, call_args, log=not retries.sent)
+            except Exception as e:
+                time.sleep(retries.delay_after(e))
                 continue
+            self._record_success(response, used_endpoint, request, call_args)
+            return response
 
-        # Second pass: substring match for common LLM typos (e.g. "ris risks" -> "risks")
-        for k, v in (obj or {}).items():
-            if k in out:
-                continue
-            ck = canon(str(k))
-            if not ck:
+    async def _acall_with_retries(self, call_args: Dict[str, Any]) -> LLMResponse:
+        retries = self._Retries(self, call_args)
+        while True:
+            endpoint = retries.next_endpoint()
+            try:
+                used_endpoint, request, response = await self._ahedged_call(endpoint, call_args, log=not retries.sent)
+            except asyncio.CancelledError:
+                if self.breaker is not None:
+                    self.breaker.record_neutral()
+                raise
+            except Exception as e:
+                await asyncio.sleep(retries.delay_after(e))
                 continue
-            candidates = [rk for rk in required if canon(rk) and canon(rk) in ck]
-            candidates = sorted(set(candidates), key=lambda x: len(canon(x)), reverse=True)
-            if len(candidates) == 1 and candidates[0] not in out:
-                out[candidates[0]] = v
+            self._record_success(response, used_endpoint, request, call_args)
+            return response
+
+    def _record_success(
+        self, response: LLMResponse, endpoint: Endpoint, request: Dict[str, Any], call_args: Dict[str, Any]
+    ) -> None:
+        if self.breaker is not None:
+            self.breaker.record_success()
+        self._record_llm_response(
+            response,
+            endpoint=endpoint,
+            request=request,
+            task=call_args.get("task") or "",
+            # A Gemini cachedContents prefix is billed as prompt tokens but not sent, so it can't calibrate.
+            prompt_tokens_estimate=0 if request.get("cached_content") else self._estimate_prompt_tokens(request),
+        )
 
-        # Fill missing keys with safe defaults
-        for k in required:
-            if k not in out:
-                out[k] = defaults.get(k, "")
+    def _continue_truncated(self, call_args: Dict[str, Any], response: LLMResponse) -> LLMResponse:
+        """Ask for the rest of a max_tokens-truncated output (up to LLM_MAX_CONTINUATIONS times) and stitch it on.
 
-        return out
+        A failed continuation keeps the truncated output, so the caller's parser/validator still decides.
+        The stitched response's completion_tokens counts every part.
+        """
+        continuation = _Continuation(response)
+        for i in range(self.max_continuations):
+            self._log_continuation(i)
+            try:
+                part = self._call_with_retries({**call_args, "continue_from": continuation.text})
+            except Exception as e:
+                print(f"  - 续写失败: {self._mask_sensitive(str(e))[:200]}")
+                break
+            if not continuation.add(part):
+                break
+        return continuation.result()
 
-    def _extract_json(self, text: str) -> Any:
-        if not isinstance(text, str):
-            raise self._JsonParseError("Model output is not a string", raw_preview=str(type(text)))
+    async def _acontinue_truncated(self, call_args: Dict[str, Any], response: LLMResponse) -> LLMResponse:
+        continuation = _Continuation(response)
+        for i in range(self.max_continuations):
+            self._log_continuation(i)
+            try:
+                part = await self._acall_with_retries({**call_args, "continue_from": continuation.text})
+            except Exception as e:
+                print(f"  - 续写失败: {self._mask_sensitive(str(e))[:200]}")
+                break
+            if not continuation.add(part):
+                break
+        return continuation.result()
 
-        # Prefer explicit json code fence, but still parse robustly.
-        fence = re.search(r"```json\s*(.*?)\s*```", text, re.DOTALL | re.IGNORECASE)
-        if fence:
-            return self._try_parse_json(fence.group(1))
+    def _log_continuation(self, i: int) -> None:
+        print(f"  - 发起续写请求（{i + 1}/{self.max_continuations}）")
+        self.metrics.incr("llm_continuations")
 
-        # Otherwise parse from the first JSON value in the response.
-        return self._try_parse_json(text)
+    @dataclass
+    class _LLMJob:
+        """One LLM call: keyword arguments for _call_llm plus the inputs its parser needs."""
+
+        label: str
+        request: Dict[str, Any]
+        context: Dict[str, Any]
+        # Text the output's evidence must quote verbatim; candidates from it go into repair requests.
+        evidence_source: str = ""
+
+    def _run_job(self, job: "DocGenerator._LLMJob", parse: Callable[[str, "DocGenerator._LLMJob"], Any]) -> Any:
+        try:
+            raw = self._call_llm(**job.request)
+            return self._parse_with_repair(job, parse, raw)
+        except Exception as e:
+            self._handle_exception(e, job.label)
+            return None
+
+    async def _arun_job(
+        self, job: "DocGenerator._LLMJob", parse: Callable[[str, "DocGenerator._LLMJob"], Any]
+    ) -> Any:
+        try:
+            raw = await self._acall_llm(**job.request)
+            return await self._aparse_with_repair(job, parse, raw)
+        except Exception as e:
+            self._handle_exception(e, job.label)
+            return None
+
+    def _evidence_candidates(self, text: str, *, extra: Sequence[str] = (), limit: int = 20) -> str:
+        text = text or ""
+        signatures = [line.strip() for line in text.splitlines() if line.startswith(("def ", "async def ", "class "))]
+        tokens = dict.fromkeys(t for t in (*extra, *_EVIDENCE_PATH_RE.findall(text), *signatures) if t and t in text)
+        return "\n".join(f"- {t}" for t in list(tokens)[:limit])
+
+    def _repair_request(
+        self,
+        request: Dict[str, Any],
+        previous: str,
+        errors: Sequence[str],
+        *,
+        evidence_source: str = "",
+        extra: Sequence[str] = (),
+    ) -> Dict[str, Any]:
+        """The original call's settings with a prompt carrying only the validator errors and the rejected output."""
+        self.metrics.incr("llm_repairs")
+        candidates = self._evidence_candidates(evidence_source, extra=extra) if evidence_source else ""
+        prompt = _REPAIR_PROMPT.format(
+            errors="\n".join(f"- {e}" for e in errors),
+            hint=_REPAIR_HINT.format(candidates=candidates) if candidates else "",
+            previous=previous,
+        )
+        return {**request, "prompt": prompt, "temperature": 0.0, "cache_prefix": None}
+
+    def _repair_succeeded(self, request: Dict[str, Any], repair_request: Dict[str, Any]) -> None:
+        self.metrics.incr("llm_repairs_succeeded")
+        if _LAST_CALL_LIVE.get():
+            # Against re-running the whole original prompt.
+            saved = self._estimate_prompt_tokens(request) - self._estimate_prompt_tokens(repair_request)
+            self.metrics.incr("llm_repair_tokens_saved", max(0, saved))
+
+    @staticmethod
+    def _restore_last_llm_response(original: Tuple[Optional[str], bool]) -> None:
+        """Make the original (rejected) response the "last" one again, so the caller's discard evicts it."""
+        _LAST_CACHE_KEY.set(original[0])
+        _LAST_CALL_LIVE.set(original[1])
+
+    def _parse_with_repair(
+        self, job: "DocGenerator._LLMJob", parse: Callable[[str, "DocGenerator._LLMJob"], Any], raw: str
+    ) -> Any:
+        """parse(raw, job); when the output fails validation, send the error back for a corrected output."""
+        original = (_LAST_CACHE_KEY.get(), _LAST_CALL_LIVE.get())
+        repair_request: Optional[Dict[str, Any]] = None
+        for attempt in range(self.max_repairs + 1):
+            try:
+                result = parse(raw, job)
+            except (ValueError, self._JsonParseError) as e:
+                if repair_request is not None:
+                    # The repair output was rejected as well.
+                    self._discard_last_llm_response()
+                if attempt >= self.max_repairs:
+                    if repair_request is not None:
+                        self._restore_last_llm_response(original)
+                    raise
+                print(f"{job.label} 输出未通过校验: {e}，请求修正 ({attempt + 1}/{self.max_repairs})")
+                repair_request = self._repair_request(
+                    job.request, raw, error_list(e), evidence_source=job.evidence_source
+                )
+                try:
+                    raw = self._call_llm(**repair_request)
+                except Exception:
+                    self._restore_last_llm_response(original)
+                    raise
+                continue
+            if repair_request is not None:
+                self._repair_succeeded(job.request, repair_request)
+            return result
+
+    async def _aparse_with_repair(
+        self, job: "DocGenerator._LLMJob", parse: Callable[[str, "DocGenerator._LLMJob"], Any], raw: str
+    ) -> Any:
+        """Async counterpart of _parse_with_repair."""
+        original = (_LAST_CACHE_KEY.get(), _LAST_CALL_LIVE.get())
+        repair_request: Optional[Dict[str, Any]] = None
+        for attempt in range(self.max_repairs + 1):
+            try:
+                result = parse(raw, job)
+            except (ValueError, self._JsonParseError) as e:
+                if repair_request is not None:
+                    # The repair output was rejected as well.
+                    self._discard_last_llm_response()
+                if attempt >= self.max_repairs:
+                    if repair_request is not None:
+                        self._restore_last_llm_response(original)
+                    raise
+                print(f"{job.label} 输出未通过校验: {e}，请求修正 ({attempt + 1}/{self.max_repairs})")
+                repair_request = self._repair_request(
+                    job.request, raw, error_list(e), evidence_source=job.evidence_source
+                )
+                try:
+                    raw = await self._acall_llm(**repair_request)
+                except Exception:
+                    self._restore_last_llm_response(original)
+                    raise
+                continue
+            if repair_request is not None:
+                self._repair_succeeded(job.request, repair_request)
+            return result
+
+    def _validate_with_repair(
+        self,
+        request: Dict[str, Any],
+        obj: Any,
+        validate: Callable[[Any], Tuple[Any, List[str]]],
+        *,
+        evidence_source: str = "",
+        extra: Sequence[str] = (),
+    ) -> Tuple[Any, List[str]]:
+        """validate(obj) -> (normalized obj, errors); on errors, send all of them back for a corrected object.
+
+        Returns (obj, errors) for the last output checked.
+        """
+        original = (_LAST_CACHE_KEY.get(), _LAST_CALL_LIVE.get())
+        obj, errors = validate(obj)
+        repair_request: Optional[Dict[str, Any]] = None
+        for attempt in range(self.max_repairs):
+            if not errors:
+                break
+            print(f"  - 输出未通过校验: {'; '.join(errors)}，请求修正 ({attempt + 1}/{self.max_repairs})")
+            previous = json.dumps(obj, ensure_ascii=False, indent=2)
+            repair_request = self._repair_request(request, previous, errors, evidence_source=evidence_source, extra=extra)
+            try:
+                repaired = self._extract_json(self._call_llm(**repair_request))
+            except Exception as e:
+                self._handle_exception(e, "修正输出")
+                break
+            obj, errors = validate(repaired)
+            if errors:
+                self._discard_last_llm_response()
+        if repair_request is None:
+            return obj, errors
+        if errors:
+            self._restore_last_llm_response(original)
+        else:
+            self._repair_succeeded(request, repair_request)
+        return obj, errors
+
+    def run_async(self, main: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `main` on a fresh event loop and close the async HTTP pool bound to it."""
+
+        async def runner() -> Any:
+            try:
+                return await main()
+            finally:
+                await aclose_http_pool()
+
+        return asyncio.run(runner())
+
+    def run_concurrently(self, jobs: List[Callable[[], Awaitable[Any]]], *, limit: int) -> List[Any]:
+        """Run async job factories on one event loop with at most `limit` in flight; results keep input order."""
+        if not jobs:
+            return []
+
+        async def runner() -> List[Any]:
+            semaphore = asyncio.Semaphore(max(1, int(limit)))
+
+            async def run_one(job: Callable[[], Awaitable[Any]]) -> Any:
+                async with semaphore:
+                    return await job()
+
+            return await asyncio.gather(*(run_one(job) for job in jobs))
+
+        return self.run_async(runner)
+
+    def _parse_job_output(
+        self, job: "DocGenerator._LLMJob", parse: Callable[[str, "DocGenerator._LLMJob"], Any], raw: str
+    ) -> Any:
+        try:
+            return self._parse_with_repair(job, parse, raw)
+        except Exception as e:
+            self._handle_exception(e, job.label)
+            return None
+
+    def _run_batch(
+        self,
+        jobs: List["DocGenerator._LLMJob"],
+        parse: Callable[[str, "DocGenerator._LLMJob"], Any],
+        *,
+        fallback_limit: int,
+    ) -> List[Any]:
+        """Run jobs as one provider batch; cache hits skip the batch and failed items fall back to direct calls."""
+        if not jobs:
+            return []
+        results: List[Any] = [None] * len(jobs)
+        pending: Dict[str, Tuple[int, Optional[str]]] = {}
+        lines: List[Dict[str, Any]] = []
+        # One batch goes to one endpoint (and OpenAI batches take one model): the jobs' task route decides both.
+        endpoint = self.endpoints.get(self._task_route(jobs[0].request.get("task") or "").endpoint)
+        try:
+            batchable = detect_api_style(endpoint.base_url, endpoint.api_style) == "openai"
+        except Exception:
+            batchable = False
+        for i, job in enumerate(jobs):
+            cache_key = self._cache_key(**job.request)
+            cached = self._cache_lookup(cache_key)
+            if cached is not None:
+                results[i] = self._parse_job_output(job, parse, cached)
+                continue
+            custom_id = f"job-{i}"
+            pending[custom_id] = (i, cache_key)
+            if batchable:
+                request = self._prepare_llm_request(**job.request, log=False, endpoint=endpoint)
+                lines.append(build_batch_line(custom_id, **request))
+
+        fallback: List[int] = [i for i, _ in pending.values()]
+        if fallback and not batchable:
+            print("批处理模式仅支持 OpenAI 兼容端点，改为直接并发请求。")
+        elif lines:
+            fallback = self._submit_batch(jobs, parse, results, pending, lines, endpoint=endpoint)
+
+        if fallback:
+            print(f"以直接调用方式处理 {len(fallback)} 个请求...")
+            retried = self.run_concurrently(
+                [functools.partial(self._arun_job, jobs[i], parse) for i in fallback], limit=fallback_limit
+            )
+            for i, value in zip(fallback, retried):
+                results[i] = value
+        return results
+
+    def _submit_batch(
+        self,
+        jobs: List["DocGenerator._LLMJob"],
+        parse: Callable[[str, "DocGenerator._LLMJob"], Any],
+        results: List[Any],
+        pending: Dict[str, Tuple[int, Optional[str]]],
+        lines: List[Dict[str, Any]],
+        *,
+        endpoint: Endpoint,
+    ) -> List[int]:
+        """Submit `lines` as one batch and fill `results`; return the job indices that still need a direct call."""
+        print(f"提交批处理任务: {len(lines)} 个请求")
+        last_status = [""]
+
+        def on_status(batch: Dict[str, Any]) -> None:
+            counts = batch.get("request_counts") or {}
+            status = f"{batch.get('status')} {counts.get('completed', 0)}/{counts.get('total', len(lines))}"
+            if status != last_status[0]:
+                last_status[0] = status
+                print(f"  - 批处理状态: {status}")
+
+        runner = OpenAIBatchRunner(
+            api_key=endpoint.api_key,
+            base_url=endpoint.base_url,
+            poll_interval=self._get_float_env("LLM_BATCH_POLL_SECONDS", 30.0),
+            max_wait_seconds=self._get_float_env("LLM_BATCH_MAX_WAIT_HOURS", 5.0) * 3600,
+            on_status=on_status,
+        )
+        try:
+            batch_results = runner.run(lines, metadata={"repo": config.REPO_NAME or ""})
+        except Exception as e:
+            print(f"批处理任务失败，回退为直接调用: {self._mask_sensitive(str(e))}")
+            self.metrics.incr("llm_batch_failures")
+            return [i for i, _ in pending.values()]
+        finally:
+            runner.close()
+
+        self.metrics.incr("llm_batch_requests", len(lines))
+        fallback: List[int] = []
+        for custom_id, (i, cache_key) in pending.items():
+            item = batch_results.get(custom_id)
+            if item is None or item.response is None:
+                print(f"{jobs[i].label} 批处理未返回结果: {item.error if item else 'missing'}")
+                fallback.append(i)
+                continue
+            response = item.response
+            if response.truncated:
+                self.metrics.incr("llm_truncated_outputs")
+                print(f"  - 警告: {jobs[i].label} 输出达到 max_tokens 上限被截断。")
+                if self.max_continuations:
+                    response = self._continue_truncated(dict(jobs[i].request), response)
+            self._observe_output_size(jobs[i].request, response)
+            if response.usage.get("completion_tokens"):
+                self.metrics.observe("llm_batch_completion_tokens", response.usage["completion_tokens"])
+            self._observe_usage(response.usage)
+            self._cache_store(cache_key, response)
+            _LAST_CALL_LIVE.set(True)
+            results[i] = self._parse_job_output(jobs[i], parse, response.text)
+        self.metrics.incr("llm_batch_fallbacks", len(fallback))
+        return fallback
+
+    @dataclass
+    class _JsonParseError(Exception):
+        message: str
+        raw_preview: str = ""
+
+        def __str__(self) -> str:  # pragma: no cover
+            if self.raw_preview:
+                return f"{self.message} | preview={self.raw_preview}"
+            return self.message
+
+    def _try_parse_json(self, s: str) -> Any:
+        """Decode the first JSON object/array in `s`, tolerating common LLM slips (see json_scan)."""
+        try:
+            return scan_json(s or "")
+        except JsonScanError as e:
+            preview = (s or "").strip()[:300].replace("\n", "\\n")
+            raise self._JsonParseError(f"Failed to parse JSON from model output: {e}", raw_preview=preview)
+
+    def _extract_json(self, text: str) -> Any:
+        if not isinstance(text, str):
+            raise self._JsonParseError("Model output is not a string", raw_preview=str(type(text)))
+        self.metrics.incr("llm_json_outputs")
+
+        # Structured output (json_schema / JSON mode) yields strict JSON; don't let the sanitizer touch it.
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+
+        try:
+            # Prefer explicit json code fence, but still parse robustly.
+            fence = re.search(r"```json\s*(.*?)\s*```", text, re.DOTALL | re.IGNORECASE)
+            # Otherwise parse from the first JSON value in the response.
+            obj = self._try_parse_json(fence.group(1) if fence else text)
+        except self._JsonParseError:
+            self.metrics.incr("llm_json_parse_failures")
+            raise
+        self.metrics.incr("llm_json_repaired")
+        return obj
 
     def _extract_changed_paths(self, diff: str) -> List[str]:
         paths: List[str] = []
@@ -766,7 +2292,7 @@ Commit Message:
 {commit_message}
 
 Diff Snippet:
-{diff[:2000]}
+{self.tokens.truncate(diff, 700)}
 
 规则：
 1. 仅当变更影响对外契约（如对外 API、事件/消息模型、配置 schema、插件/适配器接口、兼容性与对外行为）时，才需要更新文档。
@@ -780,6 +2306,7 @@ Diff Snippet:
                 system_instruction=system_instruction,
                 temperature=0,
                 max_tokens=min(64, self._get_max_tokens("", 10)),
+                task="gate",
             ).strip().upper()
             return "YES" in result
         except Exception as e:
@@ -788,10 +2315,12 @@ Diff Snippet:
 
     def _preprocess_diff(self, diff: str) -> str:
         line_count = diff.count("\n")
-        if line_count < 500:
+        diff_tokens = self.tokens.count(diff)
+        max_input_tokens = resolve_token_budget("LLM_DIFF_SUMMARY_INPUT_TOKENS", "", 10000)
+        if line_count < 500 and diff_tokens <= max_input_tokens:
             return diff
 
-        print(f"检测到变更量较大 ({line_count} 行)。正在生成技术摘要以供 AI 分析...")
+        print(f"检测到变更量较大 ({line_count} 行，约 {diff_tokens} tokens)。正在生成技术摘要以供 AI 分析...")
         system_instruction = "你是一个专业的技术摘要生成器，擅长将冗长的代码 Diff 转换为紧凑的技术摘要。"
         summary_prompt = f"""
 	你是一个资深系统架构师。以下是一个巨大的代码变更 Diff。
@@ -803,7 +2332,7 @@ Diff Snippet:
 3. 剔除样板代码、简单导入变化、纯格式调整。
 
 	--- Diff ---
-	{diff[:30000]}
+	{self.tokens.truncate(diff, max_input_tokens)}
 	"""
         try:
             summary = self._call_llm(
@@ -811,99 +2340,21 @@ Diff Snippet:
                 system_instruction=system_instruction,
                 temperature=self._get_temperature(),
                 max_tokens=self._get_max_tokens("LLM_DIFF_SUMMARY_MAX_TOKENS", 8192),
+                task="diff_summary",
             )
             return f"[Large Diff Summary]\n{summary}\n\n[Note: Original diff was {line_count} lines and was summarized.]"
         except Exception as e:
             self._handle_exception(e, "summarizing diff")
-            return diff[:10000]
-
-    def _validate_change(self, change: Dict, processed_diff: str, commit_message: str) -> Optional[str]:
-        action = (change.get("action") or "").strip().lower()
-        if action not in {"create", "update", "noop"}:
-            return "action must be one of: create/update/noop"
-
-        if action == "noop":
-            return None
-
-        file_name = (change.get("file_name") or "").strip()
-        if not file_name.endswith(".md"):
-            return "file_name must end with .md"
-        if action == "create" and file_name == "index.md":
-            return "file_name must not be index.md for create"
-        if any(x in file_name for x in ["/", "\\", ".."]):
-            return "file_name must be a plain filename (no path)"
-
-        target_category = self._normalize_category_path(change.get("target_category") or "")
-        if action == "create":
-            if not target_category:
-                return "target_category is required"
-            if not self._is_safe_category_path(target_category):
-                return "target_category must be a safe relative path under docs root (e.g. plugin_system/api)"
-
-        content = change.get("content")
-        if not isinstance(content, str) or not content.strip():
-            return "content must be a non-empty string"
-        if not content.lstrip().startswith("---"):
-            return "content must start with YAML frontmatter ('---')"
-
-        evidence = change.get("evidence")
-        if not isinstance(evidence, list) or len(evidence) < 2:
-            return "evidence must be a list with at least 2 items"
-
-        haystack = f"{commit_message}\n{processed_diff}"
-        matched = 0
-        for item in evidence:
-            if not isinstance(item, str):
-                continue
-            token = item.strip().strip("`")
-            if token and token in haystack:
-                matched += 1
-        if matched < 2:
-            return "evidence items must appear in commit message or diff"
+            return self.tokens.truncate(diff, 3000)
 
-        return None
-
-    def _validate_bootstrap_item(self, item: Dict, repo_context: str) -> Optional[str]:
-        file_name = (item.get("file_name") or "").strip()
-        if not file_name.endswith(".md"):
-            return "file_name must end with .md"
-        if file_name == "index.md":
-            return "file_name must not be index.md"
-        if any(x in file_name for x in ["/", "\\", ".."]):
-            return "file_name must be a plain filename (no path)"
-
-        target_category = self._normalize_category_path(item.get("target_category") or "")
-        if not target_category:
-            return "target_category is required"
-        if not self._is_safe_category_path(target_category):
-            return "target_category must be a safe relative path under docs root (e.g. plugin_system/api)"
-
-        content = item.get("content")
-        if not isinstance(content, str) or not content.strip():
-            return "content must be a non-empty string"
-        if not content.lstrip().startswith("---"):
-            return "content must start with YAML frontmatter ('---')"
-
-        required_sections = ("## 概述", "## 目录/结构", "## 适用范围", "## 变更影响分析")
-        for sec in required_sections:
-            if sec not in content:
-                return f"content must include section: {sec}"
-
-        evidence = item.get("evidence")
-        if not isinstance(evidence, list) or len(evidence) < 2:
-            return "evidence must be a list with at least 2 items"
-
-        matched = 0
-        for ev in evidence:
-            if not isinstance(ev, str):
-                continue
-            token = ev.strip().strip("`")
-            if token and token in repo_context:
-                matched += 1
-        if matched < 2:
-            return "evidence items must appear in provided repo context"
-
-        return None
+    def _validate_change(self, change: Any, processed_diff: str, commit_message: str) -> Tuple[Any, List[str]]:
+        """(normalized change, errors); the rules depend on the action, and a noop only needs a valid action."""
+        ctx = RuleContext(haystack=f"{commit_message}\n{processed_diff}", index=self.evidence_index)
+        change = self.output_rules["doc_update"].normalize(change, ctx)
+        action = change.get("action") if isinstance(change, dict) else None
+        rules = self.output_rules.get(f"doc_update:{action}") or self.output_rules["doc_update"]
+        change = rules.normalize(change, ctx)
+        return change, rules.errors(change, ctx)
 
     def generate_bootstrap_docs(self, repo_context: str) -> List[Dict]:
         """基于仓库结构与 README 的快照生成初始文档（用于首次建档/重建基线）。"""
@@ -913,7 +2364,7 @@ Diff Snippet:
         repo_name = config.REPO_NAME
         branch = config.UPSTREAM_BRANCH
 
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
         prompt = f"""
 你是一个高级软件工程师和技术文档专家。你的任务是为 `{repo_name}` 的 `{branch}` 分支生成**初始**开发文档（按模块分组，面向 AI/RAG）。
 
@@ -954,25 +2405,36 @@ Diff Snippet:
 
         created: List[Dict] = []
         try:
-            raw_response = self._call_llm(
-                prompt,
+            request: Dict[str, Any] = dict(
+                prompt=prompt,
                 system_instruction=system_instruction,
                 temperature=self._get_temperature(),
                 max_tokens=self._get_max_tokens("LLM_BOOTSTRAP_DOCS_MAX_TOKENS", 8192),
                 response_schema=self._schema_bootstrap_docs(),
                 response_schema_name="bootstrap_docs",
+                task="bootstrap_docs",
             )
+            raw_response = self._call_llm(**request)
             result = self._extract_json(raw_response)
-            items = result if isinstance(result, list) else [result]
-
-            for item in items:
-                if not isinstance(item, dict):
-                    continue
-                validation_error = self._validate_bootstrap_item(item, repo_context)
-                if validation_error:
-                    print(f"Bootstrap AI output validation failed: {validation_error}")
-                    continue
-
+            items = [it for it in (result if isinstance(result, list) else [result]) if isinstance(it, dict)]
+            rules = self.output_rules["bootstrap_doc"]
+            ctx = RuleContext(haystack=repo_context, index=self.evidence_index)
+            checked = rules.check_batch(items, ctx)
+            valid = [item for item, errors in checked if not errors]
+            rejected = [item for item, errors in checked if errors]
+            if rejected:
+                # All rejected items go back in one repair call, with every error of each item.
+                def validate(objs: Any) -> Tuple[Any, List[str]]:
+                    return objs, rules.batch_errors(objs, ctx)
+
+                repaired, _ = self._validate_with_repair(request, rejected, validate, evidence_source=repo_context)
+                for item, errors in rules.check_batch(repaired if isinstance(repaired, list) else [], ctx):
+                    if errors:
+                        print(f"Bootstrap AI output validation failed: {'; '.join(errors)}")
+                    else:
+                        valid.append(item)
+
+            for item in valid:
                 change = {
                     "action": "create",
                     "target_category": item.get("target_category") or self.default_category,
@@ -1051,20 +2513,31 @@ Diff Snippet:
   \"content\": \"---\\ntitle: ...\\n...\\n---\\n\\n## 概述\\n...\\n## 关键实现\\n...\\n## 变更影响分析\\n...\",\n  \"evidence\": [\"path/to/file.py\", \"ClassName.method\"],\n  \"reason\": \"\"\n}}
         """
         try:
-            raw_response = self._call_llm(
-                prompt,
+            request: Dict[str, Any] = dict(
+                prompt=prompt,
                 system_instruction=system_instruction,
                 temperature=self._get_temperature(),
                 response_schema=self._schema_doc_update(),
                 response_schema_name="doc_update",
+                task="doc_update",
             )
+            raw_response = self._call_llm(**request)
             result = self._extract_json(raw_response)
-            validation_error = self._validate_change(result, processed_diff, commit_message)
-            if validation_error:
-                if (result.get("action") or "").strip().lower() == "noop":
+            subject = (commit_message or "").strip().splitlines()[:1]
+            changed_paths = self._extract_changed_paths(processed_diff)
+            result, validation_errors = self._validate_with_repair(
+                request,
+                result,
+                lambda obj: self._validate_change(obj, processed_diff, commit_message),
+                evidence_source=f"{commit_message}\n{processed_diff}",
+                extra=[*changed_paths, *subject],
+            )
+            if validation_errors:
+                if isinstance(result, dict) and (result.get("action") or "").strip().lower() == "noop":
                     print(f"AI returned noop: {result.get('reason', '').strip()}")
                     return None
-                print(f"AI output validation failed: {validation_error}")
+                print(f"AI output validation failed: {'; '.join(validation_errors)}")
+                self._discard_last_llm_response()
                 return None
 
             if (result.get("action") or "").strip().lower() == "noop":
@@ -1162,7 +2635,7 @@ Diff Snippet:
         branch = config.UPSTREAM_BRANCH
         max_tokens = self._get_max_tokens("LLM_REPO_MAP_MAX_TOKENS", 8192)
 
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
         prompt = f"""
 你是一个资深软件架构师。请基于提供的“仓库信息（快照）”生成一个可复用的 RepoMap（用于后续逐目录分析与文档生成）。
 
@@ -1191,51 +2664,14 @@ Diff Snippet:
                 max_tokens=max_tokens,
                 response_schema=self._schema_repo_map(),
                 response_schema_name="repo_map",
+                task="repo_map",
             )
-            obj = self._extract_json(raw)
-            if not isinstance(obj, dict):
-                raise ValueError("repo_map must be a JSON object")
-
-            required_keys = [
-                "repo",
-                "branch",
-                "generated_at",
-                "summary",
-                "module_groups",
-                "public_surfaces",
-                "doc_group_suggestions",
-                "limitations",
-                "evidence",
-            ]
-            defaults: Dict[str, Any] = {
-                "repo": repo_name,
-                "branch": branch,
-                "generated_at": today,
-                "summary": "",
-                "module_groups": [],
-                "public_surfaces": [],
-                "doc_group_suggestions": [],
-                "limitations": "",
-                "evidence": [],
-            }
-            obj = self._coerce_object_keys(obj, required_keys, defaults=defaults)
-
-            obj["repo"] = (obj.get("repo") or repo_name).strip()
-            obj["branch"] = (obj.get("branch") or branch).strip()
-            obj["generated_at"] = (obj.get("generated_at") or today).strip()
-
-            evidence = obj.get("evidence")
-            if not isinstance(evidence, list) or len(evidence) < 5:
-                raise ValueError("repo_map.evidence must be a list with >= 5 items")
-
-            matched = 0
-            for ev in evidence:
-                if isinstance(ev, str) and ev.strip() and ev.strip() in repo_context:
-                    matched += 1
-            if matched < 3:
-                raise ValueError("repo_map.evidence must include at least 3 substrings present in repo_context")
-
-            return obj
+            ctx = RuleContext(
+                haystack=repo_context,
+                index=self.evidence_index,
+                defaults={"repo": repo_name, "branch": branch, "generated_at": today},
+            )
+            return self.output_rules["repo_map"].validate(self._extract_json(raw), ctx)
         except Exception as e:
             self._handle_exception(e, "RepoMap 生成")
             # Fall back to a minimal map (still valid JSON shape for later steps).
@@ -1251,7 +2687,44 @@ Diff Snippet:
                 "evidence": [],
             }
 
-    def analyze_directory_chunk(
+    def _extract_files_from_block(self, block: str) -> List[str]:
+        """Extract file list from the chunk header (avoid regex to keep it robust)."""
+        if not block:
+            return []
+        lines = (block or "").splitlines()
+        files: List[str] = []
+        in_list = False
+        for line in lines:
+            s = line.rstrip("\n")
+            if not in_list:
+                if s.strip() == "Files in this chunk:":
+                    in_list = True
+                continue
+            # Stop at the first blank line after the list.
+            if not s.strip():
+                break
+            if s.lstrip().startswith("- "):
+                p = s.strip()[2:].strip()
+                if p:
+                    files.append(p)
+        return sorted(set(files))
+
+    @staticmethod
+    def _repo_map_json(repo_map: Optional[Dict[str, Any]]) -> str:
+        return json.dumps(repo_map or {}, ensure_ascii=False, sort_keys=True)
+
+    def _shared_prompt_prefix(self, repo_map: Optional[Dict[str, Any]]) -> str:
+        """RepoMap block that opens every bootstrap prompt after stage 1.
+
+        It must stay byte-identical across calls (no per-call values, stable key order), so that provider prompt
+        caches can serve it: OpenAI caches the longest common prefix automatically, Gemini via cachedContents.
+        """
+        return (
+            f"以下是仓库 `{config.REPO_NAME}`@`{config.UPSTREAM_BRANCH}` 的 RepoMap（全局结构概览），供后续任务参考。\n\n"
+            f"--- RepoMap ---\n{self._repo_map_json(repo_map)}\n--- End RepoMap ---\n"
+        )
+
+    def _dir_analysis_job(
         self,
         *,
         repo_map: Dict[str, Any],
@@ -1259,170 +2732,256 @@ Diff Snippet:
         chunk_index: int,
         chunk_total: int,
         files_block: str,
-    ) -> Optional[Dict[str, Any]]:
-        """Stage 2: analyze one directory chunk (fixed schema)."""
+        files: Optional[List[str]] = None,
+    ) -> "DocGenerator._LLMJob":
+        """One stage-2 call; with `files` (per-file mode) it asks for one analysis per file of the chunk."""
         max_tokens = self._get_max_tokens("LLM_DIR_ANALYSIS_MAX_TOKENS", 8192)
-        repo_map_text = json.dumps(repo_map or {}, ensure_ascii=False)
-
-        def extract_files_from_block(block: str) -> List[str]:
-            """Extract file list from the chunk header (avoid regex to keep it robust)."""
-            if not block:
-                return []
-            lines = (block or "").splitlines()
-            files: List[str] = []
-            in_list = False
-            for line in lines:
-                s = line.rstrip("\n")
-                if not in_list:
-                    if s.strip() == "Files in this chunk:":
-                        in_list = True
-                    continue
-                # Stop at the first blank line after the list.
-                if not s.strip():
-                    break
-                if s.lstrip().startswith("- "):
-                    p = s.strip()[2:].strip()
-                    if p:
-                        files.append(p)
-            return sorted(set(files))
-
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
-        prompt = f"""
-	你是一个资深软件工程师。请基于以下上下文，对目录 `{dir_path}` 的这一个“分片”做结构化分析。
-
-	重要规则：
-	- 禁止编造：只能引用 files_block 中出现的内容（路径/符号/字面量）。
-	- 每个结论必须可追溯：evidence 至少 2 条，且必须是 files_block 中出现的原样子串（建议用文件路径/类名/函数名）。
-	- 严格输出纯 JSON：不要使用 ```json 代码块，不要输出任何解释文字。
-	- 控制输出体积：不要枚举大量文件/符号。除 `files` 外，所有数组最多保留 5 个元素。
-	- `files` 字段固定输出为空数组 `[]`（脚本会从 files_block 自动填充真实文件列表，避免输出过长导致截断）。
-
-	输出必须是 JSON 对象，且 key 必须严格等于下面列表（不得多、不得少）：
-	- dir: string
-	- chunk_index: number
-	- chunk_total: number
-- files: array[string]
-- summary: string
-- public_contracts: array[{{name, kind, defined_in, signature, notes}}]
-- key_components: array[{{name, defined_in, responsibility}}]
-- configs: array[{{name, defined_in, type, notes}}]
-- dependencies: array[string]
-- risks: array[string]
-- limitations: string
-- evidence: array[string]
 
---- RepoMap ---
-{repo_map_text}
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
+        # The per-file rules go after the cache prefix, so both modes share one provider prompt cache entry.
+        cache_prefix = self._shared_prompt_prefix(repo_map) + self._DIR_ANALYSIS_RULES
+        prompt = cache_prefix + (self._FILE_ANALYSIS_RULES if files is not None else "") + f"""
+--- 任务参数 ---
+dir: {dir_path}
+chunk: {chunk_index}/{chunk_total}
 
 --- files_block ---
 {files_block}
         """
-        try:
-            raw = self._call_llm(
-                prompt,
-                system_instruction=system_instruction,
-                temperature=self._get_temperature(),
-                max_tokens=max_tokens,
-                response_schema=self._schema_dir_analysis(),
-                response_schema_name="dir_analysis",
-            )
-            obj = self._extract_json(raw)
-            if isinstance(obj, list):
-                # Some models may wrap the object in a single-item array.
-                for it in obj:
-                    if isinstance(it, dict):
-                        obj = it
-                        break
-            if not isinstance(obj, dict):
-                raise ValueError("directory analysis must be a JSON object")
+        context: Dict[str, Any] = {
+            "dir_path": dir_path,
+            "chunk_index": chunk_index,
+            "chunk_total": chunk_total,
+            "files_block": files_block,
+        }
+        if files is not None:
+            context["files"] = list(files)
+        return self._LLMJob(
+            label=f"{'文件' if files is not None else '目录'}分析({dir_path}#{chunk_index}/{chunk_total})",
+            request={
+                "prompt": prompt,
+                "system_instruction": system_instruction,
+                "temperature": self._get_temperature(),
+                "max_tokens": max_tokens,
+                "response_schema": self._schema_file_analyses() if files is not None else self._schema_dir_analysis(),
+                "response_schema_name": "file_analyses" if files is not None else "dir_analysis",
+                "task": "dir_analysis",
+                "cache_prefix": cache_prefix,
+            },
+            context=context,
+            evidence_source=files_block,
+        )
 
-            required_keys = [
-                "dir",
-                "chunk_index",
-                "chunk_total",
-                "files",
-                "summary",
-                "public_contracts",
-                "key_components",
-                "configs",
-                "dependencies",
-                "risks",
-                "limitations",
-                "evidence",
-            ]
-            defaults: Dict[str, Any] = {
+    def _parse_dir_analysis(self, raw: str, job: "DocGenerator._LLMJob") -> Dict[str, Any]:
+        dir_path = job.context["dir_path"]
+        files_block = job.context["files_block"]
+
+        obj = self._extract_json(raw)
+        if isinstance(obj, list):
+            # Some models may wrap the object in a single-item array.
+            obj = next((it for it in obj if isinstance(it, dict)), obj)
+        block_files = self._extract_files_from_block(files_block)
+        ctx = RuleContext(
+            haystack=files_block,
+            index=self.evidence_index,
+            defaults={"files": block_files},
+            # Enforce fixed schema control fields.
+            pinned={
                 "dir": dir_path,
-                "chunk_index": int(chunk_index),
-                "chunk_total": int(chunk_total),
-                "files": [],
-                "summary": "",
-                "public_contracts": [],
-                "key_components": [],
-                "configs": [],
-                "dependencies": [],
-                "risks": [],
-                "limitations": "",
-                "evidence": [],
+                "chunk_index": int(job.context["chunk_index"]),
+                "chunk_total": int(job.context["chunk_total"]),
+            },
+            # Auto-fill evidence with file paths from the provided context to avoid dropping the analysis.
+            fallback_evidence=[*block_files[:5], f"Directory: {dir_path}"],
+        )
+        return self.output_rules["dir_analysis"].validate(obj, ctx)
+
+    def _parse_file_analyses(self, raw: str, job: "DocGenerator._LLMJob") -> Dict[str, Dict[str, Any]]:
+        """Per-file analyses of one packed chunk, by path; every file of the chunk must get one."""
+        dir_path = job.context["dir_path"]
+        files: List[str] = job.context["files"]
+        obj = self._extract_json(raw)
+        if isinstance(obj, dict):
+            # A wrapped array ({"analyses": [...]}) or a lone object.
+            obj = next((v for v in obj.values() if isinstance(v, list)), [obj])
+        items = [it for it in obj if isinstance(it, dict)] if isinstance(obj, list) else []
+
+        by_path: Dict[str, Dict[str, Any]] = {}
+        unnamed: List[Dict[str, Any]] = []
+        for item in items:
+            named = item.get("files")
+            named = [named] if isinstance(named, str) else named if isinstance(named, list) else []
+            path = next((str(p).strip() for p in named if str(p).strip() in files), "")
+            if path and path not in by_path:
+                by_path[path] = item
+            else:
+                unnamed.append(item)
+        # Objects that do not name their file are taken in files_block order.
+        for path in files:
+            if path not in by_path and unnamed:
+                by_path[path] = unnamed.pop(0)
+
+        out: Dict[str, Dict[str, Any]] = {}
+        errors: List[str] = []
+        for path in files:
+            if path not in by_path:
+                errors.append(f"missing the analysis object of file {path}")
+                continue
+            ctx = RuleContext(
+                haystack=job.context["files_block"],
+                index=self.evidence_index,
+                pinned={
+                    "dir": dir_path,
+                    "chunk_index": int(job.context["chunk_index"]),
+                    "chunk_total": int(job.context["chunk_total"]),
+                    "files": [path],
+                },
+                fallback_evidence=[path, f"File: {path}"],
+            )
+            try:
+                out[path] = self.output_rules["dir_analysis"].validate(by_path[path], ctx)
+            except ValueError as e:
+                errors.extend(f"[{path}] {err}" for err in error_list(e))
+        if errors:
+            raise RuleViolation(errors)
+        return out
+
+    def analyze_directory_chunk(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        dir_path: str,
+        chunk_index: int,
+        chunk_total: int,
+        files_block: str,
+    ) -> Optional[Dict[str, Any]]:
+        """Stage 2: analyze one directory chunk (fixed schema)."""
+        job = self._dir_analysis_job(
+            repo_map=repo_map,
+            dir_path=dir_path,
+            chunk_index=chunk_index,
+            chunk_total=chunk_total,
+            files_block=files_block,
+        )
+        return self._run_job(job, self._parse_dir_analysis)
+
+    async def aanalyze_directory_chunk(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        dir_path: str,
+        chunk_index: int,
+        chunk_total: int,
+        files_block: str,
+    ) -> Optional[Dict[str, Any]]:
+        """Async variant of analyze_directory_chunk; records its wall time, repairs included."""
+        job = self._dir_analysis_job(
+            repo_map=repo_map,
+            dir_path=dir_path,
+            chunk_index=chunk_index,
+            chunk_total=chunk_total,
+            files_block=files_block,
+        )
+        started = time.monotonic()
+        try:
+            return await self._arun_job(job, self._parse_dir_analysis)
+        finally:
+            self.metrics.observe(self._DIR_CHUNK_METRIC, time.monotonic() - started)
+
+    async def aanalyze_file_chunk(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        dir_path: str,
+        chunk_index: int,
+        chunk_total: int,
+        files_block: str,
+        files: List[str],
+    ) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Per-file mode: analyze every file of one packed chunk in one call; returns the analyses by path."""
+        job = self._dir_analysis_job(
+            repo_map=repo_map,
+            dir_path=dir_path,
+            chunk_index=chunk_index,
+            chunk_total=chunk_total,
+            files_block=files_block,
+            files=files,
+        )
+        started = time.monotonic()
+        try:
+            return await self._arun_job(job, self._parse_file_analyses)
+        finally:
+            self.metrics.observe(self._DIR_CHUNK_METRIC, time.monotonic() - started)
+
+    def analysis_cache_key(self, *, unit: str, path: str, content_key: str, max_context_tokens: int) -> Optional[str]:
+        """Store key of the stage-2 analyses of one directory or one file (`unit`); None when there is nothing to key.
+
+        The RepoMap in the prompt is deliberately not part of the key: it differs on every run (and per branch), while
+        the analysis of unchanged files does not depend on it in any way that matters for the docs.
+        """
+        if self.dir_analysis_cache is None or not content_key:
+            return None
+        version = self._dir_analysis_versions.get(unit)
+        if version is None:
+            # Only branch-independent inputs: the shared prefix names the repo/branch and embeds the RepoMap, so
+            # including it would keep main and dev from ever sharing an entry.
+            inputs = {
+                "prompt_version": self._DIR_ANALYSIS_PROMPT_VERSION,
+                "rules": self._DIR_ANALYSIS_RULES,
+                "system_instruction": self._JSON_ONLY_SYSTEM_INSTRUCTION,
+                "schema": self._schema_dir_analysis(),
+                "model": self._task_model("dir_analysis"),
+            }
+            if unit == "file":
+                inputs.update(file_rules=self._FILE_ANALYSIS_RULES, schema=self._schema_file_analyses())
+            version = self._dir_analysis_versions[unit] = ResponseCache.make_key(inputs)
+        return ResponseCache.make_key(
+            {
+                "unit": unit,
+                "path": path,
+                "content": content_key,
+                "version": version,
+                "max_context_tokens": int(max_context_tokens),
             }
-            obj = self._coerce_object_keys(obj, required_keys, defaults=defaults)
+        )
 
-            # Enforce fixed schema control fields.
-            obj["dir"] = dir_path
-            obj["chunk_index"] = int(chunk_index)
-            obj["chunk_total"] = int(chunk_total)
-
-            files = obj.get("files")
-            if isinstance(files, str) and files.strip():
-                files = [files.strip()]
-                obj["files"] = files
-            if not isinstance(files, list):
-                obj["files"] = []
-                files = obj["files"]
-            if not files:
-                obj["files"] = extract_files_from_block(files_block)
-                files = obj["files"]
-            if files and not all(isinstance(x, str) and x.strip() for x in files):
-                raise ValueError("analysis.files must be a list of strings")
-
-            for key in ("public_contracts", "key_components", "configs"):
-                if not isinstance(obj.get(key), list):
-                    obj[key] = []
-
-            for key in ("dependencies", "risks", "evidence"):
-                if isinstance(obj.get(key), str) and obj.get(key).strip():
-                    obj[key] = [obj.get(key).strip()]
-                if not isinstance(obj.get(key), list):
-                    obj[key] = []
-
-            evidence = obj.get("evidence")
-            if not isinstance(evidence, list):
-                evidence = []
-                obj["evidence"] = evidence
-
-            normalized_evidence: List[str] = []
-            for ev in evidence:
-                if not isinstance(ev, str):
-                    continue
-                token = ev.strip().strip("`")
-                if token and token in files_block:
-                    normalized_evidence.append(token)
-            normalized_evidence = sorted(set(normalized_evidence))
-            if len(normalized_evidence) < 2:
-                # Auto-fill evidence with file paths from the provided context to avoid dropping the analysis.
-                fallback = extract_files_from_block(files_block)[:5]
-                header_token = f"Directory: {dir_path}"
-                if header_token in (files_block or ""):
-                    fallback.append(header_token)
-                normalized_evidence = fallback[:2] if len(fallback) >= 2 else fallback
-            if len(normalized_evidence) < 2:
-                raise ValueError("analysis.evidence must include >= 2 substrings present in files_block")
-
-            obj["evidence"] = normalized_evidence[:10]
-
-            return obj
-        except Exception as e:
-            self._handle_exception(e, f"目录分析({dir_path}#{chunk_index}/{chunk_total})")
+    def cached_analyses(self, key: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+        if self.dir_analysis_cache is None or not key:
             return None
+        entry = self.dir_analysis_cache.get(key)
+        analyses = (entry or {}).get("analyses")
+        return analyses if isinstance(analyses, list) and analyses else None
+
+    def store_analyses(self, key: Optional[str], analyses: List[Optional[Dict[str, Any]]]) -> None:
+        """Keep the analyses of a unit once every chunk succeeded (a partial result would hide the failed chunks)."""
+        if self.dir_analysis_cache is None or not key or not analyses or not all(analyses):
+            return
+        try:
+            self.dir_analysis_cache.put(key, {"analyses": analyses})
+        except OSError as e:
+            print(f"警告: 写入目录分析缓存失败: {e}")
+
+    def dir_analysis_overhead_tokens(self, *, repo_map: Dict[str, Any], dir_path: str, per_file: bool = False) -> int:
+        """Estimated tokens of a stage-2 prompt before any files_block content is added."""
+        job = self._dir_analysis_job(
+            repo_map=repo_map,
+            dir_path=dir_path,
+            chunk_index=1,
+            chunk_total=1,
+            files_block="",
+            files=[] if per_file else None,
+        )
+        return self._estimate_prompt_tokens(job.request)
+
+    def analyze_directory_chunks_batch(
+        self, *, repo_map: Dict[str, Any], chunks: List[Dict[str, Any]], fallback_limit: int
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Batch variant of analyze_directory_chunk / aanalyze_file_chunk (chunks with `files`); `chunks` hold their
+        keyword arguments, results keep their order."""
+        jobs = [self._dir_analysis_job(repo_map=repo_map, **chunk) for chunk in chunks]
+        if chunks and "files" in chunks[0]:
+            return self._run_batch(jobs, self._parse_file_analyses, fallback_limit=fallback_limit)
+        return self._run_batch(jobs, self._parse_dir_analysis, fallback_limit=fallback_limit)
 
     def generate_bootstrap_doc_plan(
         self,
@@ -1433,11 +2992,12 @@ Diff Snippet:
     ) -> List[Dict[str, Any]]:
         """Stage 3a: generate a doc plan from directory briefs."""
         max_tokens = self._get_max_tokens("LLM_DOC_PLAN_MAX_TOKENS", 8192)
-        repo_map_text = json.dumps(repo_map or {}, ensure_ascii=False)
+        repo_map_text = self._repo_map_json(repo_map)
         dir_briefs_text = json.dumps(dir_briefs or [], ensure_ascii=False)
 
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
-        prompt = f"""
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
+        cache_prefix = self._shared_prompt_prefix(repo_map)
+        prompt = cache_prefix + f"""
 你是一个技术文档信息架构师。请基于 RepoMap 与逐目录摘要，为 `{config.REPO_NAME}`@`{config.UPSTREAM_BRANCH}` 生成“初始文档规划”（模块化分组，多入口）。
 
 要求：
@@ -1453,9 +3013,6 @@ Diff Snippet:
 - reason: string
 - evidence: array[string]
 
---- RepoMap ---
-{repo_map_text}
-
 --- dir_briefs ---
 {dir_briefs_text}
         """
@@ -1467,86 +3024,30 @@ Diff Snippet:
                 max_tokens=max_tokens,
                 response_schema=self._schema_bootstrap_doc_plan(),
                 response_schema_name="doc_plan",
+                cache_prefix=cache_prefix,
+                task="doc_plan",
             )
             data = self._extract_json(raw)
             items = data if isinstance(data, list) else [data]
             plan: List[Dict[str, Any]] = []
             dir_set = {str(d.get("dir")).strip() for d in (dir_briefs or []) if isinstance(d, dict) and d.get("dir")}
-            haystack = f"{repo_map_text}\n{dir_briefs_text}"
-            required_item_keys = ["target_category", "file_name", "title", "source_dirs", "reason", "evidence"]
-
-            for item in items:
-                if not isinstance(item, dict):
-                    continue
-                item = self._coerce_object_keys(
-                    item,
-                    required_item_keys,
-                    defaults={
-                        "target_category": "",
-                        "file_name": "",
-                        "title": "",
-                        "source_dirs": [],
-                        "reason": "",
-                        "evidence": [],
-                    },
-                )
-
-                target_category = self._normalize_category_path(item.get("target_category") or "")
-                file_name = (item.get("file_name") or "").strip()
-                if not self._is_safe_category_path(target_category):
-                    continue
-                if not file_name.endswith(".md") or any(x in file_name for x in ["/", "\\", ".."]):
-                    continue
-
-                source_dirs = item.get("source_dirs")
-                if not isinstance(source_dirs, list) or not source_dirs:
-                    continue
-                if not all(isinstance(d, str) and d.strip() for d in source_dirs):
-                    continue
-                if any(d.strip() not in dir_set for d in source_dirs):
-                    continue
-
-                evidence = item.get("evidence")
-                if not isinstance(evidence, list):
-                    evidence = []
-                normalized_evidence: List[str] = []
-                for ev in evidence:
-                    if not isinstance(ev, str):
-                        continue
-                    token = ev.strip().strip("`")
-                    if token:
-                        normalized_evidence.append(token)
-                normalized_evidence = sorted(set(normalized_evidence))
-
-                matched = 0
-                for ev in normalized_evidence:
-                    if ev in haystack:
-                        matched += 1
-                if matched < 2:
-                    # Auto-fill evidence with safe tokens that are guaranteed to exist in haystack.
-                    fallback: List[str] = []
-                    if source_dirs:
-                        fallback.append(source_dirs[0].strip())
-                    if source_dirs and source_dirs[-1].strip() != (source_dirs[0].strip() if source_dirs else ""):
-                        fallback.append(source_dirs[-1].strip())
-                    if repo_map.get("repo"):
-                        fallback.append(str(repo_map.get("repo")).strip())
-                    fallback = [x for x in fallback if x and x in haystack]
-                    normalized_evidence = fallback[:2]
-                if len(normalized_evidence) < 2:
+            repo_name = str(repo_map.get("repo") or "").strip()
+
+            def fallback_evidence(item: Dict[str, Any]) -> List[str]:
+                # Auto-fill evidence with safe tokens that are guaranteed to exist in haystack.
+                source_dirs = item.get("source_dirs") or []
+                return [*source_dirs[:1], *source_dirs[-1:], repo_name]
+
+            ctx = RuleContext(
+                haystack=f"{repo_map_text}\n{dir_briefs_text}",
+                index=self.evidence_index,
+                choices={"source_dirs": dir_set},
+                fallback_evidence=fallback_evidence,
+            )
+            for item, errors in self.output_rules["doc_plan"].check_batch(items, ctx):
+                if errors:
                     continue
-
-                plan.append(
-                    {
-                        "target_category": target_category,
-                        "file_name": file_name,
-                        "title": (item.get("title") or "").strip(),
-                        "source_dirs": [d.strip() for d in source_dirs],
-                        "reason": (item.get("reason") or "").strip(),
-                        "evidence": normalized_evidence,
-                    }
-                )
-
+                plan.append({**item, "title": item["title"].strip(), "reason": item["reason"].strip()})
                 if len(plan) >= int(max_pages):
                     break
 
@@ -1555,14 +3056,13 @@ Diff Snippet:
             self._handle_exception(e, "文档规划生成")
             return []
 
-    def generate_bootstrap_doc_page(
+    def _doc_page_job(
         self,
         *,
         repo_map: Dict[str, Any],
         dir_summaries: List[Dict[str, Any]],
         spec: Dict[str, Any],
-    ) -> Optional[Dict[str, Any]]:
-        """Stage 3b: generate one markdown page from a plan spec."""
+    ) -> Optional["DocGenerator._LLMJob"]:
         max_tokens = self._get_max_tokens("LLM_DOC_PAGE_MAX_TOKENS", 8192)
         today = datetime.now().strftime("%Y-%m-%d")
 
@@ -1572,7 +3072,7 @@ Diff Snippet:
         if not source_dirs:
             return None
 
-        repo_map_text = json.dumps(repo_map or {}, ensure_ascii=False)
+        repo_map_text = self._repo_map_json(repo_map)
 
         selected = [
             s
@@ -1582,8 +3082,8 @@ Diff Snippet:
         selected_text = json.dumps(selected, ensure_ascii=False)
         evidence_haystack = f"{repo_map_text}\n{selected_text}"
 
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
-        prompt = f"""
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
+        cache_prefix = self._shared_prompt_prefix(repo_map) + f"""
 你是一个高级软件工程师和技术文档专家。请根据 RepoMap + 目录分析结果，为当前 spec 生成一篇可发布的 Markdown 文档。
 
 约束：
@@ -1598,97 +3098,75 @@ Diff Snippet:
 - content
 - evidence
 - reason
-
+"""
+        prompt = cache_prefix + f"""
 --- spec ---
 {json.dumps(spec, ensure_ascii=False)}
 
---- RepoMap ---
-{repo_map_text}
-
 --- Directory analyses (selected) ---
 {selected_text}
         """
-        try:
-            raw = self._call_llm(
-                prompt,
-                system_instruction=system_instruction,
-                temperature=self._get_temperature(),
-                max_tokens=max_tokens,
-                response_schema=self._schema_doc_page(),
-                response_schema_name="doc_page",
-            )
-            obj = self._extract_json(raw)
-            if not isinstance(obj, dict):
-                raise ValueError("doc page must be a JSON object")
-            obj = self._coerce_object_keys(
-                obj,
-                ["target_category", "file_name", "content", "evidence", "reason"],
-                defaults={
-                    "target_category": target_category,
-                    "file_name": file_name,
-                    "content": "",
-                    "evidence": [],
-                    "reason": "",
-                },
-            )
+        return self._LLMJob(
+            label=f"文档生成({target_category}/{file_name})",
+            request={
+                "prompt": prompt,
+                "system_instruction": system_instruction,
+                "temperature": self._get_temperature(),
+                "max_tokens": max_tokens,
+                "response_schema": self._schema_doc_page(),
+                "response_schema_name": "doc_page",
+                "task": "doc_page",
+                "cache_prefix": cache_prefix,
+            },
+            context={
+                "repo_map": repo_map,
+                "target_category": target_category,
+                "file_name": file_name,
+                "source_dirs": source_dirs,
+                "evidence_haystack": evidence_haystack,
+            },
+            evidence_source=evidence_haystack,
+        )
 
-            out_category = self._normalize_category_path(obj.get("target_category") or target_category)
-            out_file_name = (obj.get("file_name") or file_name).strip()
-            content = obj.get("content") or ""
-            evidence = obj.get("evidence")
-
-            if not self._is_safe_category_path(out_category):
-                raise ValueError("unsafe target_category")
-            if not out_file_name.endswith(".md") or any(x in out_file_name for x in ["/", "\\", ".."]):
-                raise ValueError("invalid file_name")
-            if not isinstance(content, str) or not content.strip():
-                raise ValueError("content must be non-empty")
-            if not content.lstrip().startswith("---"):
-                raise ValueError("content must start with frontmatter")
-            for sec in ("## 概述", "## 目录/结构", "## 适用范围", "## 变更影响分析", "## 证据"):
-                if sec not in content:
-                    raise ValueError(f"missing section: {sec}")
-
-            if not isinstance(evidence, list):
-                evidence = []
-            normalized_evidence: List[str] = []
-            for ev in evidence:
-                if not isinstance(ev, str):
-                    continue
-                token = ev.strip().strip("`")
-                if token:
-                    normalized_evidence.append(token)
-            normalized_evidence = sorted(set(normalized_evidence))
-
-            matched = 0
-            for ev in normalized_evidence:
-                if ev in evidence_haystack:
-                    matched += 1
-            if matched < 2:
-                fallback: List[str] = []
-                if source_dirs:
-                    fallback.append(source_dirs[0])
-                if source_dirs and source_dirs[-1] != source_dirs[0]:
-                    fallback.append(source_dirs[-1])
-                if repo_map.get("repo"):
-                    fallback.append(str(repo_map.get("repo")).strip())
-                fallback = [x for x in fallback if x and x in evidence_haystack]
-                normalized_evidence = fallback[:2]
-            if len(normalized_evidence) < 2:
-                raise ValueError("evidence must include >= 2 substrings present in provided context")
+    def _parse_doc_page(self, raw: str, job: "DocGenerator._LLMJob") -> Dict[str, Any]:
+        repo_map = job.context["repo_map"]
+        source_dirs = job.context["source_dirs"]
+        ctx = RuleContext(
+            haystack=job.context["evidence_haystack"],
+            index=self.evidence_index,
+            defaults={"target_category": job.context["target_category"], "file_name": job.context["file_name"]},
+            fallback_evidence=[*source_dirs[:1], *source_dirs[-1:], str(repo_map.get("repo") or "").strip()],
+        )
+        obj = self.output_rules["doc_page"].validate(self._extract_json(raw), ctx)
+        return {**obj, "reason": obj["reason"].strip()}
 
-            return {
-                "target_category": out_category,
-                "file_name": out_file_name,
-                "content": content,
-                "evidence": normalized_evidence,
-                "reason": (obj.get("reason") or "").strip(),
-            }
-        except Exception as e:
-            self._handle_exception(e, f"文档生成({target_category}/{file_name})")
+    def generate_bootstrap_doc_page(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        dir_summaries: List[Dict[str, Any]],
+        spec: Dict[str, Any],
+    ) -> Optional[Dict[str, Any]]:
+        """Stage 3b: generate one markdown page from a plan spec."""
+        job = self._doc_page_job(repo_map=repo_map, dir_summaries=dir_summaries, spec=spec)
+        if job is None:
             return None
+        return self._run_job(job, self._parse_doc_page)
 
-    def generate_plugin_api_doc_page(
+    async def agenerate_bootstrap_doc_page(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        dir_summaries: List[Dict[str, Any]],
+        spec: Dict[str, Any],
+    ) -> Optional[Dict[str, Any]]:
+        """Async variant of generate_bootstrap_doc_page."""
+        job = self._doc_page_job(repo_map=repo_map, dir_summaries=dir_summaries, spec=spec)
+        if job is None:
+            return None
+        return await self._arun_job(job, self._parse_doc_page)
+
+    def _api_page_job(
         self,
         *,
         repo_map: Dict[str, Any],
@@ -1696,21 +3174,19 @@ Diff Snippet:
         module_text: str,
         target_category: str,
         file_name: str,
-    ) -> Optional[Dict[str, Any]]:
-        """Stage 4: generate one plugin API page from a single source module."""
+    ) -> "DocGenerator._LLMJob":
         max_tokens = self._get_max_tokens("LLM_API_PAGE_MAX_TOKENS", 8192)
         today = datetime.now().strftime("%Y-%m-%d")
-        repo_map_text = json.dumps(repo_map or {}, ensure_ascii=False)
 
-        system_instruction = "你是一个只输出 JSON 的文档助手。禁止编造，不得输出非 JSON 内容。"
-        prompt = f"""
+        system_instruction = self._JSON_ONLY_SYSTEM_INSTRUCTION
+        cache_prefix = self._shared_prompt_prefix(repo_map) + f"""
 你是一个插件开发文档维护助手。请基于 RepoMap + 单文件源码，为插件系统 API 生成一篇 Markdown 文档。
 
 约束：
 - 禁止编造：只允许描述源码中可直接佐证的符号、签名与行为。
 - 必须包含 YAML frontmatter，且必须包含 last_updated: {today}
 - 必须包含章节：## 概述 / ## API 列表 / ## 调用约定 / ## 变更影响分析 / ## 证据
-- evidence 至少 2 条，且必须出现在源码片段中（建议用 `{module_path}` 或函数/类名）
+- evidence 至少 2 条，且必须出现在源码片段中（建议用源码路径或函数/类名）
 
 输出必须是 JSON 对象，且 key 必须严格等于下面列表（不得多、不得少）：
 - target_category
@@ -1718,97 +3194,96 @@ Diff Snippet:
 - content
 - evidence
 - reason
-
+"""
+        prompt = cache_prefix + f"""
 目标输出路径（固定）：
 - target_category: {target_category}
 - file_name: {file_name}
 
---- RepoMap ---
-{repo_map_text}
-
 --- Source: {module_path} ---
 ```python
 {module_text}
 ```
         """
-        try:
-            raw = self._call_llm(
-                prompt,
-                system_instruction=system_instruction,
-                temperature=self._get_temperature(),
-                max_tokens=max_tokens,
-                response_schema=self._schema_doc_page(),
-                response_schema_name="api_page",
-            )
-            obj = self._extract_json(raw)
-            if not isinstance(obj, dict):
-                raise ValueError("api page must be a JSON object")
-            obj = self._coerce_object_keys(
-                obj,
-                ["target_category", "file_name", "content", "evidence", "reason"],
-                defaults={
-                    "target_category": target_category,
-                    "file_name": file_name,
-                    "content": "",
-                    "evidence": [],
-                    "reason": "",
-                },
-            )
+        return self._LLMJob(
+            label=f"API 文档生成({module_path})",
+            request={
+                "prompt": prompt,
+                "system_instruction": system_instruction,
+                "temperature": self._get_temperature(),
+                "max_tokens": max_tokens,
+                "response_schema": self._schema_doc_page(),
+                "response_schema_name": "api_page",
+                "task": "api_page",
+                "cache_prefix": cache_prefix,
+            },
+            context={
+                "module_path": module_path,
+                "module_text": module_text,
+                "target_category": target_category,
+                "file_name": file_name,
+            },
+            evidence_source=f"{module_path}\n{module_text}",
+        )
 
-            out_category = self._normalize_category_path(obj.get("target_category") or target_category)
-            out_file_name = (obj.get("file_name") or file_name).strip()
-            content = obj.get("content") or ""
-            evidence = obj.get("evidence") or []
-
-            if out_category != self._normalize_category_path(target_category):
-                raise ValueError("api page target_category mismatch")
-            if out_file_name != file_name:
-                raise ValueError("api page file_name mismatch")
-            if not self._is_safe_category_path(out_category):
-                raise ValueError("unsafe target_category")
-            if not isinstance(content, str) or not content.strip() or not content.lstrip().startswith("---"):
-                raise ValueError("invalid content")
-            for sec in ("## 概述", "## API 列表", "## 调用约定", "## 变更影响分析", "## 证据"):
-                if sec not in content:
-                    raise ValueError(f"missing section: {sec}")
-
-            if not isinstance(evidence, list):
-                evidence = []
-            normalized_evidence: List[str] = []
-            for ev in evidence:
-                if not isinstance(ev, str):
-                    continue
-                token = ev.strip().strip("`")
-                if token:
-                    normalized_evidence.append(token)
-            normalized_evidence = sorted(set(normalized_evidence))
-
-            haystack = f"{module_path}\n{module_text}"
-            matched = 0
-            for ev in normalized_evidence:
-                if ev in haystack:
-                    matched += 1
-            if matched < 2:
-                sig = ""
-                for line in (module_text or "").splitlines():
-                    if line.startswith(("def ", "async def ", "class ")):
-                        sig = line.strip()
-                        break
-                fallback = [module_path]
-                if sig:
-                    fallback.append(sig)
-                fallback = [x for x in fallback if x and x in haystack]
-                normalized_evidence = fallback[:2]
-            if len(normalized_evidence) < 2:
-                raise ValueError("evidence must include >= 2 substrings present in source module")
+    def _parse_api_page(self, raw: str, job: "DocGenerator._LLMJob") -> Dict[str, Any]:
+        module_path = job.context["module_path"]
+        module_text = job.context["module_text"]
+        signature = next(
+            (line.strip() for line in (module_text or "").splitlines() if line.startswith(("def ", "async def ", "class "))),
+            "",
+        )
+        ctx = RuleContext(
+            haystack=f"{module_path}\n{module_text}",
+            index=self.evidence_index,
+            # The output path is fixed by the request.
+            pinned={"target_category": job.context["target_category"], "file_name": job.context["file_name"]},
+            fallback_evidence=[module_path, signature],
+        )
+        obj = self.output_rules["api_page"].validate(self._extract_json(raw), ctx)
+        return {**obj, "reason": obj["reason"].strip()}
 
-            return {
-                "target_category": out_category,
-                "file_name": out_file_name,
-                "content": content,
-                "evidence": normalized_evidence,
-                "reason": (obj.get("reason") or "").strip(),
-            }
-        except Exception as e:
-            self._handle_exception(e, f"API 文档生成({module_path})")
-            return None
+    def generate_plugin_api_doc_page(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        module_path: str,
+        module_text: str,
+        target_category: str,
+        file_name: str,
+    ) -> Optional[Dict[str, Any]]:
+        """Stage 4: generate one plugin API page from a single source module."""
+        job = self._api_page_job(
+            repo_map=repo_map,
+            module_path=module_path,
+            module_text=module_text,
+            target_category=target_category,
+            file_name=file_name,
+        )
+        return self._run_job(job, self._parse_api_page)
+
+    async def agenerate_plugin_api_doc_page(
+        self,
+        *,
+        repo_map: Dict[str, Any],
+        module_path: str,
+        module_text: str,
+        target_category: str,
+        file_name: str,
+    ) -> Optional[Dict[str, Any]]:
+        """Async variant of generate_plugin_api_doc_page."""
+        job = self._api_page_job(
+            repo_map=repo_map,
+            module_path=module_path,
+            module_text=module_text,
+            target_category=target_category,
+            file_name=file_name,
+        )
+        return await self._arun_job(job, self._parse_api_page)
+
+    def generate_plugin_api_doc_pages_batch(
+        self, *, repo_map: Dict[str, Any], modules: List[Dict[str, Any]], fallback_limit: int
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Batch variant of generate_plugin_api_doc_page; `modules` hold its keyword arguments."""
+        jobs = [self._api_page_job(repo_map=repo_map, **module) for module in modules]
+        return self._run_batch(jobs, self._parse_api_page, fallback_limit=fallback_limit)
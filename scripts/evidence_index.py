@@ -0,0 +1,162 @@
+"""Where in the cloned repository an evidence token occurs.
+
+Validators used to accept an evidence item only when it was quoted from the prompt. An EvidenceIndex is built
+once per run from the clone, so evidence can also be checked against the real tree. It is looked up in order:
+- exact tables of repo paths (files and their directories) and Python symbols ("name", "Class.method" and the
+  stripped "def ...:" / "class ...:" line) answer most tokens with a dict hit;
+- everything else is a substring search over one string holding every text file (NUL-separated, so no match
+  spans two files). A word inside the token, i.e. not at its edges, must occur as a whole word in the matching
+  file, so word postings narrow the search to the files containing it. Likewise the token's first word must end
+  some word of the text and its last word must start one, which two sorted vocabularies answer by bisection.
+  A lone ASCII identifier must occur as a whole word. A fabricated path, Class.method or name is thus rejected
+  without scanning any text; only tokens without ASCII word structure (e.g. Chinese prose) scan everything.
+
+The substring search itself runs in C. A multi-pattern automaton written in Python would cost more per
+character than these narrowed scans. Results are memoized for the run. locate_many() resolves the evidence of a
+whole batch of outputs at once and reports a Location for each token.
+"""
+
+import bisect
+import os
+import re
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+_SKIP_DIRS = {".git", "node_modules", "__pycache__"}
+_WORD_RE = re.compile(r"\w+")
+_PY_DEF_RE = re.compile(r"^([ \t]*)(?:async[ \t]+)?(def|class)[ \t]+(\w+)[^\n]*", re.M)
+# Shorter tokens would "match" almost any repository.
+_MIN_TEXT_TOKEN = 3
+
+
+class Location(NamedTuple):
+    path: str
+    line: int  # 0 when the token is the path itself
+    kind: str  # "path" | "symbol" | "text"
+
+    def __str__(self) -> str:
+        return f"{self.path}:{self.line}" if self.line else self.path
+
+
+class EvidenceIndex:
+    """Paths, Python symbols and text of one checkout; see the module docstring."""
+
+    def __init__(self, files: Dict[str, str]):
+        started = time.perf_counter()
+        self.exact: Dict[str, Location] = {}
+        for path in files:
+            parts = path.split("/")
+            for i in range(1, len(parts)):
+                directory = "/".join(parts[:i])
+                self.exact.setdefault(directory, Location(directory, 0, "path"))
+                self.exact.setdefault(directory + "/", Location(directory, 0, "path"))
+            self.exact[path] = Location(path, 0, "path")
+        for path, text in files.items():
+            if path.endswith(".py"):
+                self._index_python(path, text)
+
+        self._paths: List[str] = list(files)
+        self._starts: List[int] = []
+        offset = 0
+        for text in files.values():
+            self._starts.append(offset)
+            offset += len(text) + 1
+        self._starts.append(offset)
+        self._text = "\0".join(files.values())
+        self._postings: Dict[str, List[int]] = {}
+        for i, text in enumerate(files.values()):
+            for word in set(_WORD_RE.findall(text)):
+                self._postings.setdefault(word, []).append(i)
+        self._words = sorted(self._postings)
+        self._reversed_words = sorted(w[::-1] for w in self._postings)
+        self._cache: Dict[str, Optional[Location]] = {}
+        self.stats = {"files": len(files), "chars": len(self._text), "path": 0, "symbol": 0, "text": 0, "missing": 0}
+        self.build_seconds = time.perf_counter() - started
+
+    @classmethod
+    def from_repo(cls, repo_dir: str, *, max_file_bytes: int = 1_000_000) -> "EvidenceIndex":
+        """Index every text file under repo_dir (binary and oversized files are skipped)."""
+        files: Dict[str, str] = {}
+        for root, dirnames, filenames in os.walk(repo_dir):
+            dirnames[:] = sorted(d for d in dirnames if d not in _SKIP_DIRS)
+            for filename in sorted(filenames):
+                abs_path = os.path.join(root, filename)
+                try:
+                    if os.path.getsize(abs_path) > max_file_bytes:
+                        continue
+                    with open(abs_path, "rb") as f:
+                        raw = f.read()
+                except OSError:
+                    continue
+                if b"\x00" in raw:
+                    continue
+                rel_path = os.path.relpath(abs_path, repo_dir).replace(os.sep, "/")
+                files[rel_path] = raw.decode("utf-8", errors="replace")
+        return cls(files)
+
+    def _index_python(self, path: str, text: str) -> None:
+        classes: List[Tuple[int, str]] = []  # (indent, name) of the enclosing classes
+        line = 1
+        last = 0
+        for m in _PY_DEF_RE.finditer(text):
+            line += text.count("\n", last, m.start())
+            last = m.start()
+            indent, kind, name = len(m.group(1).expandtabs()), m.group(2), m.group(3)
+            while classes and classes[-1][0] >= indent:
+                classes.pop()
+            loc = Location(path, line, "symbol")
+            self.exact.setdefault(name, loc)
+            self.exact.setdefault(m.group().strip(), loc)
+            if classes:
+                self.exact.setdefault(f"{classes[-1][1]}.{name}", loc)
+            if kind == "class":
+                classes.append((indent, name))
+
+    def locate(self, token: str) -> Optional[Location]:
+        token = (token or "").strip().strip("`")
+        if token in self._cache:
+            return self._cache[token]
+        loc = self.exact.get(token[2:] if token.startswith("./") else token)
+        if loc is None and len(token) >= _MIN_TEXT_TOKEN and "\0" not in token:
+            loc = self._find_text(token)
+        self.stats[loc.kind if loc else "missing"] += 1
+        self._cache[token] = loc
+        return loc
+
+    @staticmethod
+    def _has_prefix(sorted_words: List[str], prefix: str) -> bool:
+        i = bisect.bisect_left(sorted_words, prefix)
+        return i < len(sorted_words) and sorted_words[i].startswith(prefix)
+
+    def _find_text(self, token: str) -> Optional[Location]:
+        matches = list(_WORD_RE.finditer(token))
+        inner = [m.group() for m in matches if m.start() > 0 and m.end() < len(token)]
+        if inner:
+            return self._find_in(token, self._postings.get(max(inner, key=len), ()))
+        words = [m.group() for m in matches]
+        if len(words) >= 2 and not (
+            self._has_prefix(self._reversed_words, words[0][::-1]) and self._has_prefix(self._words, words[-1])
+        ):
+            return None
+        if len(words) == 1 and words[0].isascii():
+            # An identifier counts as a whole word; "_api" is no evidence for "send_api".
+            return self._find_in(token, self._postings.get(words[0], ()))
+        return self._find_in(token, range(len(self._paths)))
+
+    def _find_in(self, token: str, files: Iterable[int]) -> Optional[Location]:
+        for i in files:
+            pos = self._text.find(token, self._starts[i], self._starts[i + 1])
+            if pos >= 0:
+                return Location(self._paths[i], self._text.count("\n", self._starts[i], pos) + 1, "text")
+        return None
+
+    def locate_many(self, tokens: Iterable[str]) -> Dict[str, Optional[Location]]:
+        """Location (or None) of every distinct token in a batch."""
+        return {t: self.locate(t) for t in dict.fromkeys(tokens) if isinstance(t, str) and t.strip()}
+
+    def summary(self) -> str:
+        s = self.stats
+        return (
+            f"files={s['files']} chars={s['chars']} build={self.build_seconds:.2f}s "
+            f"lookups: path={s['path']} symbol={s['symbol']} text={s['text']} missing={s['missing']}"
+        )
@@ -0,0 +1,225 @@
+"""Tolerant single-pass decoder for the JSON value in an LLM reply.
+
+`scan_json` finds the first JSON object or array in free text and decodes it. Along the way it accepts the
+usual mistakes of unconstrained model output:
+- trailing commas;
+- raw newlines and other control characters inside strings;
+- smart quotes used as string delimiters;
+- single-quoted strings and unquoted keys;
+- Python literals (True / False / None);
+- full-width `：` and `，` between tokens.
+
+It does not guess at truncated output: an unterminated value is an error.
+
+Decoding is recursive descent without backtracking. Every value goes to the C decoder first (with
+strict=False, so raw newlines pass), and only a value the C decoder rejects is descended into in Python. In
+clean regions the scanner therefore runs at C speed.
+
+Cost stays linear on adversarial input, such as thousands of unmatched "[" or "{ref}" placeholders:
+- candidate starts are found by one regex search that already skips a "{" / "[" which cannot open a JSON
+  value;
+- after a failed start, the next start is searched from the point where decoding stopped, and a value nested
+  deeper than max_depth fails at the end of its run of opening brackets, so the Python scanner reads every
+  character at most once (the old cascade retried from every "{" / "[" and could return a fragment nested
+  inside a broken value);
+- the C decoder may fail at most a fixed number of times per scan, since each failure re-reads the text to
+  report a line number.
+"""
+
+import json
+import re
+from typing import Any, List, Tuple
+
+_WS = "[ \t\n\r\ufeff\u3000]*"
+_WS_RE = re.compile(_WS)
+# An opening bracket followed by something that can start a JSON member (skips "[注]", "{dir}", ...).
+_START_RE = re.compile(
+    rf"\{{{_WS}(?:[\"'\u201c}}]|[A-Za-z_$][\w$-]*{_WS}[:\uff1a])"
+    rf"|\[{_WS}(?:[\"'\u201c\[\]{{\d-]|(?:true|false|null|True|False|None)\b)"
+)
+_OPEN_RUN_RE = re.compile(r"[\[{\s]*")
+_NUMBER_RE = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_IDENT_RE = re.compile(r"[A-Za-z_$][\w$-]*")
+_HEX4_RE = re.compile(r"[0-9a-fA-F]{4}")
+# Opening delimiter -> accepted closing delimiters, and the run of plain characters before the next stop.
+_CLOSERS = {'"': '"', "'": "'", "\u201c": "\u201d\""}
+_CHUNK_RE = {'"': re.compile(r'[^"\\]*'), "'": re.compile(r"[^'\\]*"), "\u201c": re.compile('[^\u201d"\\\\]*')}
+_ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+_COLONS = ":\uff1a"
+_COMMAS = ",\uff0c"
+
+_DECODER = json.JSONDecoder(strict=False)
+_C_FAILURES = 64
+
+
+class JsonScanError(ValueError):
+    """No JSON object/array could be decoded; `pos` is where the last attempt stopped (-1 if none was made)."""
+
+    def __init__(self, message: str, pos: int = -1):
+        super().__init__(message if pos < 0 else f"{message} (char {pos})")
+        self.pos = pos
+
+
+class _Fail(Exception):
+    def __init__(self, pos: int):
+        super().__init__(pos)
+        self.pos = pos
+
+
+class _Scanner:
+    """Recursive-descent decoder over `text`; every method takes a start index and returns (value, end)."""
+
+    def __init__(self, text: str, max_depth: int):
+        self.text = text
+        self.n = len(text)
+        self.max_depth = max_depth
+        self.c_failures_left = _C_FAILURES
+
+    def c_failed(self) -> None:
+        self.c_failures_left -= 1
+
+    def skip_ws(self, i: int) -> int:
+        return _WS_RE.match(self.text, i).end()
+
+    def value(self, i: int, depth: int) -> Tuple[Any, int]:
+        if i >= self.n:
+            raise _Fail(i)
+        ch = self.text[i]
+        if self.c_failures_left > 0 and ch in '{["':
+            try:
+                return _DECODER.scan_once(self.text, i)
+            except (json.JSONDecodeError, RecursionError):
+                self.c_failed()
+            except StopIteration:
+                pass
+        if ch == "{":
+            return self.object(i + 1, depth + 1)
+        if ch == "[":
+            return self.array(i + 1, depth + 1)
+        if ch in _CLOSERS:
+            return self.string(i)
+        m = _NUMBER_RE.match(self.text, i)
+        if m:
+            s = m.group()
+            try:
+                return (float(s) if any(c in s for c in ".eE") else int(s)), m.end()
+            except ValueError:  # int() refuses absurdly long digit strings
+                raise _Fail(i)
+        m = _IDENT_RE.match(self.text, i)
+        if m and m.group() in _LITERALS:
+            return _LITERALS[m.group()], m.end()
+        raise _Fail(i)
+
+    def object(self, i: int, depth: int) -> Tuple[Any, int]:
+        if depth > self.max_depth:
+            raise _Fail(_OPEN_RUN_RE.match(self.text, i).end())
+        text = self.text
+        out = {}
+        i = self.skip_ws(i)
+        if i < self.n and text[i] == "}":
+            return out, i + 1
+        while True:
+            if i >= self.n:
+                raise _Fail(i)
+            if text[i] in _CLOSERS:
+                key, i = self.string(i)
+            else:
+                m = _IDENT_RE.match(text, i)
+                if not m:
+                    raise _Fail(i)
+                key, i = m.group(), m.end()
+            i = self.skip_ws(i)
+            if i >= self.n or text[i] not in _COLONS:
+                raise _Fail(i)
+            out[key], i = self.value(self.skip_ws(i + 1), depth)
+            i = self.skip_ws(i)
+            if i >= self.n:
+                raise _Fail(i)
+            if text[i] == "}":
+                return out, i + 1
+            if text[i] not in _COMMAS:
+                raise _Fail(i)
+            i = self.skip_ws(i + 1)
+            if i < self.n and text[i] == "}":  # trailing comma
+                return out, i + 1
+
+    def array(self, i: int, depth: int) -> Tuple[Any, int]:
+        if depth > self.max_depth:
+            raise _Fail(_OPEN_RUN_RE.match(self.text, i).end())
+        text = self.text
+        out: List[Any] = []
+        i = self.skip_ws(i)
+        if i < self.n and text[i] == "]":
+            return out, i + 1
+        while True:
+            item, i = self.value(i, depth)
+            out.append(item)
+            i = self.skip_ws(i)
+            if i >= self.n:
+                raise _Fail(i)
+            if text[i] == "]":
+                return out, i + 1
+            if text[i] not in _COMMAS:
+                raise _Fail(i)
+            i = self.skip_ws(i + 1)
+            if i < self.n and text[i] == "]":  # trailing comma
+                return out, i + 1
+
+    def string(self, i: int) -> Tuple[str, int]:
+        text = self.text
+        quote = text[i]
+        if quote == '"' and self.c_failures_left > 0:
+            try:
+                return json.decoder.scanstring(text, i + 1, False)
+            except json.JSONDecodeError:
+                self.c_failed()
+        chunk_re = _CHUNK_RE[quote]
+        parts: List[str] = []
+        i += 1
+        while True:
+            m = chunk_re.match(text, i)
+            parts.append(m.group())
+            i = m.end()
+            if i >= self.n:
+                raise _Fail(i)
+            if text[i] != "\\":
+                return "".join(parts), i + 1  # a closing delimiter
+            esc = text[i + 1 : i + 2]
+            if esc == "u" and _HEX4_RE.fullmatch(text, i + 2, i + 6):
+                code = int(text[i + 2 : i + 6], 16)
+                i += 6
+                if 0xD800 <= code < 0xDC00 and text[i : i + 2] == "\\u" and _HEX4_RE.fullmatch(text, i + 2, i + 6):
+                    low = int(text[i + 2 : i + 6], 16)
+                    if 0xDC00 <= low < 0xE000:
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                        i += 6
+                parts.append(chr(code))
+            elif esc in _ESCAPES:
+                parts.append(_ESCAPES[esc])
+                i += 2
+            elif esc:
+                # Unknown escape (e.g. a Windows path or a regex): keep it verbatim.
+                parts.append("\\" + esc)
+                i += 2
+            else:
+                raise _Fail(i)
+
+
+def scan_json(text: str, *, max_depth: int = 200) -> Any:
+    """Decode the first JSON object or array in `text` (trailing text is ignored)."""
+    if not isinstance(text, str):
+        raise JsonScanError(f"expected str, got {type(text).__name__}")
+    scanner = _Scanner(text, max_depth)
+    last_pos = -1
+    m = _START_RE.search(text)
+    while m is not None:
+        start = m.start()
+        try:
+            return scanner.value(start, 0)[0]
+        except _Fail as e:
+            last_pos = e.pos
+        m = _START_RE.search(text, max(start + 1, last_pos))
+    if last_pos < 0:
+        raise JsonScanError("no JSON object or array found")
+    raise JsonScanError("no decodable JSON object or array", last_pos)
@@ -0,0 +1,169 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from llm_client import (
+    HttpError,
+    LLMResponse,
+    _normalize_base_url,
+    _parse_response,
+    _parse_usage,
+    _prepare_request,
+    _rate_limit_headers,
+    build_openai_chat_completions_url,
+)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+@dataclass
+class BatchResult:
+    custom_id: str
+    response: Optional[LLMResponse] = None
+    error: str = ""
+
+
+def build_batch_line(custom_id: str, **request_kwargs: Any) -> Dict[str, Any]:
+    """One JSONL line of an OpenAI batch input file, built from generate_response keyword arguments."""
+    prepared = _prepare_request(
+        api_key=request_kwargs["api_key"],
+        base_url=request_kwargs["base_url"],
+        model_name=request_kwargs["model_name"],
+        prompt=request_kwargs["prompt"],
+        system_instruction=request_kwargs.get("system_instruction"),
+        temperature=request_kwargs.get("temperature", 0.7),
+        max_tokens=request_kwargs.get("max_tokens", 2048),
+        response_format=request_kwargs.get("response_format"),
+        api_version=request_kwargs.get("api_version", "v1beta"),
+        api_style=request_kwargs.get("api_style", "auto"),
+    )
+    if prepared.style != "openai":
+        raise ValueError("batch mode requires an OpenAI-compatible endpoint")
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": prepared.payload}
+
+
+class OpenAIBatchRunner:
+    """Submit chat-completion requests through /v1/files + /v1/batches and collect the results."""
+
+    def __init__(
+        self,
+        *,
+        api_key: str,
+        base_url: str,
+        poll_interval: float = 30.0,
+        max_wait_seconds: float = 5 * 3600,
+        timeout_seconds: int = 120,
+        on_status: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        # .../v1/chat/completions -> .../v1
+        self.v1_base = build_openai_chat_completions_url(_normalize_base_url(base_url)).rsplit("/chat/completions", 1)[0]
+        self.poll_interval = max(0.1, float(poll_interval))
+        self.max_wait_seconds = float(max_wait_seconds)
+        self.on_status = on_status
+        self._client = httpx.Client(
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=httpx.Timeout(float(timeout_seconds), connect=min(30.0, float(timeout_seconds))),
+        )
+
+    def close(self) -> None:
+        self._client.close()
+
+    def _request(self, method: str, path: str, **kwargs: Any) -> httpx.Response:
+        response = self._client.request(method, f"{self.v1_base}/{path.lstrip('/')}", **kwargs)
+        if response.status_code >= 400:
+            raise HttpError(
+                status_code=response.status_code,
+                body=response.text,
+                headers=_rate_limit_headers(response.headers.items()),
+            )
+        return response
+
+    def submit(self, lines: List[Dict[str, Any]], *, metadata: Optional[Dict[str, str]] = None) -> str:
+        content = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+        uploaded = self._request(
+            "POST",
+            "files",
+            data={"purpose": "batch"},
+            files={"file": ("batch_input.jsonl", content, "application/jsonl")},
+        ).json()
+        body: Dict[str, Any] = {
+            "input_file_id": uploaded["id"],
+            "endpoint": BATCH_ENDPOINT,
+            "completion_window": "24h",
+        }
+        if metadata:
+            body["metadata"] = metadata
+        return self._request("POST", "batches", json=body).json()["id"]
+
+    def wait(self, batch_id: str) -> Dict[str, Any]:
+        deadline = time.monotonic() + self.max_wait_seconds
+        while True:
+            batch = self._request("GET", f"batches/{batch_id}").json()
+            if self.on_status:
+                self.on_status(batch)
+            if batch.get("status") in _TERMINAL_STATUSES:
+                return batch
+            if time.monotonic() >= deadline:
+                try:
+                    self._request("POST", f"batches/{batch_id}/cancel")
+                except Exception:
+                    pass
+                raise TimeoutError(f"batch {batch_id} not finished after {self.max_wait_seconds:.0f}s")
+            time.sleep(self.poll_interval)
+
+    def _read_jsonl(self, file_id: Optional[str]) -> List[Dict[str, Any]]:
+        if not file_id:
+            return []
+        rows: List[Dict[str, Any]] = []
+        for line in self._request("GET", f"files/{file_id}/content").text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except Exception:
+                continue
+        return rows
+
+    def fetch_results(self, batch: Dict[str, Any], *, elapsed: float = 0.0) -> Dict[str, BatchResult]:
+        results: Dict[str, BatchResult] = {}
+        rows = self._read_jsonl(batch.get("output_file_id")) + self._read_jsonl(batch.get("error_file_id"))
+        for row in rows:
+            custom_id = str(row.get("custom_id") or "")
+            if not custom_id:
+                continue
+            response = row.get("response") or {}
+            body = response.get("body") or {}
+            status = int(response.get("status_code") or 0)
+            if row.get("error") or status != 200:
+                error = row.get("error") or body.get("error") or body
+                results[custom_id] = BatchResult(custom_id, error=f"HTTP {status}: {json.dumps(error, ensure_ascii=False)[:300]}")
+                continue
+            try:
+                choice = (body.get("choices") or [{}])[0]
+                results[custom_id] = BatchResult(
+                    custom_id,
+                    response=LLMResponse(
+                        text=_parse_response("openai", body),
+                        latency_seconds=elapsed,
+                        transport="batch",
+                        finish_reason=str(choice.get("finish_reason") or ""),
+                        usage=_parse_usage("openai", body),
+                    ),
+                )
+            except Exception as e:
+                results[custom_id] = BatchResult(custom_id, error=str(e))
+        return results
+
+    def run(self, lines: List[Dict[str, Any]], *, metadata: Optional[Dict[str, str]] = None) -> Dict[str, BatchResult]:
+        """Submit, wait and map results by custom_id; ids missing from the result map did not complete."""
+        started = time.monotonic()
+        batch_id = self.submit(lines, metadata=metadata)
+        batch = self.wait(batch_id)
+        if batch.get("status") != "completed" and not batch.get("output_file_id"):
+            raise RuntimeError(f"batch {batch_id} ended with status {batch.get('status')}: {batch.get('errors')}")
+        return self.fetch_results(batch, elapsed=time.monotonic() - started)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of LLM responses.
+
+    Layout: <root>/<key[:2]>/<key>.json. A file's mtime is bumped on every hit, so the size-based eviction is LRU;
+    entries older than the TTL (by creation time) are treated as misses and removed.
+    """
+
+    def __init__(self, root: str, *, max_bytes: int, ttl_seconds: float):
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(inputs: Dict[str, Any]) -> str:
+        canonical = json.dumps(inputs, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            entry = None
+        except Exception:
+            self.discard(key)
+            entry = None
+
+        if entry is not None and self.ttl_seconds and time.time() - float(entry.get("created_at") or 0) > self.ttl_seconds:
+            self.discard(key)
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = dict(entry)
+        entry.setdefault("created_at", time.time())
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.writes += 1
+
+    def discard(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _created_at(path: str) -> Optional[float]:
+        """The entry's stored creation time (None when the file is unreadable)."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return float(json.load(f).get("created_at") or 0)
+        except (OSError, ValueError, TypeError, AttributeError):
+            return None
+
+    def evict(self) -> int:
+        """Drop entries created longer than the TTL ago (the rule get() applies), then least-recently-used ones
+        until under max_bytes. The mtime, bumped on every hit, only orders the LRU pass."""
+        if not os.path.isdir(self.root):
+            return 0
+
+        now = time.time()
+        files: List[Tuple[float, int, str]] = []
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                expired = False
+                if self.ttl_seconds and not name.endswith(".tmp"):
+                    # The mtime is never older than the creation time, so a stale mtime settles it unread.
+                    if now - st.st_mtime > self.ttl_seconds:
+                        expired = True
+                    else:
+                        created_at = self._created_at(path)
+                        expired = created_at is None or now - created_at > self.ttl_seconds
+                if name.endswith(".tmp") or expired:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        if self.max_bytes and total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                    total -= size
+                except OSError:
+                    pass
+        return removed
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"hits={self.hits} misses={self.misses} hit_rate={rate:.1f}% writes={self.writes}"
@@ -1,15 +1,25 @@
+import asyncio
+import importlib.util
 import json
+import os
 import re
 import subprocess
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
+import httpx
+
 
 @dataclass
 class HttpError(RuntimeError):
     status_code: int
     body: str
+    # Rate-limit related response headers (lower-cased), e.g. retry-after / x-ratelimit-*.
+    headers: Dict[str, str] = field(default_factory=dict)
 
     def __str__(self) -> str:  # pragma: no cover
         preview = (self.body or "").strip()
@@ -18,6 +28,58 @@ class HttpError(RuntimeError):
         return f"HTTP {self.status_code}: {preview}"
 
 
+class StreamStalledError(RuntimeError):
+    """Raised when a streamed response produces no data within the idle timeout."""
+
+
+class StreamInterruptedError(RuntimeError):
+    """Raised when a streamed response ends without a completion marker."""
+
+
+@dataclass
+class LLMResponse:
+    text: str
+    latency_seconds: float = 0.0
+    transport: str = ""
+    # Set for streamed calls only: seconds until the first text delta arrived.
+    ttft_seconds: Optional[float] = None
+    finish_reason: str = ""
+    # response_format type that produced this response ("" when none was sent) and the ones rejected before it.
+    response_format: str = ""
+    rejected_formats: List[str] = field(default_factory=list)
+    # Normalized token usage: prompt_tokens / completion_tokens / total_tokens, plus cached_tokens
+    # (prompt tokens served from the provider's prompt cache), when reported.
+    usage: Dict[str, int] = field(default_factory=dict)
+    # Rate-limit related response headers (lower-cased), e.g. x-ratelimit-remaining-requests.
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def truncated(self) -> bool:
+        """The output stopped at max_tokens (OpenAI "length", Gemini "MAX_TOKENS")."""
+        return (self.finish_reason or "").lower() in {"length", "max_tokens"}
+
+
+def _rate_limit_headers(items: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    for name, value in items:
+        name = (name or "").strip().lower()
+        if name in {"retry-after", "retry-after-ms"} or name.startswith("x-ratelimit-"):
+            out[name] = (value or "").strip()
+    return out
+
+
+def _read_curl_headers(path: str) -> Dict[str, str]:
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            raw = f.read()
+    except OSError:
+        return {}
+    # Keep only the last header block (after redirects / 100-continue).
+    blocks = [b for b in re.split(r"\r?\n\r?\n", raw) if b.strip()]
+    lines = blocks[-1].splitlines()[1:] if blocks else []
+    return _rate_limit_headers(tuple(line.split(":", 1)) for line in lines if ":" in line)
+
+
 def _normalize_base_url(base_url: str) -> str:
     return (base_url or "").strip().rstrip("/")
 
@@ -46,8 +108,10 @@ def _curl_post_json(
     headers: Dict[str, str],
     payload: Dict[str, Any],
     timeout_seconds: int = 60,
-) -> Tuple[int, Dict[str, Any]]:
+) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
     marker = "__CURL_HTTP_STATUS__:"
+    fd, header_path = tempfile.mkstemp(prefix="llm-curl-headers-")
+    os.close(fd)
     cmd = [
         "curl",
         "-sS",
@@ -62,6 +126,8 @@ def _curl_post_json(
         "Content-Type: application/json",
         "--data-binary",
         "@-",
+        "-D",
+        header_path,
         "-w",
         f"\n{marker}%{{http_code}}",
     ]
@@ -70,14 +136,21 @@ def _curl_post_json(
         if header_value:
             cmd.extend(["-H", f"{header_name}: {header_value}"])
 
-    result = subprocess.run(
-        cmd,
-        input=json.dumps(payload, ensure_ascii=False),
-        text=True,
-        capture_output=True,
-        encoding="utf-8",
-        errors="replace",
-    )
+    try:
+        result = subprocess.run(
+            cmd,
+            input=json.dumps(payload, ensure_ascii=False),
+            text=True,
+            capture_output=True,
+            encoding="utf-8",
+            errors="replace",
+        )
+        response_headers = _read_curl_headers(header_path)
+    finally:
+        try:
+            os.remove(header_path)
+        except OSError:
+            pass
 
     stdout = result.stdout or ""
     if marker not in stdout:
@@ -90,14 +163,219 @@ def _curl_post_json(
     status_code = int(status_text.strip() or "0")
 
     if status_code < 200 or status_code >= 300:
-        raise HttpError(status_code=status_code, body=body_text)
+        raise HttpError(status_code=status_code, body=body_text, headers=response_headers)
 
     try:
-        return status_code, json.loads(body_text) if body_text else {}
+        return status_code, json.loads(body_text) if body_text else {}, response_headers
     except json.JSONDecodeError:
         raise RuntimeError(f"Non-JSON response (HTTP {status_code}): {body_text[:500]}")
 
 
+_HTTP_POOL_OPTIONS: Dict[str, Any] = {
+    "http2": False,
+    "max_connections": 10,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 120.0,
+}
+_HTTP_CLIENT: Optional[httpx.Client] = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+# httpx.AsyncClient is bound to the event loop it was first used on; a loop running in a worker thread (e.g. a
+# provider batch's fallback inside the bootstrap pipeline) gets a pool of its own.
+_ASYNC_HTTP_CLIENTS: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+# Pending aclose() tasks; the loop only keeps a weak reference to a task, so one nobody holds could be collected
+# before it finishes.
+_CLOSING_TASKS: Set["asyncio.Task[None]"] = set()
+
+
+def configure_http_pool(
+    *,
+    http2: Optional[bool] = None,
+    max_connections: Optional[int] = None,
+    max_keepalive_connections: Optional[int] = None,
+    keepalive_expiry: Optional[float] = None,
+) -> None:
+    """Set pool options for the shared httpx transport (takes effect on the next request)."""
+    if http2 is not None:
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("警告: LLM_HTTP2=1 但未安装 h2（pip install 'httpx[http2]'），将回退到 HTTP/1.1。")
+            http2 = False
+        _HTTP_POOL_OPTIONS["http2"] = bool(http2)
+    if max_connections is not None:
+        _HTTP_POOL_OPTIONS["max_connections"] = max(1, int(max_connections))
+    if max_keepalive_connections is not None:
+        _HTTP_POOL_OPTIONS["max_keepalive_connections"] = max(0, int(max_keepalive_connections))
+    if keepalive_expiry is not None:
+        _HTTP_POOL_OPTIONS["keepalive_expiry"] = max(0.0, float(keepalive_expiry))
+    close_http_pool()
+
+
+def close_http_pool() -> None:
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is not None:
+            _HTTP_CLIENT.close()
+            _HTTP_CLIENT = None
+        async_clients = list(_ASYNC_HTTP_CLIENTS.items())
+        _ASYNC_HTTP_CLIENTS.clear()
+    for loop, client in async_clients:
+        _close_async_client(loop, client)
+
+
+def _close_async_client(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient) -> None:
+    """Close an async pool from synchronous code; aclose() has to run on the loop the client was used on."""
+    if loop.is_closed():
+        # Nothing can run on it any more; its connections go away with their sockets.
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if loop is running:
+        _start_close(client)
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    elif running is None:
+        loop.run_until_complete(client.aclose())
+    else:
+        # An idle loop cannot be driven from inside another running loop: the client closes when its loop runs
+        # again, or never.
+        loop.call_soon_threadsafe(_start_close, client)
+        print(
+            "警告: 无法在另一个运行中的事件循环里关闭空闲事件循环的 httpx 连接池，它将在该循环下次运行时关闭；"
+            "请在该循环结束前调用 aclose_http_pool()。"
+        )
+
+
+def _start_close(client: httpx.AsyncClient) -> None:
+    task = asyncio.get_running_loop().create_task(client.aclose())
+    _CLOSING_TASKS.add(task)
+    task.add_done_callback(_CLOSING_TASKS.discard)
+
+
+async def aclose_http_pool() -> None:
+    """Close the async pool created on the running event loop (call before the loop shuts down)."""
+    with _HTTP_CLIENT_LOCK:
+        client = _ASYNC_HTTP_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _pool_client_kwargs() -> Dict[str, Any]:
+    return {
+        "http2": _HTTP_POOL_OPTIONS["http2"],
+        "limits": httpx.Limits(
+            max_connections=_HTTP_POOL_OPTIONS["max_connections"],
+            max_keepalive_connections=_HTTP_POOL_OPTIONS["max_keepalive_connections"],
+            keepalive_expiry=_HTTP_POOL_OPTIONS["keepalive_expiry"],
+        ),
+        "headers": {"Accept": "application/json", "Content-Type": "application/json"},
+    }
+
+
+def _get_http_client() -> httpx.Client:
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is None:
+            _HTTP_CLIENT = httpx.Client(**_pool_client_kwargs())
+        return _HTTP_CLIENT
+
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    with _HTTP_CLIENT_LOCK:
+        client = _ASYNC_HTTP_CLIENTS.get(loop)
+        if client is None:
+            client = _ASYNC_HTTP_CLIENTS[loop] = httpx.AsyncClient(**_pool_client_kwargs())
+        return client
+
+
+def _request_timeout(timeout_seconds: int) -> httpx.Timeout:
+    return httpx.Timeout(float(timeout_seconds), connect=min(30.0, float(timeout_seconds)))
+
+
+def _decode_json_response(response: httpx.Response) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    status_code = response.status_code
+    body_text = (response.text or "").strip()
+    response_headers = _rate_limit_headers(response.headers.items())
+
+    if status_code < 200 or status_code >= 300:
+        raise HttpError(status_code=status_code, body=body_text, headers=response_headers)
+
+    try:
+        return status_code, json.loads(body_text) if body_text else {}, response_headers
+    except json.JSONDecodeError:
+        raise RuntimeError(f"Non-JSON response (HTTP {status_code}): {body_text[:500]}")
+
+
+def _httpx_post_json(
+    *,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_seconds: int = 60,
+) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    client = _get_http_client()
+    response = client.post(
+        url,
+        headers={k: v for k, v in headers.items() if v},
+        content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        timeout=_request_timeout(timeout_seconds),
+    )
+    return _decode_json_response(response)
+
+
+async def _ahttpx_post_json(
+    *,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_seconds: int = 60,
+) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    client = _get_async_http_client()
+    response = await client.post(
+        url,
+        headers={k: v for k, v in headers.items() if v},
+        content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        timeout=_request_timeout(timeout_seconds),
+    )
+    return _decode_json_response(response)
+
+
+def _post_json(
+    *,
+    transport: str,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_seconds: int = 60,
+) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    if transport == "curl":
+        return _curl_post_json(url=url, headers=headers, payload=payload, timeout_seconds=timeout_seconds)
+    return _httpx_post_json(url=url, headers=headers, payload=payload, timeout_seconds=timeout_seconds)
+
+
+async def _apost_json(
+    *,
+    transport: str,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_seconds: int = 60,
+) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    if transport == "curl":
+        return await asyncio.to_thread(
+            _curl_post_json, url=url, headers=headers, payload=payload, timeout_seconds=timeout_seconds
+        )
+    return await _ahttpx_post_json(url=url, headers=headers, payload=payload, timeout_seconds=timeout_seconds)
+
+
+def _normalize_transport(transport: str) -> str:
+    transport = (transport or "httpx").strip().lower()
+    if transport not in {"httpx", "curl"}:
+        raise ValueError("LLM_HTTP_TRANSPORT must be one of: httpx/curl")
+    return transport
+
+
 def build_openai_chat_completions_url(base_url: str) -> str:
     base_url = _normalize_base_url(base_url)
     parsed = urlparse(base_url)
@@ -108,41 +386,125 @@ def build_openai_chat_completions_url(base_url: str) -> str:
     return _join_url(v1_base, "chat/completions")
 
 
-def build_gemini_generate_content_url(base_url: str, api_version: str, model_name: str) -> str:
+def _gemini_url_prefix(base_url: str, api_version: str) -> str:
     base_url = _normalize_base_url(base_url)
     api_version = (api_version or "v1beta").strip().strip("/")
-
     if re.search(r"/v1(beta)?/?$", urlparse(base_url).path or ""):
-        url_prefix = base_url
-    else:
-        url_prefix = _join_url(base_url, api_version)
+        return base_url
+    return _join_url(base_url, api_version)
+
 
+def build_gemini_generate_content_url(base_url: str, api_version: str, model_name: str, stream: bool = False) -> str:
+    url_prefix = _gemini_url_prefix(base_url, api_version)
+    if stream:
+        return _join_url(url_prefix, f"models/{model_name}:streamGenerateContent?alt=sse")
     return _join_url(url_prefix, f"models/{model_name}:generateContent")
 
 
-def generate_text(
+def _looks_like_response_format_error(body_text: str) -> bool:
+    t = (body_text or "").lower()
+    needles = [
+        "response_format",
+        "json_schema",
+        "json_object",
+        "responseschema",
+        "responsemimetype",
+        "response_schema",
+        "response_mime_type",
+        "unknown parameter",
+        "unrecognized",
+        "unsupported",
+        "not supported",
+        "invalid",
+    ]
+    return any(n in t for n in needles)
+
+
+def _schema_root_type(fmt: Dict[str, Any]) -> str:
+    try:
+        if (fmt or {}).get("type") != "json_schema":
+            return ""
+        js = (fmt or {}).get("json_schema") or {}
+        schema = js.get("schema") or {}
+        return str(schema.get("type") or "").strip().lower()
+    except Exception:
+        return ""
+
+
+def gemini_response_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate a JSON schema (the strict OpenAI subset used for json_schema) into a Gemini responseSchema.
+
+    Gemini takes an OpenAPI-style subset: upper-case types, `nullable` instead of type unions, no
+    additionalProperties; `propertyOrdering` keeps the keys in the order the schema lists them.
+    """
+    if not isinstance(schema, dict):
+        return {}
+    out: Dict[str, Any] = {}
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        if "null" in kind:
+            out["nullable"] = True
+        kind = next((k for k in kind if k != "null"), "string")
+    kind = str(kind or "").lower()
+    if kind:
+        out["type"] = kind.upper()
+    for key in ("description", "enum", "format", "minItems", "maxItems", "minimum", "maximum"):
+        if key in schema:
+            out[key] = schema[key]
+    if kind == "object":
+        props = schema.get("properties") or {}
+        out["properties"] = {name: gemini_response_schema(sub) for name, sub in props.items()}
+        out["propertyOrdering"] = list(props)
+        if schema.get("required"):
+            out["required"] = list(schema["required"])
+    elif kind == "array" and isinstance(schema.get("items"), dict):
+        out["items"] = gemini_response_schema(schema["items"])
+    return out
+
+
+@dataclass
+class _PreparedRequest:
+    style: str
+    url: str
+    headers: Dict[str, str]
+    payload: Dict[str, Any]
+
+
+def _prepare_request(
     *,
     api_key: str,
     base_url: str,
     model_name: str,
     prompt: str,
-    system_instruction: Optional[str] = None,
-    temperature: float = 0.7,
-    max_tokens: int = 2048,
-    response_format: Optional[Dict[str, Any]] = None,
-    api_version: str = "v1beta",
-    api_style: str = "auto",
-    timeout_seconds: int = 60,
-) -> str:
+    system_instruction: Optional[str],
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[Dict[str, Any]],
+    api_version: str,
+    api_style: str,
+    stream: bool = False,
+    cached_content: Optional[str] = None,
+    prompt_cache_key: Optional[str] = None,
+    extra_messages: Optional[List[Dict[str, str]]] = None,
+) -> _PreparedRequest:
+    """Build URL/headers/payload for one call.
+
+    `response_format` uses the OpenAI shape for both styles; for Gemini, json_schema becomes
+    responseMimeType=application/json + responseSchema and json_object becomes responseMimeType alone.
+    `cached_content` (Gemini) names a cachedContents resource holding the system instruction and the shared
+    prompt prefix; `prompt` is then only the remainder. `prompt_cache_key` (OpenAI) groups requests that share
+    a prefix so they are routed to the same prompt cache. `extra_messages` are turns after the prompt
+    ({"role": "assistant" | "user", "content"}; "assistant" is sent as Gemini's "model" role).
+    """
     style = detect_api_style(base_url, api_style)
 
     if style == "openai":
-        url = build_openai_chat_completions_url(base_url)
         messages = []
         if system_instruction:
             messages.append({"role": "system", "content": system_instruction})
         messages.append({"role": "user", "content": prompt})
-        payload = {
+        messages.extend({"role": m["role"], "content": m["content"]} for m in extra_messages or [])
+        payload: Dict[str, Any] = {
             "model": model_name,
             "messages": messages,
             "temperature": float(temperature),
@@ -150,95 +512,145 @@ def generate_text(
         }
         if response_format is not None:
             payload["response_format"] = response_format
+        if prompt_cache_key:
+            payload["prompt_cache_key"] = prompt_cache_key
+        if stream:
+            payload["stream"] = True
+        return _PreparedRequest(
+            style=style,
+            url=build_openai_chat_completions_url(base_url),
+            headers={"Authorization": f"Bearer {api_key}"},
+            payload=payload,
+        )
 
-        def _looks_like_response_format_error(body_text: str) -> bool:
-            t = (body_text or "").lower()
-            needles = [
-                "response_format",
-                "json_schema",
-                "json_object",
-                "unknown parameter",
-                "unrecognized",
-                "unsupported",
-                "not supported",
-                "invalid",
-            ]
-            return any(n in t for n in needles)
-
-        def _schema_root_type(fmt: Dict[str, Any]) -> str:
-            try:
-                if (fmt or {}).get("type") != "json_schema":
-                    return ""
-                js = (fmt or {}).get("json_schema") or {}
-                schema = js.get("schema") or {}
-                return str(schema.get("type") or "").strip().lower()
-            except Exception:
-                return ""
-
-        def _post(p: Dict[str, Any]) -> Dict[str, Any]:
-            _, data = _curl_post_json(
-                url=url,
-                headers={"Authorization": f"Bearer {api_key}"},
-                payload=p,
-                timeout_seconds=timeout_seconds,
-            )
-            return data or {}
-
-        try:
-            data = _post(payload)
-        except HttpError as e:
-            # Some OpenAI-compatible endpoints (or older models) don't support response_format/json_schema.
-            if response_format is None or e.status_code not in {400, 422} or not _looks_like_response_format_error(e.body):
-                raise
-
-            fallback_payload = dict(payload)
-            fmt = response_format or {}
-            if fmt.get("type") == "json_schema" and _schema_root_type(fmt) == "object":
-                # Try JSON mode as a best-effort fallback for object responses.
-                fallback_payload["response_format"] = {"type": "json_object"}
-            else:
-                # Arrays can't use json_object; fall back to prompt-only JSON.
-                fallback_payload.pop("response_format", None)
-
-            try:
-                data = _post(fallback_payload)
-            except HttpError as e2:
-                if (
-                    "response_format" in (e2.body or "").lower()
-                    and fallback_payload.get("response_format") is not None
-                    and e2.status_code in {400, 422}
-                ):
-                    fallback_payload.pop("response_format", None)
-                    data = _post(fallback_payload)
-                else:
-                    raise
-        try:
-            return (data["choices"][0]["message"]["content"] or "").strip()
-        except Exception:
-            raise RuntimeError(f"Unexpected OpenAI response shape: {json.dumps(data, ensure_ascii=False)[:500]}")
-
-    url = build_gemini_generate_content_url(base_url, api_version, model_name)
     payload = {
         "contents": [
             {
                 "role": "user",
                 "parts": [{"text": prompt}],
             }
+        ]
+        + [
+            {"role": "model" if m["role"] == "assistant" else "user", "parts": [{"text": m["content"]}]}
+            for m in extra_messages or []
         ],
         "generationConfig": {
             "temperature": float(temperature),
             "maxOutputTokens": int(max_tokens),
         },
     }
-    if system_instruction:
+    fmt_type = (response_format or {}).get("type")
+    if fmt_type in {"json_schema", "json_object"}:
+        payload["generationConfig"]["responseMimeType"] = "application/json"
+    schema = ((response_format or {}).get("json_schema") or {}).get("schema") if fmt_type == "json_schema" else None
+    if schema:
+        payload["generationConfig"]["responseSchema"] = gemini_response_schema(schema)
+    if cached_content:
+        # The cached content already carries the system instruction.
+        payload["cachedContent"] = cached_content
+    elif system_instruction:
         payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
-
-    _, data = _curl_post_json(
-        url=url,
+    return _PreparedRequest(
+        style=style,
+        url=build_gemini_generate_content_url(base_url, api_version, model_name, stream=stream),
         headers={"x-goog-api-key": api_key},
         payload=payload,
-        timeout_seconds=timeout_seconds,
     )
+
+
+def _response_format_fallback(
+    payload: Dict[str, Any], error: HttpError, *, first_failure: bool
+) -> Optional[Dict[str, Any]]:
+    """Return a downgraded payload after a response_format rejection, or None if the error is unrelated.
+
+    The chain is json_schema -> json_object (object roots only) -> prompt-only JSON.
+    """
+    fmt_type = _response_format_type(payload)
+    if not fmt_type or error.status_code not in {400, 422}:
+        return None
+
+    gemini = "generationConfig" in payload
+    if first_failure:
+        # Some OpenAI-compatible endpoints (or older models) don't support response_format/json_schema,
+        # and some Gemini models/proxies reject responseSchema.
+        if not _looks_like_response_format_error(error.body):
+            return None
+        if fmt_type == "json_schema" and (gemini or _schema_root_type(payload["response_format"]) == "object"):
+            # Try JSON mode as a best-effort fallback (OpenAI's json_object only allows object roots).
+            return _with_json_mode(payload, schema=False)
+        # Arrays can't use json_object; fall back to prompt-only JSON.
+        return _with_json_mode(payload, schema=False, mime=False)
+
+    if ("response" if gemini else "response_format") not in (error.body or "").lower():
+        return None
+    return _with_json_mode(payload, schema=False, mime=False)
+
+
+def _with_json_mode(payload: Dict[str, Any], *, schema: bool, mime: bool = True) -> Dict[str, Any]:
+    """Copy of `payload` keeping only the requested structured-output settings."""
+    out = dict(payload)
+    if "generationConfig" in payload:
+        gen = dict(payload["generationConfig"])
+        if not schema:
+            gen.pop("responseSchema", None)
+        if not mime:
+            gen.pop("responseMimeType", None)
+        out["generationConfig"] = gen
+        return out
+    if not mime:
+        out.pop("response_format", None)
+    elif not schema:
+        out["response_format"] = {"type": "json_object"}
+    return out
+
+
+def _response_format_type(payload: Dict[str, Any]) -> str:
+    """"json_schema" / "json_object" / "" for the structured-output mode of an OpenAI or Gemini payload."""
+    if "generationConfig" in payload:
+        gen = payload.get("generationConfig") or {}
+        if gen.get("responseSchema"):
+            return "json_schema"
+        return "json_object" if gen.get("responseMimeType") == "application/json" else ""
+    return str((payload.get("response_format") or {}).get("type") or "")
+
+
+def _parse_usage(style: str, data: Dict[str, Any]) -> Dict[str, int]:
+    if style == "openai":
+        raw = data.get("usage") or {}
+        keys = {"prompt_tokens": "prompt_tokens", "completion_tokens": "completion_tokens", "total_tokens": "total_tokens"}
+    else:
+        raw = data.get("usageMetadata") or {}
+        keys = {
+            "promptTokenCount": "prompt_tokens",
+            "candidatesTokenCount": "completion_tokens",
+            "totalTokenCount": "total_tokens",
+            "cachedContentTokenCount": "cached_tokens",
+        }
+    usage: Dict[str, int] = {}
+    if not isinstance(raw, dict):
+        return usage
+    details = raw.get("prompt_tokens_details")
+    if isinstance(details, dict) and details.get("cached_tokens") is not None:
+        try:
+            usage["cached_tokens"] = int(details["cached_tokens"])
+        except (TypeError, ValueError):
+            pass
+    for src, dst in keys.items():
+        try:
+            if raw.get(src) is not None:
+                usage[dst] = int(raw.get(src))
+        except (TypeError, ValueError):
+            continue
+    return usage
+
+
+def _parse_response(style: str, data: Dict[str, Any]) -> str:
+    if style == "openai":
+        try:
+            return (data["choices"][0]["message"]["content"] or "").strip()
+        except Exception:
+            raise RuntimeError(f"Unexpected OpenAI response shape: {json.dumps(data, ensure_ascii=False)[:500]}")
+
     try:
         candidates = data.get("candidates") or []
         if not candidates:
@@ -247,3 +659,468 @@ def generate_text(
         return "".join((part.get("text") or "") for part in parts).strip()
     except Exception:
         raise RuntimeError(f"Unexpected Gemini response shape: {json.dumps(data, ensure_ascii=False)[:500]}")
+
+
+class _StreamAccumulator:
+    """Incremental SSE decoder for OpenAI chat.completions chunks and Gemini streamGenerateContent events."""
+
+    def __init__(self, style: str):
+        self.style = style
+        self.parts: List[str] = []
+        self.finish_reason = ""
+        self.usage: Dict[str, int] = {}
+        self.done = False
+        self._data_lines: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts).strip()
+
+    @property
+    def complete(self) -> bool:
+        return self.done or bool(self.finish_reason)
+
+    def feed_line(self, line: str) -> str:
+        """Consume one SSE line; returns the text delta completed by it (may be empty)."""
+        line = (line or "").rstrip("\r")
+        if not line:
+            return self._flush_event()
+        if line.startswith(":"):
+            return ""
+        if line.startswith("data:"):
+            self._data_lines.append(line[5:].lstrip())
+        return ""
+
+    def close(self) -> str:
+        return self._flush_event()
+
+    def _flush_event(self) -> str:
+        if not self._data_lines:
+            return ""
+        data = "\n".join(self._data_lines).strip()
+        self._data_lines = []
+        if data == "[DONE]":
+            self.done = True
+            return ""
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            raise RuntimeError(f"Malformed stream event: {data[:200]}")
+        if isinstance(event, dict) and event.get("error"):
+            raise RuntimeError(f"Stream error event: {json.dumps(event.get('error'), ensure_ascii=False)[:500]}")
+        usage = _parse_usage(self.style, event)
+        if usage:
+            self.usage = usage
+
+        delta = ""
+        if self.style == "openai":
+            for choice in event.get("choices") or []:
+                delta += ((choice.get("delta") or {}).get("content") or "")
+                if choice.get("finish_reason"):
+                    self.finish_reason = str(choice.get("finish_reason"))
+        else:
+            for candidate in (event.get("candidates") or [])[:1]:
+                parts = ((candidate.get("content") or {}).get("parts") or [])
+                delta += "".join((part.get("text") or "") for part in parts)
+                if candidate.get("finishReason"):
+                    self.finish_reason = str(candidate.get("finishReason"))
+        if delta:
+            self.parts.append(delta)
+        return delta
+
+
+def _parse_finish_reason(style: str, data: Dict[str, Any]) -> str:
+    try:
+        if style == "openai":
+            return str(data["choices"][0].get("finish_reason") or "")
+        return str((data.get("candidates") or [{}])[0].get("finishReason") or "")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return ""
+
+
+def _response_from_data(style: str, data: Dict[str, Any], *, started: float, transport: str) -> LLMResponse:
+    return LLMResponse(
+        text=_parse_response(style, data),
+        latency_seconds=time.monotonic() - started,
+        transport=transport,
+        finish_reason=_parse_finish_reason(style, data),
+        usage=_parse_usage(style, data),
+    )
+
+
+def _stream_timeout(idle_timeout: float) -> httpx.Timeout:
+    # The read timeout applies between received chunks, so it acts as an inter-chunk idle timeout.
+    return httpx.Timeout(float(idle_timeout), connect=min(30.0, float(idle_timeout)))
+
+
+def _finish_stream(acc: _StreamAccumulator, *, started: float, ttft: Optional[float]) -> LLMResponse:
+    if not acc.complete:
+        raise StreamInterruptedError(f"Stream ended without a completion marker after {len(acc.text)} chars")
+    return LLMResponse(
+        text=acc.text,
+        latency_seconds=time.monotonic() - started,
+        transport="httpx",
+        ttft_seconds=ttft,
+        finish_reason=acc.finish_reason,
+        usage=acc.usage,
+    )
+
+
+def _httpx_stream_post(
+    *,
+    request: _PreparedRequest,
+    payload: Dict[str, Any],
+    idle_timeout: float,
+    on_text: Optional[Callable[[str], None]],
+    started: float,
+) -> LLMResponse:
+    client = _get_http_client()
+    acc = _StreamAccumulator(request.style)
+    ttft: Optional[float] = None
+    try:
+        with client.stream(
+            "POST",
+            request.url,
+            headers={**{k: v for k, v in request.headers.items() if v}, "Accept": "text/event-stream"},
+            content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            timeout=_stream_timeout(idle_timeout),
+        ) as response:
+            if response.status_code < 200 or response.status_code >= 300:
+                response.read()
+                raise HttpError(
+                    status_code=response.status_code,
+                    body=(response.text or "").strip(),
+                    headers=_rate_limit_headers(response.headers.items()),
+                )
+            for line in response.iter_lines():
+                delta = acc.feed_line(line)
+                if delta:
+                    ttft = ttft if ttft is not None else time.monotonic() - started
+                    if on_text:
+                        on_text(delta)
+            delta = acc.close()
+            if delta and on_text:
+                on_text(delta)
+            response_headers = _rate_limit_headers(response.headers.items())
+    except httpx.ReadTimeout as e:
+        raise StreamStalledError(f"No stream data for {idle_timeout:.0f}s (received {len(acc.text)} chars)") from e
+    result = _finish_stream(acc, started=started, ttft=ttft)
+    result.headers = response_headers
+    return result
+
+
+async def _ahttpx_stream_post(
+    *,
+    request: _PreparedRequest,
+    payload: Dict[str, Any],
+    idle_timeout: float,
+    on_text: Optional[Callable[[str], None]],
+    started: float,
+) -> LLMResponse:
+    client = _get_async_http_client()
+    acc = _StreamAccumulator(request.style)
+    ttft: Optional[float] = None
+    try:
+        async with client.stream(
+            "POST",
+            request.url,
+            headers={**{k: v for k, v in request.headers.items() if v}, "Accept": "text/event-stream"},
+            content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            timeout=_stream_timeout(idle_timeout),
+        ) as response:
+            if response.status_code < 200 or response.status_code >= 300:
+                await response.aread()
+                raise HttpError(
+                    status_code=response.status_code,
+                    body=(response.text or "").strip(),
+                    headers=_rate_limit_headers(response.headers.items()),
+                )
+            async for line in response.aiter_lines():
+                delta = acc.feed_line(line)
+                if delta:
+                    ttft = ttft if ttft is not None else time.monotonic() - started
+                    if on_text:
+                        on_text(delta)
+            delta = acc.close()
+            if delta and on_text:
+                on_text(delta)
+            response_headers = _rate_limit_headers(response.headers.items())
+    except httpx.ReadTimeout as e:
+        raise StreamStalledError(f"No stream data for {idle_timeout:.0f}s (received {len(acc.text)} chars)") from e
+    result = _finish_stream(acc, started=started, ttft=ttft)
+    result.headers = response_headers
+    return result
+
+
+def generate_text(
+    *,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    response_format: Optional[Dict[str, Any]] = None,
+    api_version: str = "v1beta",
+    api_style: str = "auto",
+    timeout_seconds: int = 60,
+    transport: str = "httpx",
+) -> str:
+    return generate_response(
+        api_key=api_key,
+        base_url=base_url,
+        model_name=model_name,
+        prompt=prompt,
+        system_instruction=system_instruction,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        api_version=api_version,
+        api_style=api_style,
+        timeout_seconds=timeout_seconds,
+        transport=transport,
+    ).text
+
+
+class _ResponseCall:
+    """The I/O-free part of generate_response / agenerate_response: the prepared request, the payload of the current
+    attempt and the response_format downgrade chain. The two functions only differ in how they send it."""
+
+    def __init__(self, *, transport: str, stream: bool, format_fallback: bool, **request_kwargs: Any):
+        self.transport = _normalize_transport(transport)
+        if stream and self.transport != "httpx":
+            raise ValueError("stream=True requires the httpx transport (LLM_HTTP_TRANSPORT=httpx)")
+        self.stream = bool(stream)
+        self.format_fallback = format_fallback
+        self.started = time.monotonic()
+        self.request = _prepare_request(stream=self.stream, **request_kwargs)
+        self.payload = self.request.payload
+        self.rejected_formats: List[str] = []
+
+    def from_data(self, data: Optional[Dict[str, Any]], headers: Dict[str, str]) -> LLMResponse:
+        result = _response_from_data(self.request.style, data or {}, started=self.started, transport=self.transport)
+        result.headers = headers
+        return result
+
+    def fall_back(self, error: HttpError) -> None:
+        """Switch to the next response_format after a rejection; re-raises `error` when there is none."""
+        fallback_payload = None
+        if self.format_fallback:
+            fallback_payload = _response_format_fallback(self.payload, error, first_failure=not self.rejected_formats)
+        if fallback_payload is None:
+            raise error
+        self.rejected_formats.append(_response_format_type(self.payload))
+        self.payload = fallback_payload
+
+    def finish(self, result: LLMResponse) -> LLMResponse:
+        result.response_format = _response_format_type(self.payload)
+        result.rejected_formats = self.rejected_formats
+        return result
+
+
+def generate_response(
+    *,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    response_format: Optional[Dict[str, Any]] = None,
+    api_version: str = "v1beta",
+    api_style: str = "auto",
+    timeout_seconds: int = 60,
+    transport: str = "httpx",
+    stream: bool = False,
+    stream_idle_timeout: float = 120.0,
+    on_text: Optional[Callable[[str], None]] = None,
+    format_fallback: bool = True,
+    cached_content: Optional[str] = None,
+    prompt_cache_key: Optional[str] = None,
+    extra_messages: Optional[List[Dict[str, str]]] = None,
+) -> LLMResponse:
+    """Like generate_text, but also reports wall-clock latency of the call (including fallbacks).
+
+    With stream=True (httpx transport only; ValueError otherwise) the response is read as SSE: `on_text` receives
+    each text delta, the call fails with StreamStalledError when no data arrives for `stream_idle_timeout` seconds
+    (instead of waiting for `timeout_seconds`), and the result carries time-to-first-token. Both modes report the
+    finish reason (`LLMResponse.truncated` for max_tokens).
+
+    format_fallback=False disables the response_format downgrade chain, so a rejection surfaces as HttpError.
+    See _prepare_request for cached_content / prompt_cache_key / extra_messages.
+    """
+    call = _ResponseCall(
+        transport=transport,
+        stream=stream,
+        format_fallback=format_fallback,
+        api_key=api_key,
+        base_url=base_url,
+        model_name=model_name,
+        prompt=prompt,
+        system_instruction=system_instruction,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        api_version=api_version,
+        api_style=api_style,
+        cached_content=cached_content,
+        prompt_cache_key=prompt_cache_key,
+        extra_messages=extra_messages,
+    )
+    while True:
+        try:
+            if call.stream:
+                result = _httpx_stream_post(
+                    request=call.request,
+                    payload=call.payload,
+                    idle_timeout=stream_idle_timeout,
+                    on_text=on_text,
+                    started=call.started,
+                )
+            else:
+                _, data, response_headers = _post_json(
+                    transport=call.transport,
+                    url=call.request.url,
+                    headers=call.request.headers,
+                    payload=call.payload,
+                    timeout_seconds=timeout_seconds,
+                )
+                result = call.from_data(data, response_headers)
+            return call.finish(result)
+        except HttpError as e:
+            call.fall_back(e)
+
+
+async def agenerate_text(
+    *,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    response_format: Optional[Dict[str, Any]] = None,
+    api_version: str = "v1beta",
+    api_style: str = "auto",
+    timeout_seconds: int = 60,
+    transport: str = "httpx",
+) -> str:
+    response = await agenerate_response(
+        api_key=api_key,
+        base_url=base_url,
+        model_name=model_name,
+        prompt=prompt,
+        system_instruction=system_instruction,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        api_version=api_version,
+        api_style=api_style,
+        timeout_seconds=timeout_seconds,
+        transport=transport,
+    )
+    return response.text
+
+
+async def agenerate_response(
+    *,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    response_format: Optional[Dict[str, Any]] = None,
+    api_version: str = "v1beta",
+    api_style: str = "auto",
+    timeout_seconds: int = 60,
+    transport: str = "httpx",
+    stream: bool = False,
+    stream_idle_timeout: float = 120.0,
+    on_text: Optional[Callable[[str], None]] = None,
+    format_fallback: bool = True,
+    cached_content: Optional[str] = None,
+    prompt_cache_key: Optional[str] = None,
+    extra_messages: Optional[List[Dict[str, str]]] = None,
+) -> LLMResponse:
+    """Async counterpart of generate_response (same response_format fallback chain and streaming mode)."""
+    call = _ResponseCall(
+        transport=transport,
+        stream=stream,
+        format_fallback=format_fallback,
+        api_key=api_key,
+        base_url=base_url,
+        model_name=model_name,
+        prompt=prompt,
+        system_instruction=system_instruction,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        api_version=api_version,
+        api_style=api_style,
+        cached_content=cached_content,
+        prompt_cache_key=prompt_cache_key,
+        extra_messages=extra_messages,
+    )
+    while True:
+        try:
+            if call.stream:
+                result = await _ahttpx_stream_post(
+                    request=call.request,
+                    payload=call.payload,
+                    idle_timeout=stream_idle_timeout,
+                    on_text=on_text,
+                    started=call.started,
+                )
+            else:
+                _, data, response_headers = await _apost_json(
+                    transport=call.transport,
+                    url=call.request.url,
+                    headers=call.request.headers,
+                    payload=call.payload,
+                    timeout_seconds=timeout_seconds,
+                )
+                result = call.from_data(data, response_headers)
+            return call.finish(result)
+        except HttpError as e:
+            call.fall_back(e)
+
+
+def create_gemini_cached_content(
+    *,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    text: str,
+    system_instruction: Optional[str] = None,
+    api_version: str = "v1beta",
+    ttl_seconds: int = 1800,
+    timeout_seconds: int = 60,
+    transport: str = "httpx",
+) -> Tuple[str, Dict[str, int]]:
+    """Create a Gemini cachedContents resource for a shared prompt prefix; returns (name, usage).
+
+    Providers enforce a minimum size (a few thousand tokens) and reject smaller contents with HTTP 400.
+    """
+    payload: Dict[str, Any] = {
+        "model": f"models/{model_name}",
+        "contents": [{"role": "user", "parts": [{"text": text}]}],
+        "ttl": f"{max(60, int(ttl_seconds))}s",
+    }
+    if system_instruction:
+        payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    _, data, _ = _post_json(
+        transport=_normalize_transport(transport),
+        url=_join_url(_gemini_url_prefix(base_url, api_version), "cachedContents"),
+        headers={"x-goog-api-key": api_key},
+        payload=payload,
+        timeout_seconds=timeout_seconds,
+    )
+    name = str((data or {}).get("name") or "")
+    if not name:
+        raise RuntimeError(f"Gemini cachedContents returned no name: {json.dumps(data, ensure_ascii=False)[:300]}")
+    return name, _parse_usage("gemini", data or {})
@@ -0,0 +1,263 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from rate_governor import parse_reset_duration, parse_retry_after
+
+
+@dataclass
+class Endpoint:
+    name: str
+    base_url: str
+    api_key: str
+    api_style: str = "auto"
+    weight: float = 1.0
+    # Per-key budgets for the rate governor (0 = use the global LLM_RPM / LLM_TPM).
+    rpm: int = 0
+    tpm: int = 0
+
+
+@dataclass
+class _Health:
+    latency: Optional[float] = None  # EWMA of successful call latency (seconds)
+    error_rate: float = 0.0  # EWMA of endpoint-level failures
+    in_flight: int = 0
+    # Fraction of the provider-reported request quota still available (None when not reported).
+    quota: Optional[float] = None
+    drained_until: float = 0.0
+    drain_seconds: float = 0.0
+    # Set when the drain expired and one trial call is allowed before the endpoint is re-admitted.
+    probing: bool = False
+    probe_in_flight: bool = False
+    calls: int = 0
+    failures: int = 0
+    drains: int = 0
+
+
+def load_endpoints(
+    raw: str, *, default_base_url: str, default_api_key: str, default_api_style: str = "auto"
+) -> List[Endpoint]:
+    """Parse LLM_ENDPOINTS (a JSON list); an empty value yields the single configured endpoint.
+
+    Each item: {"name", "base_url", "api_key" | "api_key_env", "api_style", "weight", "rpm", "tpm"}.
+    Missing base_url / key / style fall back to the primary BASE_URL / key / LLM_API_STYLE.
+    """
+    primary = Endpoint(
+        name="primary", base_url=default_base_url.rstrip("/"), api_key=default_api_key, api_style=default_api_style
+    )
+    raw = (raw or "").strip()
+    if not raw:
+        return [primary]
+    items = json.loads(raw)
+    if not isinstance(items, list) or not items:
+        raise ValueError("LLM_ENDPOINTS must be a non-empty JSON list")
+
+    endpoints: List[Endpoint] = []
+    for i, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f"LLM_ENDPOINTS[{i}] must be an object")
+        api_key = str(item.get("api_key") or "").strip()
+        if not api_key and item.get("api_key_env"):
+            api_key = (os.getenv(str(item["api_key_env"])) or "").strip()
+        endpoint = Endpoint(
+            name=str(item.get("name") or f"endpoint-{i}"),
+            base_url=str(item.get("base_url") or default_base_url).strip().rstrip("/"),
+            api_key=api_key or default_api_key,
+            api_style=str(item.get("api_style") or default_api_style),
+            weight=max(0.0, float(item.get("weight", 1.0))),
+            rpm=max(0, int(item.get("rpm") or 0)),
+            tpm=max(0, int(item.get("tpm") or 0)),
+        )
+        if not endpoint.api_key:
+            raise ValueError(f"LLM_ENDPOINTS[{i}] ({endpoint.name}) has no API key")
+        endpoints.append(endpoint)
+    if len({e.name for e in endpoints}) != len(endpoints):
+        raise ValueError("LLM_ENDPOINTS names must be unique")
+    return endpoints
+
+
+class EndpointPool:
+    """Route calls across endpoints by weight, observed latency, error rate and remaining quota.
+
+    Endpoints that fail at the endpoint level (429, 401/403, 5xx, network errors) are drained for
+    Retry-After or an exponentially growing period. When the drain expires the endpoint gets a single
+    trial call; success re-admits it, failure drains it again for twice as long.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        *,
+        base_drain_seconds: float = 15.0,
+        max_drain_seconds: float = 600.0,
+        seed: Optional[int] = None,
+    ):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = list(endpoints)
+        self.base_drain_seconds = float(base_drain_seconds)
+        self.max_drain_seconds = float(max_drain_seconds)
+        self._health: Dict[str, _Health] = {e.name: _Health() for e in self.endpoints}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def get(self, name: str) -> Endpoint:
+        """The named endpoint, or the primary one for an empty name."""
+        for endpoint in self.endpoints:
+            if endpoint.name == name:
+                return endpoint
+        if name:
+            raise KeyError(name)
+        return self.primary
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def _score(self, endpoint: Endpoint, health: _Health, default_latency: float) -> float:
+        latency = health.latency if health.latency is not None else default_latency
+        quota = 1.0 if health.quota is None else min(1.0, max(0.05, health.quota))
+        return endpoint.weight * quota * (1.0 - health.error_rate) ** 2 / (max(latency, 0.05) * (1 + health.in_flight))
+
+    def acquire(self, *, exclude: Optional[Endpoint] = None, only: str = "") -> Endpoint:
+        """Pick an endpoint for one call; every acquire must be paired with release().
+
+        `only` pins the call to the named endpoint (used even while drained: there is nothing to fail over to).
+        """
+        now = time.time()
+        with self._lock:
+            for health in self._health.values():
+                if health.drained_until and health.drained_until <= now and not health.probing:
+                    health.probing = True
+                    health.drained_until = 0.0
+
+            def usable(endpoint: Endpoint) -> bool:
+                health = self._health[endpoint.name]
+                if health.drained_until > now or endpoint.weight <= 0:
+                    return False
+                return not (health.probing and health.probe_in_flight)
+
+            pool = [e for e in self.endpoints if e.name == only] if only else self.endpoints
+            candidates = [e for e in pool if usable(e)]
+            if exclude is not None and len(candidates) > 1:
+                candidates = [e for e in candidates if e.name != exclude.name] or candidates
+            if not candidates:
+                # Everything is drained: use the endpoint that recovers first rather than failing outright.
+                candidates = [min(pool, key=lambda e: self._health[e.name].drained_until)]
+
+            known = [h.latency for h in self._health.values() if h.latency is not None]
+            # Unmeasured endpoints are scored as fast as the best one, so they get explored.
+            default_latency = min(known) if known else 1.0
+            weights = [self._score(e, self._health[e.name], default_latency) for e in candidates]
+            if sum(weights) <= 0:
+                chosen = candidates[0]
+            else:
+                chosen = self._random.choices(candidates, weights=weights, k=1)[0]
+
+            health = self._health[chosen.name]
+            health.in_flight += 1
+            health.calls += 1
+            if health.probing:
+                health.probe_in_flight = True
+            return chosen
+
+    def release(
+        self,
+        endpoint: Endpoint,
+        *,
+        latency_seconds: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+        status_code: Optional[int] = None,
+        failed: bool = False,
+    ) -> float:
+        """Fold one call outcome into the endpoint's health; returns the drain applied (0 if none).
+
+        `failed` marks an endpoint-level failure; request-level errors (e.g. 400) should pass failed=False.
+        """
+        headers = {str(k).lower(): str(v) for k, v in (headers or {}).items()}
+        now = time.time()
+        drained = 0.0
+        with self._lock:
+            health = self._health[endpoint.name]
+            health.in_flight = max(0, health.in_flight - 1)
+            health.error_rate = 0.8 * health.error_rate + (0.2 if failed else 0.0)
+
+            try:
+                remaining = float(headers["x-ratelimit-remaining-requests"])
+                limit = float(headers.get("x-ratelimit-limit-requests") or 0)
+                if limit > 0:
+                    health.quota = remaining / limit
+                if remaining <= 0:
+                    reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests", ""))
+                    if reset:
+                        health.drained_until = max(health.drained_until, now + reset)
+                        drained = reset
+            except (KeyError, ValueError):
+                pass
+
+            if failed:
+                health.failures += 1
+                if health.probing:
+                    health.drain_seconds = min(self.max_drain_seconds, max(health.drain_seconds, self.base_drain_seconds) * 2)
+                else:
+                    health.drain_seconds = self.base_drain_seconds
+                drain = health.drain_seconds
+                retry_after = parse_retry_after(headers)
+                if retry_after is not None:
+                    drain = min(self.max_drain_seconds, max(drain, retry_after))
+                elif status_code == 429:
+                    drain = max(drain, parse_reset_duration(headers.get("x-ratelimit-reset-requests", "")) or 0.0)
+                health.drained_until = max(health.drained_until, now + drain)
+                health.drains += 1
+                drained = max(drained, drain)
+            else:
+                if latency_seconds is not None:
+                    latency = float(latency_seconds)
+                    health.latency = latency if health.latency is None else 0.7 * health.latency + 0.3 * latency
+                if health.probing:
+                    health.drain_seconds = 0.0
+            # Either re-admitted (success) or drained again; the next expiry starts a new trial.
+            health.probing = False
+            health.probe_in_flight = False
+            return drained
+
+    def has_alternative(self, endpoint: Endpoint, *, only: str = "") -> bool:
+        if only:
+            return False
+        now = time.time()
+        with self._lock:
+            return any(
+                e.name != endpoint.name and e.weight > 0 and self._health[e.name].drained_until <= now
+                for e in self.endpoints
+            )
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "name": e.name,
+                    "calls": self._health[e.name].calls,
+                    "failures": self._health[e.name].failures,
+                    "drains": self._health[e.name].drains,
+                    "latency": self._health[e.name].latency,
+                    "error_rate": round(self._health[e.name].error_rate, 3),
+                    "drained": self._health[e.name].drained_until > now,
+                }
+                for e in self.endpoints
+            ]
+
+    def summary(self) -> str:
+        parts = []
+        for s in self.snapshot():
+            latency = f"{s['latency']:.2f}s" if s["latency"] is not None else "-"
+            state = " drained" if s["drained"] else ""
+            parts.append(f"{s['name']}(calls={s['calls']} failures={s['failures']} drains={s['drains']} latency={latency}{state})")
+        return " ".join(parts)
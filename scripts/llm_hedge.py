@@ -0,0 +1,67 @@
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+from llm_metrics import _percentile
+
+
+class HedgeCancelled(RuntimeError):
+    """Raised inside the losing call of a hedged pair to abort it (streamed calls only)."""
+
+
+class HedgePolicy:
+    """Decide when a slow call gets a duplicate ("hedge"), from the recent latency distribution.
+
+    The deadline is the `percentile` of the last `window` successful call latencies (never below
+    `min_seconds`); no hedges fire until `min_samples` latencies have been seen. At most `max_ratio`
+    of calls may be hedged, so a slow provider does not double the load on itself.
+    """
+
+    def __init__(
+        self,
+        *,
+        percentile: float = 0.9,
+        min_seconds: float = 5.0,
+        max_ratio: float = 0.1,
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.percentile = min(0.999, max(0.5, float(percentile)))
+        self.min_seconds = max(0.0, float(min_seconds))
+        self.max_ratio = min(1.0, max(0.0, float(max_ratio)))
+        self.min_samples = max(1, int(min_samples))
+        self._latencies: Deque[float] = deque(maxlen=max(self.min_samples, int(window)))
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+
+    def observe(self, latency_seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(float(latency_seconds))
+
+    def deadline(self) -> Optional[float]:
+        """Seconds after which a call should be hedged (None while there is too little data)."""
+        with self._lock:
+            self.calls += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            values = sorted(self._latencies)
+        return max(self.min_seconds, _percentile(values, self.percentile))
+
+    def try_fire(self) -> bool:
+        """Reserve one hedge if the budget allows it."""
+        with self._lock:
+            if self.fired + 1 > self.max_ratio * self.calls + 1:
+                return False
+            self.fired += 1
+            return True
+
+    def record_win(self) -> None:
+        with self._lock:
+            self.won += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            rate = self.fired / self.calls if self.calls else 0.0
+            return f"calls={self.calls} fired={self.fired} ({rate:.1%}) won={self.won}"
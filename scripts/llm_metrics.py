@@ -0,0 +1,84 @@
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    q = min(1.0, max(0.0, float(q)))
+    idx = int(round(q * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+class LLMMetrics:
+    """Thread-safe counters and latency samples collected during one run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self._samples: Dict[str, List[float]] = {}
+        # (task, model) -> call latencies and token totals, for tuning LLM_TASK_PROFILE tiers.
+        self._tasks: Dict[Tuple[str, str], Dict[str, List[float]]] = {}
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + int(n)
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self._samples.setdefault(name, []).append(float(value))
+
+    def observe_task(
+        self, task: str, *, model: str, latency_seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0
+    ) -> None:
+        with self._lock:
+            stats = self._tasks.setdefault((task, model), {"latency": [], "prompt_tokens": [], "completion_tokens": []})
+            stats["latency"].append(float(latency_seconds))
+            stats["prompt_tokens"].append(float(prompt_tokens))
+            stats["completion_tokens"].append(float(completion_tokens))
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def samples(self, name: str) -> List[float]:
+        with self._lock:
+            return list(self._samples.get(name) or [])
+
+    def histogram(self, name: str, bounds: Sequence[float]) -> str:
+        """Bucket counts of one sample series, e.g. "<=1s:3 <=5s:10 >5s:1" for bounds (1, 5)."""
+        values = self.samples(name)
+        counts = [0] * (len(bounds) + 1)
+        for value in values:
+            counts[bisect.bisect_left(bounds, value)] += 1
+        labels = [f"<={b:g}s" for b in bounds] + [f">{bounds[-1]:g}s"]
+        return " ".join(f"{label}:{count}" for label, count in zip(labels, counts))
+
+    def summary_lines(self) -> List[str]:
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {k: sorted(v) for k, v in self._samples.items()}
+            tasks = {k: {name: list(values) for name, values in v.items()} for k, v in self._tasks.items()}
+
+        lines: List[str] = []
+        for name in sorted(samples.keys()):
+            values = samples[name]
+            if not values:
+                continue
+            total = sum(values)
+            lines.append(
+                f"- {name}: n={len(values)} total={total:.2f} avg={total / len(values):.2f} "
+                f"p50={_percentile(values, 0.5):.2f} p95={_percentile(values, 0.95):.2f} max={values[-1]:.2f}"
+            )
+        for name in sorted(counters.keys()):
+            lines.append(f"- {name}: {counters[name]}")
+        for (task, model), stats in sorted(tasks.items()):
+            latency = sorted(stats["latency"])
+            prompt, completion = sum(stats["prompt_tokens"]), sum(stats["completion_tokens"])
+            lines.append(
+                f"- llm_task[{task}]: model={model} calls={len(latency)} p50={_percentile(latency, 0.5):.2f}s "
+                f"p95={_percentile(latency, 0.95):.2f}s prompt_tokens={prompt:.0f} completion_tokens={completion:.0f} "
+                f"avg_completion={completion / len(latency):.0f}"
+            )
+        return lines
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+def default_profile_path(state_file: str) -> str:
+    """Profile file lives next to STATE_FILE, e.g. scripts/state_maibot_dev.llm_profile.json."""
+    stem, _ = os.path.splitext(state_file or "scripts/state.json")
+    return f"{stem}.llm_profile.json"
+
+
+def parse_limits_from_error(body: str) -> Dict[str, int]:
+    """Extract token limits that providers report in 400 bodies (context window / max output tokens)."""
+    text = (body or "").lower()
+    limits: Dict[str, int] = {}
+
+    m = re.search(r"maximum context length is (\d+)", text) or re.search(
+        r"input token count \(\d+\) exceeds the maximum number of tokens allowed \((\d+)\)", text
+    )
+    if m:
+        limits["context_limit_tokens"] = int(m.group(1))
+
+    m = re.search(r"supports at most (\d+) completion tokens", text) or re.search(
+        r"max_tokens[^0-9]{0,40}(?:must be|should be)?\s*(?:less than or equal to|<=|at most)\s*`?(\d+)", text
+    )
+    if m:
+        limits["max_output_tokens_limit"] = int(m.group(1))
+    return limits
+
+
+def input_size_bucket(prompt_tokens: int) -> int:
+    """Power-of-two prompt size class: 0 = under 1k tokens, 1 = 1k-2k, 2 = 2k-4k, ..."""
+    return max(0, int(prompt_tokens).bit_length() - 10)
+
+
+class LLMProfileStore:
+    """Learned facts about LLM endpoints, persisted as JSON across runs.
+
+    Capabilities are keyed by (base_url, model); output sizes by (model, task, input size bucket).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._data: Dict[str, Any] = {"capabilities": {}, "output_sizes": {}}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if isinstance(loaded, dict):
+                self._data.update(loaded)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"警告: 无法读取 LLM 能力档案 {path}: {e}，将重新学习。")
+
+    def _key(self, base_url: str, model_name: str) -> str:
+        return f"{(base_url or '').strip().rstrip('/')}|{(model_name or '').strip()}"
+
+    def capability(self, base_url: str, model_name: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict((self._data.get("capabilities") or {}).get(self._key(base_url, model_name)) or {})
+
+    def update_capability(self, base_url: str, model_name: str, **fields: Any) -> bool:
+        """Merge fields into the endpoint/model entry; returns whether anything changed."""
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return False
+        with self._lock:
+            caps = self._data.setdefault("capabilities", {})
+            entry = caps.setdefault(self._key(base_url, model_name), {})
+            changed = any(entry.get(k) != v for k, v in fields.items())
+            if not changed:
+                return False
+            entry.update(fields)
+            entry["updated_at"] = int(time.time())
+            self._dirty = True
+            return True
+
+    def observe_call(
+        self,
+        base_url: str,
+        model_name: str,
+        *,
+        latency_seconds: float,
+        completion_tokens: Optional[int] = None,
+    ) -> None:
+        """Fold one successful call into the typical-latency EWMA and the largest output seen."""
+        with self._lock:
+            caps = self._data.setdefault("capabilities", {})
+            entry = caps.setdefault(self._key(base_url, model_name), {})
+            prev = entry.get("latency_ewma_s")
+            entry["latency_ewma_s"] = round(
+                float(latency_seconds) if prev is None else 0.8 * float(prev) + 0.2 * float(latency_seconds), 3
+            )
+            if completion_tokens and int(completion_tokens) > int(entry.get("max_output_tokens_observed") or 0):
+                entry["max_output_tokens_observed"] = int(completion_tokens)
+            self._dirty = True
+
+    def observe_output(
+        self, model_name: str, task: str, bucket: int, completion_tokens: int, *, window: int = 200
+    ) -> None:
+        """Record the output size of one call of `task` (keeping the last `window` per model/task/input size)."""
+        with self._lock:
+            sizes = self._data.setdefault("output_sizes", {})
+            samples = sizes.setdefault(f"{(model_name or '').strip()}|{task}|{int(bucket)}", [])
+            samples.append(int(completion_tokens))
+            del samples[: -max(1, int(window))]
+            self._dirty = True
+
+    def output_sizes(self, model_name: str, task: str, bucket: Optional[int] = None) -> List[int]:
+        """Recorded output sizes of `task` on `model_name`; bucket None pools every input size."""
+        prefix = f"{(model_name or '').strip()}|{task}|"
+        with self._lock:
+            sizes = self._data.get("output_sizes") or {}
+            if bucket is not None:
+                return list(sizes.get(f"{prefix}{int(bucket)}") or [])
+            return [v for key, samples in sizes.items() if key.startswith(prefix) for v in samples]
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._data, indent=4, ensure_ascii=False, sort_keys=True)
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,188 @@
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from llm_client import HttpError, StreamInterruptedError, StreamStalledError, _looks_like_response_format_error
+from llm_hedge import HedgeCancelled
+
+RETRYABLE = "retryable"  # transient: retry after a backoff (or on another endpoint)
+FALLBACK = "fallback"  # the request must change (weaker response_format) and can be resent at once
+FATAL = "fatal"  # retrying the same request cannot help
+
+_RETRYABLE_STATUS = {408, 425, 429}
+_QUOTA_RE = re.compile(r"rate|quota|exceed|too many", re.IGNORECASE)
+
+
+class FormatRejected(RuntimeError):
+    """The endpoint rejected the request's response_format; the next attempt uses the next weaker mode."""
+
+    def __init__(self, format_type: str, error: HttpError):
+        super().__init__(f"response_format {format_type} rejected: {error}")
+        self.format_type = format_type
+        self.error = error
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the endpoint while the circuit breaker is open."""
+
+
+class DeadlineExceeded(RuntimeError):
+    """The per-call or per-run time budget is used up."""
+
+
+def format_rejection(e: BaseException, format_type: str) -> Optional[FormatRejected]:
+    """Wrap `e` as FormatRejected when it is a 400/422 about the response_format the request carried."""
+    if not format_type or not isinstance(e, HttpError) or e.status_code not in {400, 422}:
+        return None
+    if not _looks_like_response_format_error(e.body):
+        return None
+    return FormatRejected(format_type, e)
+
+
+def classify_error(e: BaseException) -> str:
+    if isinstance(e, FormatRejected):
+        return FALLBACK
+    if isinstance(e, (CircuitOpenError, DeadlineExceeded, HedgeCancelled)):
+        return FATAL
+    if isinstance(e, HttpError):
+        if e.status_code in _RETRYABLE_STATUS or e.status_code >= 500:
+            return RETRYABLE
+        # Some gateways report quota exhaustion as 403.
+        if e.status_code == 403 and _QUOTA_RE.search(e.body or ""):
+            return RETRYABLE
+        return FATAL
+    if isinstance(e, (httpx.TransportError, StreamStalledError, StreamInterruptedError, TimeoutError, ConnectionError)):
+        return RETRYABLE
+    # curl failures and malformed / empty provider responses surface as RuntimeError.
+    if isinstance(e, RuntimeError):
+        return RETRYABLE
+    return FATAL
+
+
+class Deadline:
+    """Monotonic time budget; `seconds` <= 0 means unlimited."""
+
+    def __init__(self, seconds: float):
+        self.seconds = float(seconds)
+        self._expires = time.monotonic() + self.seconds if self.seconds > 0 else None
+
+    def remaining(self) -> Optional[float]:
+        if self._expires is None:
+            return None
+        return max(0.0, self._expires - time.monotonic())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def allows(self, wait_seconds: float) -> bool:
+        remaining = self.remaining()
+        return remaining is None or wait_seconds < remaining
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter: attempt n waits uniformly in [c/2, c], c = min(max, base * 2**n).
+
+    A server-provided Retry-After is honoured as a lower bound (capped at `max_retry_after_seconds`).
+    """
+
+    def __init__(
+        self,
+        *,
+        base_seconds: float = 1.0,
+        max_seconds: float = 60.0,
+        max_retry_after_seconds: float = 300.0,
+        seed: Optional[int] = None,
+    ):
+        self.base_seconds = max(0.0, float(base_seconds))
+        self.max_seconds = max(self.base_seconds, float(max_seconds))
+        self.max_retry_after_seconds = float(max_retry_after_seconds)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt: int, *, retry_after: Optional[float] = None) -> float:
+        ceiling = min(self.max_seconds, self.base_seconds * (2 ** max(0, int(attempt))))
+        with self._lock:
+            delay = self._random.uniform(ceiling / 2, ceiling)
+        if retry_after is not None:
+            delay = max(delay, min(max(retry_after, 0.5), self.max_retry_after_seconds))
+        return delay
+
+
+class CircuitBreaker:
+    """Fail calls fast after `failure_threshold` consecutive endpoint-level failures.
+
+    While open, calls raise CircuitOpenError. After `reset_seconds` one trial call is let through (half-open):
+    success closes the circuit, failure re-opens it for twice as long (up to `max_reset_seconds`).
+    """
+
+    def __init__(self, *, failure_threshold: int = 5, reset_seconds: float = 60.0, max_reset_seconds: float = 600.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.base_reset_seconds = max(1.0, float(reset_seconds))
+        self.max_reset_seconds = max(self.base_reset_seconds, float(max_reset_seconds))
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._reset_seconds = self.base_reset_seconds
+        self._open_until = 0.0
+        self._half_open = False
+        self._probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._open_until > 0
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self._open_until <= 0:
+                return
+            now = time.monotonic()
+            if now >= self._open_until and not self._probe_in_flight:
+                self._half_open = True
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+            wait = max(0.0, self._open_until - now)
+            raise CircuitOpenError(f"circuit open after {self._failures} consecutive failures (retry in {wait:.0f}s)")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+            self._reset_seconds = self.base_reset_seconds
+            self._half_open = False
+            self._probe_in_flight = False
+
+    def record_failure(self) -> float:
+        """Count one endpoint-level failure; returns the open duration when this failure opened the circuit."""
+        with self._lock:
+            self._failures += 1
+            if self._half_open:
+                self._reset_seconds = min(self.max_reset_seconds, self._reset_seconds * 2)
+            elif self._failures < self.failure_threshold or self._open_until > 0:
+                return 0.0
+            self._half_open = False
+            self._probe_in_flight = False
+            self._open_until = time.monotonic() + self._reset_seconds
+            self.opened += 1
+            return self._reset_seconds
+
+    def record_neutral(self) -> None:
+        """The call ended without telling anything about endpoint health (e.g. it was cancelled)."""
+        with self._lock:
+            if self._probe_in_flight:
+                self._probe_in_flight = False
+                self._half_open = False
+                self._open_until = time.monotonic()
+
+    def summary(self) -> str:
+        with self._lock:
+            state = "open" if self._open_until > 0 else "closed"
+            return f"state={state} opened={self.opened} rejected_calls={self.rejected}"
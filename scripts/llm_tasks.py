@@ -0,0 +1,60 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterable
+
+# Pipeline steps that can be routed separately; "default" applies to every step without its own entry.
+TASKS = (
+    "gate",  # should_update_docs YES/NO
+    "diff_summary",  # summary of a large diff before doc update
+    "doc_update",  # incremental page create/update
+    "bootstrap_docs",  # single-call bootstrap (legacy path)
+    "repo_map",
+    "dir_analysis",
+    "doc_plan",
+    "doc_page",
+    "api_page",
+)
+
+
+@dataclass
+class TaskRoute:
+    model: str = ""  # "" = MODEL_NAME
+    endpoint: str = ""  # LLM_ENDPOINTS name; "" = the whole pool
+    max_tokens: int = 0  # 0 = the step's own max_tokens
+
+
+def load_task_profile(raw: str, *, endpoint_names: Iterable[str]) -> Dict[str, TaskRoute]:
+    """Parse LLM_TASK_PROFILE: a JSON object (or a path to a JSON file) mapping task -> route.
+
+    A route is {"model", "endpoint", "max_tokens"} or just a model name, e.g.
+    {"gate": "gemini-2.5-flash-lite", "dir_analysis": {"model": "gemini-2.5-flash", "max_tokens": 4096}}.
+    """
+    raw = (raw or "").strip()
+    if not raw:
+        return {}
+    if not raw.startswith("{"):
+        with open(raw, "r", encoding="utf-8") as f:
+            raw = f.read()
+    items = json.loads(raw)
+    if not isinstance(items, dict):
+        raise ValueError("LLM_TASK_PROFILE must be a JSON object")
+
+    names = set(endpoint_names)
+    routes: Dict[str, TaskRoute] = {}
+    for task, item in items.items():
+        if task != "default" and task not in TASKS:
+            raise ValueError(f"LLM_TASK_PROFILE: unknown task {task!r} (expected one of: default, {', '.join(TASKS)})")
+        if isinstance(item, str):
+            item = {"model": item}
+        if not isinstance(item, dict):
+            raise ValueError(f"LLM_TASK_PROFILE[{task}] must be a model name or an object")
+        route = TaskRoute(
+            model=str(item.get("model") or "").strip(),
+            endpoint=str(item.get("endpoint") or "").strip(),
+            max_tokens=max(0, int(item.get("max_tokens") or 0)),
+        )
+        if route.endpoint and route.endpoint not in names:
+            raise ValueError(f"LLM_TASK_PROFILE[{task}]: endpoint {route.endpoint!r} is not in LLM_ENDPOINTS")
+        routes[task] = route
+    return routes
+
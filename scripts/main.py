@@ -1,17 +1,25 @@
 import argparse
+import asyncio
+import functools
+import hashlib
+import json
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from config import config
 from doc_gen import DocGenerator
 from monitor import GitHubMonitor
+from pipeline_dag import CheckpointStore, Pipeline
+from token_estimator import resolve_token_budget
 
 
 class MainController:
+    _PLUGIN_API_CATEGORY = "plugin_system/api"
+
     def __init__(self):
         self.monitor = GitHubMonitor()
         self.doc_gen = DocGenerator()
@@ -19,13 +27,12 @@ class MainController:
         self.ai_changes = []
         self.docs_root = config.DOCS_ROOT
         self.bootstrap_mode = False
+        self.resume = False
 
-    def _get_llm_max_context_chars(self) -> int:
-        raw = os.getenv("LLM_MAX_CONTEXT_CHARS") or os.getenv("BOOTSTRAP_MAX_CONTEXT_CHARS") or "120000"
-        try:
-            return max(8000, int(raw))
-        except Exception:
-            return 120000
+    def _get_llm_max_context_tokens(self) -> int:
+        legacy_env = "LLM_MAX_CONTEXT_CHARS" if os.getenv("LLM_MAX_CONTEXT_CHARS") else "BOOTSTRAP_MAX_CONTEXT_CHARS"
+        requested = resolve_token_budget("LLM_MAX_CONTEXT_TOKENS", legacy_env, 40000, minimum=2500)
+        return self.doc_gen.input_token_budget(requested)
 
     def _get_bootstrap_max_pages(self) -> int:
         raw = os.getenv("BOOTSTRAP_MAX_PAGES") or "60"
@@ -34,6 +41,26 @@ class MainController:
         except Exception:
             return 60
 
+    def _get_bootstrap_analysis_unit(self) -> str:
+        # Per-file analyses are still made several files per call (see _get_bootstrap_files_per_call), so a cold
+        # bootstrap costs about as many calls as per directory, and a rebootstrap only reanalyzes the changed files.
+        unit = (os.getenv("BOOTSTRAP_ANALYSIS_UNIT") or "file").strip().lower()
+        return unit if unit in {"file", "dir"} else "file"
+
+    def _get_bootstrap_files_per_call(self) -> int:
+        raw = os.getenv("BOOTSTRAP_FILES_PER_CALL") or "8"
+        try:
+            return max(1, int(raw))
+        except Exception:
+            return 8
+
+    def _get_bootstrap_concurrency(self) -> int:
+        raw = os.getenv("BOOTSTRAP_CONCURRENCY") or "4"
+        try:
+            return max(1, int(raw))
+        except Exception:
+            return 4
+
     def _clone_upstream_repo(self, dest_dir: str, *, branch: str, head_sha: str = "") -> str:
         """Clone upstream repo (shallow) to a local directory for bootstrap scanning."""
         repo_name = (config.REPO_NAME or "").strip()
@@ -56,19 +83,31 @@ class MainController:
             raise RuntimeError(f"Failed to clone {repo_url}@{branch}: {e}") from e
 
         if head_sha:
-            try:
-                subprocess.run(
-                    ["git", "-C", dest_dir, "checkout", head_sha],
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT,
-                )
-            except Exception:
-                # Best-effort: HEAD should normally match the API-reported head sha.
-                pass
+            # Best-effort: HEAD normally matches the API-reported head sha. A resumed bootstrap may ask for an older
+            # commit, which a depth-1 clone only has after fetching it.
+            for cmd in (["checkout", head_sha], ["fetch", "--depth", "1", "origin", head_sha], ["checkout", head_sha]):
+                try:
+                    subprocess.run(
+                        ["git", "-C", dest_dir, *cmd],
+                        check=True,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.STDOUT,
+                    )
+                except Exception:
+                    continue
+                if cmd[0] == "checkout":
+                    break
 
         return dest_dir
 
+    def _repo_head_sha(self, repo_dir: str) -> str:
+        try:
+            return subprocess.run(
+                ["git", "-C", repo_dir, "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+            ).stdout.strip()
+        except Exception:
+            return ""
+
     def _iter_upstream_files(self, repo_dir: str) -> List[str]:
         """List all files in repo_dir applying user-specified bootstrap filters."""
         exclude_dir_names = {
@@ -123,22 +162,17 @@ class MainController:
         except Exception:
             return True
 
-    def _read_text_file_parts(self, repo_dir: str, rel_path: str, *, part_chars: int) -> List[str]:
+    def _read_text_file_parts(self, repo_dir: str, rel_path: str, *, part_tokens: int) -> List[str]:
         abs_path = os.path.join(repo_dir, rel_path)
         if self._is_binary_file(abs_path):
             return []
 
-        parts: List[str] = []
         try:
             with open(abs_path, "r", encoding="utf-8", errors="replace") as f:
-                while True:
-                    chunk = f.read(part_chars)
-                    if not chunk:
-                        break
-                    parts.append(chunk)
+                text = f.read()
         except Exception:
             return []
-        return parts
+        return self.doc_gen.tokens.split(text, part_tokens)
 
     def _build_directory_chunks(
         self,
@@ -146,16 +180,20 @@ class MainController:
         repo_dir: str,
         dir_path: str,
         files: List[str],
-        repo_map_text: str,
-        max_context_chars: int,
+        max_context_tokens: int,
+        overhead_tokens: int,
+        max_files: int = 0,
     ) -> List[Dict[str, Any]]:
-        fixed_overhead = 12000 + len(repo_map_text) + len(dir_path) * 4
-        budget = max(2000, max_context_chars - fixed_overhead)
-        part_chars = max(2000, int(budget * 0.7))
+        """Pack the files of a directory into chunks within the context budget, and at most `max_files` files each."""
+        tokens = self.doc_gen.tokens
+        # Leave room for the per-chunk header (directory, chunk index, file list) added after packing.
+        header_reserve = 50 + tokens.count("\n".join(files))
+        budget = max(700, max_context_tokens - overhead_tokens - header_reserve)
+        part_tokens = max(700, int(budget * 0.7))
 
         file_blocks: List[Tuple[str, int, int, str]] = []
         for rel_path in files:
-            parts = self._read_text_file_parts(repo_dir, rel_path, part_chars=part_chars)
+            parts = self._read_text_file_parts(repo_dir, rel_path, part_tokens=part_tokens)
             if not parts:
                 continue
             total = len(parts)
@@ -176,6 +214,9 @@ class MainController:
             current_files = []
             current_len = 0
 
+        def full(rel_path: str) -> bool:
+            return bool(max_files) and rel_path not in current_files and len(set(current_files)) >= max_files
+
         for rel_path, part_index, part_total, text in file_blocks:
             block_lines = [
                 f"--- File: {rel_path} (part {part_index}/{part_total}) ---",
@@ -184,35 +225,31 @@ class MainController:
                 "```",
                 "",
             ]
-            block_text = "\n".join(block_lines)
-            if len(block_text) > budget and text:
+            block_tokens = tokens.count("\n".join(block_lines))
+            if block_tokens > budget and text:
                 # As a safety valve, hard-split oversized parts.
-                split_size = max(1000, int(budget * 0.6))
-                start = 0
-                while start < len(text):
-                    sub = text[start : start + split_size]
+                for sub_index, sub in enumerate(tokens.split(text, max(350, int(budget * 0.6))), start=1):
                     sub_lines = [
-                        f"--- File: {rel_path} (part {part_index}/{part_total}, sub {start // split_size + 1}) ---",
+                        f"--- File: {rel_path} (part {part_index}/{part_total}, sub {sub_index}) ---",
                         "```text",
                         sub.rstrip("\n"),
                         "```",
                         "",
                     ]
-                    sub_text = "\n".join(sub_lines)
-                    if current_len + len(sub_text) > budget and current_lines:
+                    sub_tokens = tokens.count("\n".join(sub_lines))
+                    if (current_len + sub_tokens > budget or full(rel_path)) and current_lines:
                         flush()
                     current_lines.extend(sub_lines)
                     current_files.append(rel_path)
-                    current_len += len(sub_text)
-                    start += split_size
+                    current_len += sub_tokens
                 continue
 
-            if current_len + len(block_text) > budget and current_lines:
+            if (current_len + block_tokens > budget or full(rel_path)) and current_lines:
                 flush()
 
             current_lines.extend(block_lines)
             current_files.append(rel_path)
-            current_len += len(block_text)
+            current_len += block_tokens
 
         flush()
 
@@ -320,11 +357,8 @@ class MainController:
 
     def _build_repo_context(self, *, head_sha: str, repo_dir: str, tree_paths: List[str]) -> str:
         """Build bootstrap context by scanning the whole repo with strict filters (no upstream docs/config noise)."""
-        max_total_chars = int(
-            os.getenv("LLM_MAX_CONTEXT_CHARS")
-            or os.getenv("BOOTSTRAP_MAX_CONTEXT_CHARS", "120000")
-            or "120000"
-        )
+        max_total_tokens = self._get_llm_max_context_tokens()
+        tokens = self.doc_gen.tokens
         max_file_bytes = int(os.getenv("BOOTSTRAP_MAX_FILE_BYTES", "60000") or "60000")
         max_sig_lines = int(os.getenv("BOOTSTRAP_MAX_SIG_LINES_PER_FILE", "60") or "60")
 
@@ -335,15 +369,16 @@ class MainController:
             top_level.setdefault(top, []).append(p)
 
         lines: List[str] = []
-        total_chars = 0
+        total_tokens = 0.0
 
         def add(line: str) -> bool:
-            nonlocal total_chars
+            nonlocal total_tokens
             line = line.rstrip("\n")
-            if total_chars + len(line) + 1 > max_total_chars:
+            line_tokens = tokens.estimate(line + "\n")
+            if total_tokens + line_tokens > max_total_tokens:
                 return False
             lines.append(line)
-            total_chars += len(line) + 1
+            total_tokens += line_tokens
             return True
 
         add(f"Repo: {config.REPO_NAME}")
@@ -465,21 +500,21 @@ class MainController:
                     "dir": dir_path,
                     "files_count": len(agg["files"]),
                     "public_contracts": sorted(agg["public"])[:30],
-                    "summary": "\n".join(agg["summary"])[:1600],
+                    "summary": self.doc_gen.tokens.truncate("\n".join(agg["summary"]), 500),
                     "evidence": sorted(agg["evidence"])[:20],
                 }
             )
         return briefs
 
-    def _generate_plugin_api_docs(self, *, repo_dir: str, repo_map: Dict) -> None:
+    def _plugin_api_modules(self, repo_dir: str) -> List[Tuple[str, str, str]]:
+        """(module path, module source, page file name) for every module under src/plugin_system/apis."""
         apis_dir = os.path.join(repo_dir, "src", "plugin_system", "apis")
         if not os.path.isdir(apis_dir):
-            return
-
-        target_category = "plugin_system/api"
-        os.makedirs(os.path.join(self.docs_root, target_category), exist_ok=True)
+            return []
 
-        generated: List[str] = []
+        # The page prompt also carries the repo map and instructions; keep the module source within half the budget.
+        module_budget = max(2000, self._get_llm_max_context_tokens() // 2)
+        modules: List[Tuple[str, str, str]] = []
         for filename in sorted(os.listdir(apis_dir)):
             if not filename.endswith(".py"):
                 continue
@@ -489,15 +524,16 @@ class MainController:
             module_text = self._read_repo_file_text(repo_dir, module_rel, max_bytes=200000)
             if not module_text.strip():
                 continue
+            module_text = self.doc_gen.tokens.truncate(module_text, module_budget)
+            modules.append((module_rel, module_text, filename[:-3] + ".md"))
+        return modules
 
-            md_name = filename[:-3] + ".md"
-            page = self.doc_gen.generate_plugin_api_doc_page(
-                repo_map=repo_map,
-                module_path=module_rel,
-                module_text=module_text,
-                target_category=target_category,
-                file_name=md_name,
-            )
+    def _write_plugin_api_docs(self, modules: List[Tuple[str, str, str]], pages: List[Optional[Dict]]) -> None:
+        target_category = self._PLUGIN_API_CATEGORY
+        os.makedirs(os.path.join(self.docs_root, target_category), exist_ok=True)
+
+        generated: List[str] = []
+        for (_, _, md_name), page in zip(modules, pages):
             if not page:
                 continue
             out_path = self.doc_gen.write_markdown(
@@ -529,6 +565,323 @@ class MainController:
             f.write("\n".join(index_lines))
         self.updated_files.add(index_path)
 
+    def _blob_shas(self, repo_dir: str) -> Dict[str, str]:
+        """Git blob sha of every file in the clone's HEAD, by repo-relative path."""
+        try:
+            out = subprocess.run(
+                ["git", "-C", repo_dir, "ls-tree", "-r", "-z", "HEAD"], check=True, capture_output=True
+            ).stdout
+        except Exception:
+            return {}
+        blobs: Dict[str, str] = {}
+        for entry in out.split(b"\0"):
+            meta, _, path = entry.partition(b"\t")
+            parts = meta.split()
+            if len(parts) == 3 and parts[1] == b"blob":
+                blobs[path.decode("utf-8", errors="surrogateescape")] = parts[2].decode("ascii")
+        return blobs
+
+    @staticmethod
+    def _dir_content_key(files: List[str], blobs: Dict[str, str]) -> str:
+        """Hash of the blob shas of the files stage 2 analyzes in one directory (its direct files).
+
+        Unlike the directory's own tree sha this ignores subdirectories, which stage 2 analyzes separately, so a
+        change deep in the tree does not invalidate every parent.
+        """
+        shas = [blobs.get(p) for p in files]
+        if not files or not all(shas):
+            return ""
+        listing = "\n".join(f"{sha} {p}" for sha, p in zip(shas, files))
+        return hashlib.sha256(listing.encode("utf-8", errors="surrogateescape")).hexdigest()
+
+    def _compose_dir_analysis(self, dir_path: str, analyses: List[Optional[Dict]]) -> Optional[Dict]:
+        """Merge the per-file stage-2 analyses of one directory into one analysis of the same shape (no LLM call)."""
+        items = [a for a in analyses if isinstance(a, dict)]
+        if not items:
+            return None
+
+        def merged(key: str, limit: int) -> List[Any]:
+            seen: Dict[str, Any] = {}
+            for item in items:
+                for value in item.get(key) or []:
+                    seen.setdefault(json.dumps(value, ensure_ascii=False, sort_keys=True), value)
+            return list(seen.values())[:limit]
+
+        summary_lines: List[str] = []
+        limitations: List[str] = []
+        for item in items:
+            files = ", ".join(item.get("files") or []) or dir_path
+            summary = (item.get("summary") or "").strip()
+            if summary:
+                summary_lines.append(f"- {files}: {summary}")
+            limitation = (item.get("limitations") or "").strip()
+            if limitation and limitation not in limitations:
+                limitations.append(limitation)
+        return {
+            "dir": dir_path,
+            "chunk_index": 1,
+            "chunk_total": 1,
+            "files": sorted({f for item in items for f in item.get("files") or [] if isinstance(f, str)}),
+            "summary": self.doc_gen.tokens.truncate("\n".join(summary_lines), 2000),
+            "public_contracts": merged("public_contracts", 30),
+            "key_components": merged("key_components", 30),
+            "configs": merged("configs", 20),
+            "dependencies": merged("dependencies", 20),
+            "risks": merged("risks", 10),
+            "limitations": "\n".join(limitations),
+            "evidence": merged("evidence", 20),
+        }
+
+    def _bootstrap_checkpoints(self, head_sha: str) -> Tuple[CheckpointStore, str]:
+        """Checkpoint store of this repo/branch, and the head to bootstrap (the checkpointed one on --resume)."""
+        root = (os.getenv("BOOTSTRAP_CHECKPOINT_DIR") or ".cache/bootstrap_checkpoints").strip()
+        store = CheckpointStore(os.path.join(root, f"{config.REPO_NAME.replace('/', '-')}-{config.UPSTREAM_BRANCH}"))
+        saved_head = store.saved_head()
+        if self.resume and saved_head:
+            if head_sha and saved_head != head_sha:
+                print(f"♻️ 续跑 {saved_head[:7]} 的 bootstrap 检查点（上游已更新到 {head_sha[:7]}，本次仍以检查点为准）。")
+            else:
+                print(f"♻️ 续跑 {saved_head[:7]} 的 bootstrap 检查点。")
+            return store, saved_head
+        if self.resume:
+            print("ℹ️ 未找到可续跑的 bootstrap 检查点，从头开始。")
+        store.reset(head_sha)
+        return store, head_sha
+
+    @staticmethod
+    def _page_node(index: int, spec: Dict) -> str:
+        return f"page:{index}:{spec.get('target_category') or ''}/{spec.get('file_name') or ''}"
+
+    @staticmethod
+    def _chunk_ref(unit: str, spec: Dict) -> str:
+        """Checkpoint name of one stage-2 chunk of a unit.
+
+        The packing is recomputed on --resume from a token scale and budget the interrupted run may have updated,
+        so the name covers the chunk's content: a chunk packed differently gets a new name and runs again instead
+        of being restored next to chunks of the new packing.
+        """
+        digest = hashlib.sha1(json.dumps(spec, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        return f"{unit}#{spec['chunk_index']}-{digest}"
+
+    def _run_bootstrap_pipeline(
+        self,
+        *,
+        repo_dir: str,
+        tree_paths: List[str],
+        repo_context: str,
+        plugin_api_modules: List[Tuple[str, str, str]],
+        store: CheckpointStore,
+    ) -> Dict[str, Any]:
+        """Bootstrap stages 1-4 as one DAG (see pipeline_dag); returns the results by node name.
+
+        repo_map -> one node per directory chunk -> plan -> one node per page, and one node per plugin API module
+        that only needs repo_map. In batch mode each provider batch (all chunks, all API modules) is one node.
+        With BOOTSTRAP_ANALYSIS_UNIT=file (the default) each file gets its own analysis, stored under its blob sha: the
+        files of a directory that are not in the analysis store are packed several per call, the answer is split per
+        file, and the analyses of a directory are merged by _compose_dir_analysis. Files or directories found in the
+        analysis store skip the LLM: their chunk nodes just return the stored analyses.
+        """
+        max_context_tokens = self._get_llm_max_context_tokens()
+        max_pages = self._get_bootstrap_max_pages()
+        batch_mode = self.doc_gen.batch_mode
+        dag = Pipeline(limit=self._get_bootstrap_concurrency(), store=store)
+        per_file = self._get_bootstrap_analysis_unit() == "file"
+        unit_kind = "file" if per_file else "dir"
+        # A unit (a file, or a whole directory) is analyzed in chunks; in per-file mode a chunk covers several files
+        # and returns their analyses by path. A unit's results come from its chunk nodes, or from the one batch node,
+        # keyed by _chunk_ref.
+        dir_units: Dict[str, List[str]] = {}
+        unit_nodes: Dict[str, List[str]] = {}
+        batch_chunks: Dict[str, List[str]] = {}
+        batch_results: Dict[str, Optional[Dict]] = {}
+        store_keys: Dict[str, str] = {}  # unit -> analysis store key, for units analyzed in this run
+
+        def unit_analyses(unit: str) -> List[Optional[Dict]]:
+            if unit in unit_nodes:
+                results = [dag.result(node) for node in unit_nodes[unit]]
+            else:
+                results = [batch_results.get(ref) for ref in batch_chunks.get(unit, [])]
+            return [(r or {}).get(unit) for r in results] if per_file else results
+
+        def dir_summaries() -> List[Dict]:
+            summaries: List[Dict] = []
+            for dir_path, units in dir_units.items():
+                analyses = [a for unit in units for a in unit_analyses(unit)]
+                if per_file:
+                    analyses = [self._compose_dir_analysis(dir_path, analyses)]
+                summaries.extend(a for a in analyses if a)
+            return summaries
+
+        def store_units(units: List[str], _output: Any = None) -> None:
+            for unit in units:
+                if unit in unit_nodes and not all(node in dag.results for node in unit_nodes[unit]):
+                    continue
+                if unit in store_keys:
+                    self.doc_gen.store_analyses(store_keys.pop(unit), unit_analyses(unit))
+
+        def store_batch(output: Optional[Dict[str, Optional[Dict]]]) -> None:
+            batch_results.update(output or {})
+            store_units(list(batch_chunks))
+
+        async def cached(value: Any) -> Any:
+            return value
+
+        async def stage_repo_map() -> Dict:
+            return self._compact_repo_map(await asyncio.to_thread(self.doc_gen.generate_repo_map, repo_context))
+
+        def expand_repo_map(repo_map: Dict) -> None:
+            # Stage 2: Recursive per-directory analysis (direct files only; no descendant duplication), per file or per
+            # directory. Units whose content is unchanged since an earlier bootstrap (of any branch) reuse its analyses.
+            blobs = self._blob_shas(repo_dir)
+            units: List[Tuple[str, str, List[str], str]] = []  # (dir, unit, files, content key)
+            for dir_path, files in self._group_files_by_dir(tree_paths).items():
+                if per_file:
+                    units.extend((dir_path, path, [path], blobs.get(path, "")) for path in files)
+                else:
+                    units.append((dir_path, dir_path, files, self._dir_content_key(files, blobs)))
+            chunk_specs: List[Dict] = []
+            batch_refs: List[str] = []
+            pending: Dict[str, List[str]] = {}  # dir -> files of the units analyzed in this run
+            reused = 0
+            for dir_path, unit, files, content_key in units:
+                dir_units.setdefault(dir_path, []).append(unit)
+                store_key = self.doc_gen.analysis_cache_key(
+                    unit=unit_kind, path=unit, content_key=content_key, max_context_tokens=max_context_tokens
+                )
+                analyses = self.doc_gen.cached_analyses(store_key)
+                if analyses:
+                    reused += 1
+                    for idx, analysis in enumerate(analyses, start=1):
+                        node = f"{unit_kind}:{unit}#{idx}"
+                        unit_nodes.setdefault(unit, []).append(node)
+                        value = {unit: analysis} if per_file else analysis
+                        dag.add(node, functools.partial(cached, value), deps=["repo_map"], checkpoint=False)
+                    continue
+                if store_key:
+                    store_keys[unit] = store_key
+                pending.setdefault(dir_path, []).extend(files)
+            for dir_path, files in pending.items():
+                # Per file, the changed files of a directory share calls; each chunk's answer is split per file.
+                chunks = self._build_directory_chunks(
+                    repo_dir=repo_dir,
+                    dir_path=dir_path,
+                    files=files,
+                    max_context_tokens=max_context_tokens,
+                    overhead_tokens=self.doc_gen.dir_analysis_overhead_tokens(
+                        repo_map=repo_map, dir_path=dir_path, per_file=per_file
+                    ),
+                    max_files=self._get_bootstrap_files_per_call() if per_file else 0,
+                )
+                chunk_total = len(chunks) or 1
+                for idx, ch in enumerate(chunks, start=1):
+                    spec = {
+                        "dir_path": dir_path,
+                        "chunk_index": idx,
+                        "chunk_total": chunk_total,
+                        "files_block": ch["files_block"],
+                    }
+                    if per_file:
+                        spec["files"] = ch["files"]
+                    owners = ch["files"] if per_file else [dir_path]
+                    ref = self._chunk_ref(dir_path, spec)
+                    if batch_mode:
+                        for owner in owners:
+                            batch_chunks.setdefault(owner, []).append(ref)
+                        batch_refs.append(ref)
+                        chunk_specs.append(spec)
+                        continue
+                    node = f"{unit_kind}:{ref}"
+                    for owner in owners:
+                        unit_nodes.setdefault(owner, []).append(node)
+                    analyze = self.doc_gen.aanalyze_file_chunk if per_file else self.doc_gen.aanalyze_directory_chunk
+                    run = functools.partial(analyze, repo_map=repo_map, **spec)
+                    dag.add(node, run, deps=["repo_map"], expand=functools.partial(store_units, owners))
+            if self.doc_gen.dir_analysis_cache is not None:
+                noun = "文件" if per_file else "目录"
+                print(f"阶段 2：{reused}/{len(units)} 个{noun}内容未变，复用已有的分析。")
+
+            async def stage2_batch() -> Dict[str, Optional[Dict]]:
+                analyses = await asyncio.to_thread(
+                    self.doc_gen.analyze_directory_chunks_batch,
+                    repo_map=repo_map,
+                    chunks=chunk_specs,
+                    fallback_limit=self._get_bootstrap_concurrency(),
+                )
+                return dict(zip(batch_refs, analyses))
+
+            stage2 = list(dict.fromkeys(n for nodes in unit_nodes.values() for n in nodes))
+            if chunk_specs:
+                # Named after every chunk it covers, so a resumed run with a different packing submits a new batch.
+                batch_node = "dir_analysis-" + hashlib.sha1("\n".join(batch_refs).encode("utf-8")).hexdigest()[:12]
+                dag.add(batch_node, stage2_batch, deps=["repo_map"], expand=store_batch)
+                stage2.append(batch_node)
+
+            # Stage 3a: modular plan from directory briefs (needs every directory)
+            async def stage_plan() -> List[Dict]:
+                return await asyncio.to_thread(
+                    self.doc_gen.generate_bootstrap_doc_plan,
+                    repo_map=repo_map,
+                    dir_briefs=self._build_dir_briefs(dir_summaries()),
+                    max_pages=max_pages,
+                )
+
+            dag.add("plan", stage_plan, deps=["repo_map", *stage2], expand=functools.partial(expand_plan, repo_map))
+
+            # Stage 4: Plugin system API docs (LLM per module; only needs the RepoMap)
+            modules = [
+                {
+                    "module_path": module_rel,
+                    "module_text": module_text,
+                    "target_category": self._PLUGIN_API_CATEGORY,
+                    "file_name": md_name,
+                }
+                for module_rel, module_text, md_name in plugin_api_modules
+            ]
+            if batch_mode and modules:
+                dag.add(
+                    "plugin_api",
+                    functools.partial(
+                        asyncio.to_thread,
+                        self.doc_gen.generate_plugin_api_doc_pages_batch,
+                        repo_map=repo_map,
+                        modules=modules,
+                        fallback_limit=self._get_bootstrap_concurrency(),
+                    ),
+                    deps=["repo_map"],
+                )
+            elif not batch_mode:
+                for module in modules:
+                    run = functools.partial(self.doc_gen.agenerate_plugin_api_doc_page, repo_map=repo_map, **module)
+                    dag.add(f"api:{module['module_path']}", run, deps=["repo_map"])
+
+        def expand_plan(repo_map: Dict, plan: List[Dict]) -> None:
+            if not plan:
+                # Fallback: keep the original single-pass bootstrap behavior. It writes its pages itself, so it is
+                # not checkpointed.
+                dag.add(
+                    "fallback_docs",
+                    functools.partial(asyncio.to_thread, self.doc_gen.generate_bootstrap_docs, repo_context),
+                    deps=["plan"],
+                    checkpoint=False,
+                )
+                return
+            # Stage 3b: one page per spec, as soon as its source directories are analyzed
+            summaries = dir_summaries()
+            for i, spec in enumerate(plan):
+                source_dirs = [d for d in spec.get("source_dirs") or [] if isinstance(d, str)]
+                units = [u for d in source_dirs for u in dir_units.get(d.strip(), [])]
+                deps = ["plan", *dict.fromkeys(n for u in units for n in unit_nodes.get(u, []))]
+                run = functools.partial(
+                    self.doc_gen.agenerate_bootstrap_doc_page, repo_map=repo_map, dir_summaries=summaries, spec=spec
+                )
+                dag.add(self._page_node(i, spec), run, deps=deps)
+
+        dag.add("repo_map", stage_repo_map, expand=expand_repo_map)
+        try:
+            return self.doc_gen.run_async(dag.run)
+        finally:
+            print(f"🧩 bootstrap 流水线: {dag.summary()}")
+
     def _write_snapshot_indexes(self) -> None:
         snapshots_root = os.path.join(self.docs_root, "snapshots")
         if not os.path.isdir(snapshots_root):
@@ -624,104 +977,68 @@ class MainController:
     def run(self, force_latest: bool = False) -> None:
         print("=== LLM 文档自动化同步开始 ===")
         try:
+            self.doc_gen.ensure_capability_profile()
             if self.bootstrap_mode:
                 head_sha = self.monitor.get_head_sha()
-                max_context_chars = self._get_llm_max_context_chars()
-                max_pages = self._get_bootstrap_max_pages()
-                repo_context = ""
-                repo_map: Dict = {}
-                dir_summaries: List[Dict] = []
+                store, head_sha = self._bootstrap_checkpoints(head_sha)
                 with tempfile.TemporaryDirectory(
                     prefix=f"upstream-{config.REPO_NAME.replace('/', '-')}-{config.UPSTREAM_BRANCH}-"
                 ) as tmp_dir:
                     repo_dir = os.path.join(tmp_dir, "repo")
                     self._clone_upstream_repo(repo_dir, branch=config.UPSTREAM_BRANCH, head_sha=head_sha)
+                    cloned_sha = self._repo_head_sha(repo_dir)
+                    if cloned_sha and head_sha and cloned_sha != head_sha:
+                        print(f"⚠️ 无法检出 {head_sha[:7]}，检查点作废，改用 {cloned_sha[:7]} 从头开始。")
+                        head_sha = cloned_sha
+                        store.reset(head_sha)
                     tree_paths = self._iter_upstream_files(repo_dir)
-
-                    # Stage 1: RepoMap
+                    self.doc_gen.build_evidence_index(repo_dir)
                     repo_context = self._build_repo_context(head_sha=head_sha, repo_dir=repo_dir, tree_paths=tree_paths)
-                    repo_map = self.doc_gen.generate_repo_map(repo_context)
-                    repo_map = self._compact_repo_map(repo_map)
-
-                    # Stage 2: Recursive per-directory analysis (direct files only; no descendant duplication)
-                    dir_to_files = self._group_files_by_dir(tree_paths)
-                    repo_map_text = str(repo_context)
-                    try:
-                        import json as _json
-
-                        repo_map_text = _json.dumps(repo_map or {}, ensure_ascii=False)
-                    except Exception:
-                        repo_map_text = str(repo_map or "")
-
-                    for dir_path, files in dir_to_files.items():
-                        chunks = self._build_directory_chunks(
-                            repo_dir=repo_dir,
-                            dir_path=dir_path,
-                            files=files,
-                            repo_map_text=repo_map_text,
-                            max_context_chars=max_context_chars,
-                        )
-                        chunk_total = len(chunks) or 1
-                        for idx, ch in enumerate(chunks, start=1):
-                            analysis = self.doc_gen.analyze_directory_chunk(
-                                repo_map=repo_map,
-                                dir_path=dir_path,
-                                chunk_index=idx,
-                                chunk_total=chunk_total,
-                                files_block=ch["files_block"],
-                            )
-                            if analysis:
-                                dir_summaries.append(analysis)
+                    plugin_api_modules = self._plugin_api_modules(repo_dir)
+                    results = self._run_bootstrap_pipeline(
+                        repo_dir=repo_dir,
+                        tree_paths=tree_paths,
+                        repo_context=repo_context,
+                        plugin_api_modules=plugin_api_modules,
+                        store=store,
+                    )
 
                 latest_tag = self.monitor.get_latest_tag_name() if config.ENABLE_SNAPSHOTS else ""
                 self.monitor.save_state({"last_commit_sha": head_sha, "last_tag": latest_tag})
 
-                # Stage 3: Generate docs from directory summaries (modular plan -> pages)
-                dir_briefs = self._build_dir_briefs(dir_summaries)
-                plan = self.doc_gen.generate_bootstrap_doc_plan(
-                    repo_map=repo_map,
-                    dir_briefs=dir_briefs,
-                    max_pages=max_pages,
-                )
-
-                if plan:
-                    for spec in plan:
-                        page = self.doc_gen.generate_bootstrap_doc_page(
-                            repo_map=repo_map,
-                            dir_summaries=dir_summaries,
-                            spec=spec,
-                        )
-                        if not page:
-                            continue
-                        file_path = self.doc_gen.write_markdown(
-                            target_category=page["target_category"],
-                            file_name=page["file_name"],
-                            content=page["content"],
-                        )
+                # Stage 3: write pages in plan order
+                plan = results.get("plan") or []
+                for i, spec in enumerate(plan):
+                    page = results.get(self._page_node(i, spec))
+                    if not page:
+                        continue
+                    file_path = self.doc_gen.write_markdown(
+                        target_category=page["target_category"],
+                        file_name=page["file_name"],
+                        content=page["content"],
+                    )
+                    self.updated_files.add(file_path)
+                    self.ai_changes.append(
+                        {
+                            "file_path": file_path,
+                            "action": "create",
+                            "title": spec.get("title") or page.get("file_name") or "",
+                        }
+                    )
+                for item in results.get("fallback_docs") or []:
+                    # Written by the single-pass fallback itself.
+                    file_path = item.get("file_path")
+                    if file_path:
                         self.updated_files.add(file_path)
-                        self.ai_changes.append(
-                            {
-                                "file_path": file_path,
-                                "action": "create",
-                                "title": spec.get("title") or page.get("file_name") or "",
-                            }
-                        )
+                        self.ai_changes.append(item)
+
+                # Stage 4: plugin system API pages
+                if self.doc_gen.batch_mode:
+                    api_pages = results.get("plugin_api") or [None] * len(plugin_api_modules)
                 else:
-                    # Fallback: keep the original single-pass bootstrap behavior.
-                    created = self.doc_gen.generate_bootstrap_docs(repo_context)
-                    for item in created:
-                        file_path = item.get("file_path")
-                        if file_path:
-                            self.updated_files.add(file_path)
-                            self.ai_changes.append(item)
-
-                # Stage 4: Plugin system API docs (LLM per module)
-                with tempfile.TemporaryDirectory(
-                    prefix=f"upstream-api-{config.REPO_NAME.replace('/', '-')}-{config.UPSTREAM_BRANCH}-"
-                ) as api_tmp:
-                    api_repo = os.path.join(api_tmp, "repo")
-                    self._clone_upstream_repo(api_repo, branch=config.UPSTREAM_BRANCH, head_sha=head_sha)
-                    self._generate_plugin_api_docs(repo_dir=api_repo, repo_map=repo_map)
+                    api_pages = [results.get(f"api:{module_rel}") for module_rel, _, _ in plugin_api_modules]
+                if plugin_api_modules:
+                    self._write_plugin_api_docs(plugin_api_modules, api_pages)
 
                 self.output_summary([{"type": "bootstrap", "sha": head_sha}])
                 return
@@ -746,6 +1063,10 @@ class MainController:
         except Exception as e:
             print(f"💥 主循环出现严重错误：{e}")
             sys.exit(1)
+        finally:
+            self.doc_gen.save_llm_profile()
+            self.doc_gen.evict_llm_cache()
+            self.doc_gen.report_llm_metrics()
         print("=== LLM 文档自动化同步完成 ===")
 
     def output_summary(self, updates: List[Dict]) -> None:
@@ -806,8 +1127,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="MaiBot Docs Automation")
     parser.add_argument("--force-latest", action="store_true", help="Force sync with the latest commit")
     parser.add_argument("--bootstrap", action="store_true", help="Generate initial docs baseline from repo snapshot")
+    parser.add_argument(
+        "--resume", action="store_true", help="With --bootstrap: continue from the checkpoints of an interrupted run"
+    )
     args = parser.parse_args()
 
     controller = MainController()
     controller.bootstrap_mode = bool(args.bootstrap)
+    controller.resume = bool(args.resume)
     controller.run(force_latest=args.force_latest)
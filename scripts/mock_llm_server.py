@@ -0,0 +1,803 @@
+"""Local stand-in for an LLM endpoint, for exercising the sync pipeline without a real provider.
+
+Speaks the OpenAI protocol (/v1/chat/completions, streaming included, plus the /v1/files and /v1/batches
+endpoints used by LLM_BATCH_MODE) and the Gemini protocol (models/*:generateContent, :streamGenerateContent,
+cachedContents). Replies are schema-valid JSON for the DocGenerator `_schema_*` shapes, filled with paths and
+parameters taken from the prompt so the bootstrap validators accept them; plain prompts get "OK" / "YES".
+
+Faults can be injected to exercise the retry, failover and repair paths: a latency distribution, random 5xx,
+periodic 429 bursts (with Retry-After), an RPM limit, response_format/responseSchema rejection, truncated
+(mid-JSON) output (a follow-up turn after the model's own reply continues it), the formatting slips of
+unconstrained JSON (replies made without a schema or JSON mode), and replies that break the validators' content
+rules (a repair turn that quotes the rejected output gets them fixed).
+
+    python scripts/mock_llm_server.py --port 8089 --latency-p50 0.5 --latency-p99 4 --error-rate 0.05
+    BASE_URL=http://127.0.0.1:8089/v1 LLM_API_STYLE=openai GEMINI_API_KEY=dummy python scripts/main.py --bootstrap
+    BASE_URL=http://127.0.0.1:8089 LLM_API_STYLE=gemini GEMINI_API_KEY=dummy python scripts/test_api.py
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# Relative paths / file names, used as evidence that appears verbatim in the prompt.
+_PATH_RE = re.compile(r"(?<![\w./-])((?:[\w.-]+/)+[\w.-]*\w|[\w-]+\.(?:py|pyi|js|ts|go|rs|java|json|toml|md))(?![\w/])")
+_GEMINI_PATH_RE = re.compile(r"^/v1(?:beta)?/models/([^/:]+):(generateContent|streamGenerateContent)$")
+_GEMINI_STATUS = {400: "INVALID_ARGUMENT", 429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+_DEFAULT_SECTIONS = ["## 概述", "## 目录/结构", "## 适用范围", "## 变更影响分析", "## 证据"]
+_SCHEMAS: Optional[List[Tuple[str, Dict[str, Any]]]] = None
+# Opens the rejected output in DocGenerator repair prompts.
+_REPAIR_MARKER = "--- 上一次的输出 ---"
+
+
+def example_from_schema(schema: Dict[str, Any], hints: Optional[Dict[str, Any]] = None, name: str = "") -> Any:
+    """Smallest instance that satisfies a (strict, OpenAI-subset or Gemini) JSON schema.
+
+    `hints` maps property names to values taken from the prompt; they are used as-is.
+    """
+    hints = hints or {}
+    if name and name in hints:
+        return hints[name]
+    if not isinstance(schema, dict):
+        return None
+    if "enum" in schema:
+        return (schema.get("enum") or [None])[0]
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    kind = str(kind or "").lower()
+    if kind == "object":
+        props = schema.get("properties") or {}
+        return {key: example_from_schema(sub, hints, key) for key, sub in props.items()}
+    if kind == "array":
+        return [example_from_schema(schema.get("items") or {}, hints) for _ in range(int(schema.get("minItems") or 0))]
+    if kind == "string":
+        return f"mock {name}" if name else "example"
+    if kind in {"integer", "number"}:
+        return schema.get("minimum", 0)
+    if kind == "boolean":
+        return False
+    return None
+
+
+def _docgen_schemas() -> List[Tuple[str, Dict[str, Any]]]:
+    """The DocGenerator `_schema_*` shapes (empty when doc_gen cannot be imported)."""
+    global _SCHEMAS
+    if _SCHEMAS is None:
+        try:
+            from doc_gen import DocGenerator
+        except Exception:
+            _SCHEMAS = []
+        else:
+            # The schema builders use no instance state, so an uninitialized instance will do.
+            bare = DocGenerator.__new__(DocGenerator)
+            _SCHEMAS = [
+                (name[len("_schema_"):], getattr(DocGenerator, name)(bare))
+                for name in sorted(dir(DocGenerator))
+                if name.startswith("_schema_")
+            ]
+    return _SCHEMAS
+
+
+def _task_text(prompt: str) -> str:
+    # Bootstrap prompts open with the shared RepoMap block; the per-stage rules and data follow it.
+    return prompt.split("--- End RepoMap ---", 1)[-1]
+
+
+def infer_schema(prompt: str) -> Optional[Dict[str, Any]]:
+    """Guess which DocGenerator schema a prompt asks for, from the output keys its rules list."""
+    task = _task_text(prompt)
+    wants_array = "JSON 数组" in task
+    best: Optional[Tuple[Tuple[bool, int], Dict[str, Any]]] = None
+    for _, schema in _docgen_schemas():
+        is_array = schema.get("type") == "array"
+        keys = (schema.get("items") if is_array else schema).get("required") or []
+        # Keys count only where the rules list them ("- key: ..." bullets or "... key：a, b"), not inside embedded JSON.
+        if not keys or not all(re.search(rf"^\s*- {k}\b|key：.*\b{k}\b", task, re.M) for k in keys):
+            continue
+        score = (is_array == wants_array, len(keys))
+        if best is None or score > best[0]:
+            best = (score, schema)
+    return best[1] if best else None
+
+
+def _unique(items: List[str]) -> List[str]:
+    return list(dict.fromkeys(x for x in items if x))
+
+
+def prompt_hints(prompt: str) -> Dict[str, Any]:
+    """Field values that make a schema instance pass the bootstrap validators for this prompt."""
+    task = _task_text(prompt)
+    header = re.search(r"^\s*--- .+ ---\s*$", task, re.M)
+    data = task[header.start():] if header else task
+
+    lines = [s.strip() for s in data.splitlines()]
+    snippets = [s for s in lines if 3 <= len(s) <= 80 and not s.startswith("---")]
+    today = re.search(r"last_updated:\s*(\d{4}-\d{2}-\d{2})", prompt)
+    hints: Dict[str, Any] = {
+        "evidence": _unique(_PATH_RE.findall(data) + snippets)[:5],
+        "generated_at": today.group(1) if today else datetime.now().strftime("%Y-%m-%d"),
+        "files": [],
+        "action": "create",
+        "dirs": _unique(re.findall(r'"dir":\s*"([^"]+)"', data)),
+    }
+    repo = re.search(r"`([^`]+)`@`([^`]+)`", prompt)
+    if repo:
+        hints["repo"], hints["branch"] = repo.group(1), repo.group(2)
+    directory = re.search(r"^dir: (.+)$", task, re.M)
+    if directory:
+        hints["dir"] = directory.group(1).strip()
+    chunk = re.search(r"^chunk: (\d+)/(\d+)$", task, re.M)
+    if chunk:
+        hints["chunk_index"], hints["chunk_total"] = int(chunk.group(1)), int(chunk.group(2))
+    listed = re.search(r"^Files in this chunk:\n((?:- .+\n)+)", data, re.M)
+    if listed:
+        hints["chunk_files"] = [line[2:].strip() for line in listed.group(1).splitlines()]
+    for key, pattern in (("target_category", r"[\w/-]+"), ("file_name", r"[\w.-]+\.md")):
+        found = re.search(rf'"{key}":\s*"({pattern})"', data) or re.search(rf"^\s*-\s*{key}:\s*({pattern})\s*$", task, re.M)
+        if found and found.group(1) != "string":
+            hints[key] = found.group(1)
+
+    sections = re.search(r"必须包含章节：(.+)$", task, re.M)
+    hints["sections"] = [s.strip() for s in sections.group(1).split(" / ")] if sections else _DEFAULT_SECTIONS
+    if _REPAIR_MARKER in task:
+        # A repair turn keeps the rejected output's sections and adds the ones the errors name.
+        hints["sections"] = _unique(re.findall(r"## [^\\\n\"`]+", data)) or hints["sections"]
+    return hints
+
+
+def _markdown_page(hints: Dict[str, Any], title: str) -> str:
+    body = [f"---\ntitle: {title}\ntype: feature\nstatus: experimental\nlast_updated: {hints['generated_at']}\nrelated_base:\n---\n"]
+    for section in hints["sections"]:
+        if "证据" in section:
+            text = "\n".join(f"- `{ev}`" for ev in hints["evidence"]) or "- （无）"
+        else:
+            text = "由本地 mock 服务生成的占位内容。"
+        body.append(f"{section}\n\n{text}\n")
+    return "\n".join(body)
+
+
+def fill_schema(schema: Dict[str, Any], prompt: str) -> Any:
+    """Schema instance for `prompt`; root arrays get one item per file of a stage-2 chunk, or else one per directory
+    found in the prompt (at most 3)."""
+    hints = prompt_hints(prompt)
+    if str(schema.get("type") or "").lower() != "array":
+        title = hints.get("file_name", "mock").rsplit(".", 1)[0]
+        return example_from_schema(schema, dict(hints, title=title, content=_markdown_page(hints, title)))
+    if hints.get("chunk_files"):
+        return [example_from_schema(schema.get("items") or {}, dict(hints, files=[p])) for p in hints["chunk_files"]]
+
+    items = []
+    for i, directory in enumerate(hints["dirs"][:3] or [""]):
+        slug = re.sub(r"[^\w-]+", "_", directory).strip("_") or ("overview" if i == 0 else f"page_{i + 1}")
+        title = directory or "概览"
+        item_hints = dict(
+            hints,
+            target_category=hints.get("target_category") or "modules",
+            file_name=f"{slug}.md",
+            title=title,
+            source_dirs=[directory] if directory else [],
+            content=_markdown_page(hints, title),
+        )
+        items.append(example_from_schema(schema.get("items") or {}, item_hints))
+    return items
+
+
+@dataclass
+class FaultConfig:
+    latency: float = 0.0  # fixed seconds before every generation reply
+    # Extra log-normal latency given by its median and 99th percentile (seconds); 0 disables it.
+    latency_p50: float = 0.0
+    latency_p99: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    # Every `burst_every` generation calls, the last `burst_length` of them get 429 + Retry-After.
+    burst_every: int = 0
+    burst_length: int = 0
+    retry_after: float = 1.0
+    rpm: int = 0  # requests per minute before 429 (0 = unlimited); also reported in x-ratelimit-* headers
+    reject_json_schema: bool = False
+    reject_json_object: bool = False
+    truncate_rate: float = 0.0  # fraction of replies cut mid-way with finish_reason length / MAX_TOKENS
+    # Fraction of JSON replies made without a schema / JSON mode that come back malformed, like free-form
+    # model output: wrapped in prose and a fence, trailing commas, Python literals or a missing key.
+    unstructured_noise: float = 0.0
+    # Fraction of schema replies that break a content rule the validators check: a required section left out
+    # or evidence that is not in the prompt.
+    invalid_rate: float = 0.0
+    seed: Optional[int] = None
+
+
+class MockLLMState:
+    def __init__(self, *, faults: FaultConfig, batch_delay: float):
+        self.faults = faults
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.random = random.Random(faults.seed)
+        self.calls = 0
+        self.recent: Deque[float] = deque()
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.cached_contents: Dict[str, str] = {}
+
+    def admit(self) -> Tuple[Optional[Tuple[int, str]], Dict[str, str]]:
+        """Decide injected faults for one generation call: (error status and message or None, headers)."""
+        f = self.faults
+        headers: Dict[str, str] = {}
+        now = time.time()
+        with self.lock:
+            self.calls += 1
+            if f.rpm > 0:
+                while self.recent and self.recent[0] <= now - 60:
+                    self.recent.popleft()
+                reset = (self.recent[0] + 60 - now) if self.recent else 60.0
+                limited = len(self.recent) >= f.rpm
+                if not limited:
+                    self.recent.append(now)
+                headers.update(
+                    {
+                        "x-ratelimit-limit-requests": str(f.rpm),
+                        "x-ratelimit-remaining-requests": str(max(0, f.rpm - len(self.recent))),
+                        "x-ratelimit-reset-requests": f"{reset:.1f}s",
+                    }
+                )
+                if limited:
+                    headers["retry-after"] = str(max(1, math.ceil(reset)))
+                    return (429, f"Rate limit reached: {f.rpm} requests per minute"), headers
+            if f.burst_every > 0 and (self.calls - 1) % f.burst_every >= f.burst_every - f.burst_length:
+                headers["retry-after"] = str(max(1, math.ceil(f.retry_after)))
+                return (429, "Too many requests (injected burst)"), headers
+            if f.error_rate > 0 and self.random.random() < f.error_rate:
+                return (f.error_status, f"Injected server error {f.error_status}"), headers
+        return None, headers
+
+    def latency(self) -> float:
+        f = self.faults
+        seconds = max(0.0, f.latency)
+        if f.latency_p50 > 0:
+            sigma = max(0.0, math.log(max(f.latency_p99, f.latency_p50) / f.latency_p50)) / 2.326
+            with self.lock:
+                seconds += self.random.lognormvariate(math.log(f.latency_p50), sigma)
+        return seconds
+
+    def generate(
+        self,
+        prompt: str,
+        *,
+        schema: Optional[Dict[str, Any]],
+        json_mode: bool,
+        max_tokens: int,
+        continue_from: Optional[str] = None,
+    ) -> Tuple[str, bool]:
+        """Reply text for one call and whether it was truncated.
+
+        `continue_from` is the model's own earlier (truncated) reply when the request continues it.
+        """
+        constrained = bool(schema) or json_mode or continue_from is not None
+        schema = schema or infer_schema(prompt)
+        if schema:
+            obj = fill_schema(schema, prompt)
+            if continue_from is None:
+                self._invalidate(obj)
+            text = json.dumps(obj, ensure_ascii=False)
+            if not constrained:
+                text = self._unstructured(obj, schema, text)
+        elif json_mode:
+            text = json.dumps({"ok": True})
+        elif '"YES" 或 "NO"' in prompt:
+            text = "YES"
+        else:
+            text = "OK"
+
+        if continue_from is not None and text.startswith(continue_from):
+            # Carry on from the cut, repeating a little of it as real models tend to.
+            text = text[len(continue_from) - min(len(continue_from), 20) :]
+        with self.lock:
+            cut = self.faults.truncate_rate > 0 and self.random.random() < self.faults.truncate_rate
+        cut = cut and continue_from is None
+        if cut and len(text) > 1:
+            return text[: len(text) // 2], True
+        # Roughly 3 characters per token, like the client-side estimate for mixed Chinese/code text.
+        if max_tokens > 0 and len(text) > max_tokens * 3:
+            return text[: max_tokens * 3], True
+        return text, False
+
+    def _invalidate(self, obj: Any) -> None:
+        item = obj[0] if isinstance(obj, list) and obj else obj
+        if not isinstance(item, dict):
+            return
+        content = item.get("content")
+        headings = re.findall(r"^## .+$", content, re.M) if isinstance(content, str) else []
+        kinds = (["drop_section"] if headings else []) + (["fabricated_evidence"] if "evidence" in item else [])
+        with self.lock:
+            if not kinds or self.faults.invalid_rate <= 0 or self.random.random() >= self.faults.invalid_rate:
+                return
+            kind = self.random.choice(kinds)
+            heading = self.random.choice(headings) if headings else ""
+        if kind == "drop_section":
+            item["content"] = content.replace(heading + "\n", "", 1)
+        else:
+            item["evidence"] = ["src/made_up_module.py", "MadeUpClient.run"]
+
+    def _unstructured(self, obj: Any, schema: Dict[str, Any], text: str) -> str:
+        with self.lock:
+            if self.faults.unstructured_noise <= 0 or self.random.random() >= self.faults.unstructured_noise:
+                return text
+            kind = self.random.choice(["fence", "trailing_comma", "python_literal", "missing_key"])
+        if kind == "fence":
+            return f"好的，以下是结果：\n```json\n{json.dumps(obj, ensure_ascii=False, indent=2)}\n```\n如需调整请告诉我。"
+        if kind == "trailing_comma":
+            return text[:-1] + ",\n" + text[-1] + "\n"
+        if kind == "python_literal":
+            return repr(obj)
+        item = obj[0] if isinstance(obj, list) and obj else obj
+        root = (schema.get("items") or {}) if schema.get("type") == "array" else schema
+        required = [k for k in root.get("required") or [] if isinstance(item, dict) and k in item]
+        if not required:
+            return text
+        # Drop the key the validators lean on most.
+        key = "evidence" if "evidence" in required else required[0]
+        del item[key]
+        return json.dumps(obj, ensure_ascii=False)
+
+    def chat_completion(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages:
+            return 400, {"error": {"message": "messages must be a non-empty array", "type": "invalid_request_error"}}
+
+        fmt = body.get("response_format") or {}
+        fmt_type = fmt.get("type")
+        if (fmt_type == "json_schema" and self.faults.reject_json_schema) or (
+            fmt_type == "json_object" and self.faults.reject_json_object
+        ):
+            message = f"Invalid parameter: 'response_format' of type '{fmt_type}' is not supported with this model."
+            return 400, {"error": {"message": message, "type": "invalid_request_error", "param": "response_format"}}
+
+        continue_from = None
+        if len(messages) >= 3 and messages[-2].get("role") == "assistant":
+            continue_from = str(messages[-2].get("content") or "")
+            messages = messages[:-2]
+        prompt = "\n".join(str(m.get("content") or "") for m in messages)
+        schema = (fmt.get("json_schema") or {}).get("schema") if fmt_type == "json_schema" else None
+        content, truncated = self.generate(
+            prompt,
+            schema=schema,
+            json_mode=fmt_type == "json_object",
+            max_tokens=int(body.get("max_completion_tokens") or body.get("max_tokens") or 0),
+            continue_from=continue_from,
+        )
+        prompt_tokens = len(prompt) // 3
+        completion_tokens = max(1, len(content) // 3)
+        return 200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or "mock",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "length" if truncated else "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def generate_content(self, model: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Gemini models/{model}:generateContent."""
+        contents = body.get("contents")
+        if not isinstance(contents, list) or not contents:
+            return 400, {"error": {"code": 400, "message": "contents is required", "status": "INVALID_ARGUMENT"}}
+
+        gen = body.get("generationConfig") or {}
+        schema = gen.get("responseSchema") or gen.get("responseJsonSchema")
+        if schema and self.faults.reject_json_schema:
+            message = 'Invalid JSON payload received. Unknown name "responseSchema" at \'generation_config\': Cannot find field.'
+            return 400, {"error": {"code": 400, "message": message, "status": "INVALID_ARGUMENT"}}
+
+        cached = ""
+        name = str(body.get("cachedContent") or "")
+        if name:
+            with self.lock:
+                cached = self.cached_contents.get(name, "")
+            if not cached:
+                return 404, {"error": {"code": 404, "message": f"CachedContent not found: {name}", "status": "NOT_FOUND"}}
+        continue_from = None
+        if len(contents) >= 3 and contents[-2].get("role") == "model":
+            continue_from = "".join(p.get("text") or "" for p in (contents[-2].get("parts") or []))
+            contents = contents[:-2]
+        parts = [p.get("text") or "" for c in contents for p in (c.get("parts") or []) if isinstance(p, dict)]
+        prompt = cached + "".join(parts)
+        text, truncated = self.generate(
+            prompt,
+            schema=schema,
+            json_mode=gen.get("responseMimeType") == "application/json",
+            max_tokens=int(gen.get("maxOutputTokens") or 0),
+            continue_from=continue_from,
+        )
+        system = "".join(p.get("text") or "" for p in ((body.get("systemInstruction") or {}).get("parts") or []))
+        cached_tokens = len(cached) // 3
+        prompt_tokens = (len(system) + len(prompt)) // 3
+        completion_tokens = max(1, len(text) // 3)
+        usage = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": completion_tokens,
+            "totalTokenCount": prompt_tokens + completion_tokens,
+        }
+        if cached_tokens:
+            usage["cachedContentTokenCount"] = cached_tokens
+        return 200, {
+            "candidates": [
+                {
+                    "content": {"role": "model", "parts": [{"text": text}]},
+                    "finishReason": "MAX_TOKENS" if truncated else "STOP",
+                    "index": 0,
+                }
+            ],
+            "usageMetadata": usage,
+            "modelVersion": model,
+        }
+
+    def create_cached_content(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Gemini cachedContents: the system instruction and contents are prepended to later prompts using it."""
+        parts = [p.get("text") or "" for c in (body.get("contents") or []) for p in (c.get("parts") or [])]
+        system = "".join(p.get("text") or "" for p in ((body.get("systemInstruction") or {}).get("parts") or []))
+        text = "".join(parts)
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        with self.lock:
+            self.cached_contents[name] = text
+        return 200, {
+            "name": name,
+            "model": body.get("model") or "models/mock",
+            "expireTime": datetime.fromtimestamp(time.time() + 3600, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "usageMetadata": {"totalTokenCount": (len(system) + len(text)) // 3},
+        }
+
+    def add_file(self, content: bytes, purpose: str, filename: str) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        with self.lock:
+            self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+
+    def create_batch(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        input_file_id = body.get("input_file_id")
+        with self.lock:
+            content = self.files.get(input_file_id or "")
+        if content is None:
+            return 404, {"error": {"message": f"No such file: {input_file_id}"}}
+        if body.get("endpoint") != "/v1/chat/completions":
+            return 400, {"error": {"message": "only /v1/chat/completions is supported"}}
+
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        lines = [line for line in content.decode("utf-8").splitlines() if line.strip()]
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": input_file_id,
+            "completion_window": body.get("completion_window") or "24h",
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata") or {},
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._process_batch, args=(batch_id, lines), daemon=True).start()
+        return 200, dict(batch)
+
+    def _process_batch(self, batch_id: str, lines: List[str]) -> None:
+        time.sleep(self.batch_delay / 2)
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "cancelling":
+                batch["status"] = "cancelled"
+                return
+            batch["status"] = "in_progress"
+        time.sleep(self.batch_delay / 2)
+
+        outputs: List[str] = []
+        errors: List[str] = []
+        for line in lines:
+            try:
+                item = json.loads(line)
+            except Exception:
+                continue
+            status, data = self.chat_completion(item.get("body") or {})
+            row = {
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": item.get("custom_id"),
+                "response": {"status_code": status, "request_id": uuid.uuid4().hex, "body": data},
+                "error": None,
+            }
+            (outputs if status == 200 else errors).append(json.dumps(row, ensure_ascii=False))
+
+        output = self.add_file(("\n".join(outputs) + "\n").encode("utf-8"), "batch_output", "output.jsonl")
+        error = self.add_file(("\n".join(errors) + "\n").encode("utf-8"), "batch_output", "errors.jsonl") if errors else None
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch["output_file_id"] = output["id"]
+            batch["error_file_id"] = error["id"] if error else None
+            batch["request_counts"] = {"total": len(lines), "completed": len(outputs), "failed": len(errors)}
+            batch["status"] = "cancelled" if batch["status"] == "cancelling" else "completed"
+            batch["completed_at"] = int(time.time())
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffered writes without Nagle, otherwise delayed ACKs add ~40ms to every response.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    state: MockLLMState
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, obj: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send_bytes(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json", headers)
+
+    def _send_bytes(self, status: int, data: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def _send_sse(self, events: List[str], headers: Dict[str, str]) -> None:
+        """Stream `events` as server-sent events over chunked transfer encoding."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        try:
+            for event in events:
+                data = f"data: {event}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+                time.sleep(0.005)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the stream (e.g. a cancelled hedge).
+            self.close_connection = True
+
+    @staticmethod
+    def _pieces(text: str, size: int = 24) -> List[str]:
+        return [text[i : i + size] for i in range(0, len(text), size)] or [""]
+
+    def _openai_stream(self, data: Dict[str, Any], headers: Dict[str, str]) -> None:
+        choice = data["choices"][0]
+        base = {"id": data["id"], "object": "chat.completion.chunk", "created": data["created"], "model": data["model"]}
+        events = [
+            json.dumps(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]), ensure_ascii=False)
+            for piece in self._pieces(choice["message"]["content"])
+        ]
+        final = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": choice["finish_reason"]}], usage=data["usage"])
+        events += [json.dumps(final), "[DONE]"]
+        self._send_sse(events, headers)
+
+    def _gemini_stream(self, data: Dict[str, Any], headers: Dict[str, str]) -> None:
+        candidate = data["candidates"][0]
+        pieces = self._pieces(candidate["content"]["parts"][0]["text"])
+        events = []
+        for i, piece in enumerate(pieces):
+            event: Dict[str, Any] = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}, "index": 0}]}
+            if i == len(pieces) - 1:
+                event["candidates"][0]["finishReason"] = candidate["finishReason"]
+                event["usageMetadata"] = data["usageMetadata"]
+            events.append(json.dumps(event, ensure_ascii=False))
+        self._send_sse(events, headers)
+
+    def _generation(self, gemini_model: Optional[str], stream: bool, body: Dict[str, Any]) -> None:
+        error, headers = self.state.admit()
+        if error:
+            status, message = error
+            if gemini_model is not None:
+                payload = {"error": {"code": status, "message": message, "status": _GEMINI_STATUS.get(status, "UNKNOWN")}}
+            else:
+                payload = {"error": {"message": message, "type": "rate_limit_error" if status == 429 else "server_error"}}
+            return self._send_json(status, payload, headers)
+
+        delay = self.state.latency()
+        if delay:
+            time.sleep(delay)
+        if gemini_model is not None:
+            status, data = self.state.generate_content(gemini_model, body)
+        else:
+            status, data = self.state.chat_completion(body)
+        if status != 200 or not stream:
+            return self._send_json(status, data, headers)
+        if gemini_model is not None:
+            return self._gemini_stream(data, headers)
+        return self._openai_stream(data, headers)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _path(self) -> str:
+        path = self.path.split("?", 1)[0].rstrip("/")
+        return path[len("/v1"):] if path.startswith("/v1/") else path
+
+    def _parse_multipart(self, raw: bytes) -> Dict[str, Tuple[Optional[str], bytes]]:
+        header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("utf-8")
+        message = BytesParser(policy=default_policy).parsebytes(header + raw)
+        fields: Dict[str, Tuple[Optional[str], bytes]] = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name:
+                fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+        return fields
+
+    def do_POST(self) -> None:
+        path = self._path()
+        raw = self._read_body()
+        gemini = _GEMINI_PATH_RE.match(self.path.split("?", 1)[0])
+        if gemini or path in {"/v1beta/cachedContents", "/cachedContents"}:
+            try:
+                body = json.loads(raw or b"{}")
+            except Exception:
+                return self._send_json(400, {"error": {"code": 400, "message": "invalid JSON body", "status": "INVALID_ARGUMENT"}})
+            if not gemini:
+                return self._send_json(*self.state.create_cached_content(body))
+            return self._generation(gemini.group(1), gemini.group(2) == "streamGenerateContent", body)
+
+        if path == "/files":
+            fields = self._parse_multipart(raw)
+            filename, content = fields.get("file") or (None, b"")
+            purpose = (fields.get("purpose") or (None, b""))[1].decode("utf-8")
+            if not content:
+                return self._send_json(400, {"error": {"message": "file is required"}})
+            return self._send_json(200, self.state.add_file(content, purpose, filename or "upload.jsonl"))
+
+        try:
+            body = json.loads(raw or b"{}")
+        except Exception:
+            return self._send_json(400, {"error": {"message": "invalid JSON body"}})
+
+        if path == "/chat/completions":
+            return self._generation(None, bool(body.get("stream")), body)
+        if path == "/batches":
+            return self._send_json(*self.state.create_batch(body))
+        if path.startswith("/batches/") and path.endswith("/cancel"):
+            batch_id = path.split("/")[2]
+            with self.state.lock:
+                batch = self.state.batches.get(batch_id)
+                if batch and batch["status"] in {"validating", "in_progress"}:
+                    batch["status"] = "cancelling"
+                snapshot = dict(batch) if batch else None
+            if snapshot is None:
+                return self._send_json(404, {"error": {"message": f"No such batch: {batch_id}"}})
+            return self._send_json(200, snapshot)
+        self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+
+    def do_GET(self) -> None:
+        path = self._path()
+        parts = path.split("/")
+        if len(parts) == 3 and parts[1] == "batches":
+            with self.state.lock:
+                batch = self.state.batches.get(parts[2])
+                snapshot = dict(batch) if batch else None
+            if snapshot is None:
+                return self._send_json(404, {"error": {"message": f"No such batch: {parts[2]}"}})
+            return self._send_json(200, snapshot)
+        if len(parts) == 4 and parts[1] == "files" and parts[3] == "content":
+            with self.state.lock:
+                content = self.state.files.get(parts[2])
+            if content is None:
+                return self._send_json(404, {"error": {"message": f"No such file: {parts[2]}"}})
+            return self._send_bytes(200, content, "application/jsonl")
+        self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under concurrent bootstrap load.
+    request_queue_size = 128
+
+
+def make_server(
+    host: str = "127.0.0.1",
+    port: int = 8089,
+    *,
+    latency: float = 0.0,
+    batch_delay: float = 1.0,
+    faults: Optional[FaultConfig] = None,
+) -> MockLLMServer:
+    state = MockLLMState(faults=faults or FaultConfig(latency=latency), batch_delay=batch_delay)
+    handler = type("BoundMockLLMHandler", (MockLLMHandler,), {"state": state})
+    return MockLLMServer((host, port), handler)
+
+
+def _parse_burst(value: str) -> Tuple[int, int]:
+    try:
+        every, length = (int(x) for x in value.split(":", 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected EVERY:LENGTH, e.g. 20:3")
+    if every <= 0 or not 0 <= length <= every:
+        raise argparse.ArgumentTypeError("need EVERY > 0 and 0 <= LENGTH <= EVERY")
+    return every, length
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local mock of an OpenAI-compatible / Gemini LLM endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="Fixed seconds before each generation reply")
+    parser.add_argument("--latency-p50", type=float, default=0.0, help="Median of extra log-normal latency (seconds)")
+    parser.add_argument("--latency-p99", type=float, default=0.0, help="99th percentile of the extra latency (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--rate-limit-burst", type=_parse_burst, default=(0, 0), metavar="EVERY:LENGTH",
+                        help="Answer the last LENGTH of every EVERY calls with 429 + Retry-After")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with burst 429s")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before 429 (0 = unlimited)")
+    parser.add_argument("--reject-json-schema", action="store_true", help="Reject response_format json_schema / Gemini responseSchema")
+    parser.add_argument("--reject-json-object", action="store_true", help="Reject response_format json_object")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Fraction of replies cut mid-JSON (finish_reason length)")
+    parser.add_argument("--unstructured-noise", type=float, default=0.0,
+                        help="Fraction of JSON replies made without a schema / JSON mode that come back malformed")
+    parser.add_argument("--invalid-rate", type=float, default=0.0,
+                        help="Fraction of schema replies that drop a required section or cite evidence not in the prompt")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Seconds a batch spends before completing")
+    args = parser.parse_args()
+
+    faults = FaultConfig(
+        latency=args.latency,
+        latency_p50=args.latency_p50,
+        latency_p99=args.latency_p99,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        burst_every=args.rate_limit_burst[0],
+        burst_length=args.rate_limit_burst[1],
+        retry_after=args.retry_after,
+        rpm=args.rpm,
+        reject_json_schema=args.reject_json_schema,
+        reject_json_object=args.reject_json_object,
+        truncate_rate=args.truncate_rate,
+        unstructured_noise=args.unstructured_noise,
+        invalid_rate=args.invalid_rate,
+        seed=args.seed,
+    )
+    server = make_server(args.host, args.port, batch_delay=args.batch_delay, faults=faults)
+    print(f"Mock LLM server listening on http://{args.host}:{args.port} (OpenAI: /v1, Gemini: /v1beta)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
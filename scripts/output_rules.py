@@ -0,0 +1,324 @@
+"""Declarative validation of the JSON objects the doc generator asks the model for.
+
+An OutputRules is compiled once from the JSON Schema a request already sends, plus the project's own rules:
+required sections, YAML frontmatter, a safe docs path, and evidence quoted from the prompt.
+- normalize() maps near-miss keys onto the schema, fills defaults, and fixes the shapes models commonly get
+  wrong (a bare string where a list of strings is expected).
+- errors() reports every violated rule, not just the first, so one repair call can fix all of them.
+- check_batch() / batch_errors() do the same for a whole array of outputs.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Collection, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+from evidence_index import EvidenceIndex
+
+_CATEGORY_SEGMENT_RE = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9_-]*$")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+_EMPTY = {"string": "", "array": [], "object": {}, "number": 0, "integer": 0}
+
+
+class RuleViolation(ValueError):
+    """All rules an output broke; str() joins them, so `except ValueError` handlers keep working."""
+
+    def __init__(self, errors: Sequence[str]):
+        self.errors = list(errors)
+        super().__init__("; ".join(self.errors))
+
+
+def error_list(e: BaseException) -> List[str]:
+    return list(getattr(e, "errors", None) or [str(e)])
+
+
+def normalize_category_path(category: str) -> str:
+    return (category or "").strip().replace("\\", "/").strip("/")
+
+
+def is_safe_category_path(category: str) -> bool:
+    """A relative docs_root subdirectory: plain segments, no dot-dirs, no snapshots/."""
+    category = (category or "").strip().strip("/")
+    if not category or category.startswith(("/", "\\")) or "\\" in category or ":" in category:
+        return False
+    parts = [p for p in category.split("/") if p]
+    if not parts:
+        return False
+    return all(p != "snapshots" and _CATEGORY_SEGMENT_RE.match(p) for p in parts)
+
+
+def _evidence_token(item: Any) -> str:
+    return item.strip().strip("`") if isinstance(item, str) else ""
+
+
+@dataclass
+class RuleContext:
+    """Per-call inputs of the rules."""
+
+    haystack: str = ""  # text evidence items are quoted from
+    defaults: Dict[str, Any] = field(default_factory=dict)  # value for a missing or empty key
+    pinned: Dict[str, Any] = field(default_factory=dict)  # fields fixed by the request, whatever the model says
+    # Tokens (or obj -> tokens) that stand in for the model's evidence when too few of its items match.
+    fallback_evidence: Union[Sequence[str], Callable[[Dict[str, Any]], Sequence[str]]] = ()
+    # list field -> allowed values; the list must be non-empty and drawn from them
+    choices: Dict[str, Collection[str]] = field(default_factory=dict)
+    index: Optional[EvidenceIndex] = None  # the checked-out repo; evidence found there counts as well
+    _found: Dict[str, bool] = field(default_factory=dict, init=False, repr=False)
+
+    def verify(self, tokens: Iterable[str]) -> Dict[str, bool]:
+        """Whether each evidence token is quoted from the haystack or found in the repo; memoized per context."""
+        out: Dict[str, bool] = {}
+        for token in tokens:
+            found = self._found.get(token)
+            if found is None:
+                found = bool(token) and (
+                    token in self.haystack or (self.index is not None and self.index.locate(token) is not None)
+                )
+                self._found[token] = found
+            out[token] = found
+        return out
+
+    def has_evidence(self, token: str) -> bool:
+        return self.verify((token,))[token]
+
+
+@dataclass(frozen=True)
+class _Field:
+    name: str
+    kind: str
+    item_kind: str
+    enum: Tuple[str, ...]
+
+
+class OutputRules:
+    """Rules for one JSON object shape; build with compile_rules()."""
+
+    def __init__(
+        self,
+        name: str,
+        fields: Sequence[_Field],
+        *,
+        sections: Sequence[str],
+        frontmatter: bool,
+        check_category: bool,
+        check_file_name: bool,
+        allow_index: bool,
+        min_evidence: int,
+        max_evidence: int,
+    ):
+        self.name = name
+        self.fields = tuple(fields)
+        self.keys = tuple(f.name for f in self.fields)
+        self.sections = tuple(sections)
+        self.frontmatter = frontmatter
+        self.check_category = check_category
+        self.check_file_name = check_file_name
+        self.allow_index = allow_index
+        self.min_evidence = min_evidence
+        self.max_evidence = max_evidence
+        self._canon = {_NON_ALNUM_RE.sub("", k.lower()): k for k in self.keys}
+        # raw key -> schema key (or None), shared across objects: models repeat the same near-misses.
+        self._key_cache: Dict[str, Optional[str]] = {k: k for k in self.keys}
+
+    def _schema_key(self, key: str) -> Optional[str]:
+        try:
+            return self._key_cache[key]
+        except KeyError:
+            pass
+        ck = _NON_ALNUM_RE.sub("", key.lower())
+        found = self._canon.get(ck)
+        if found is None and ck:
+            # A key with junk around it (e.g. "ris risks" -> "risks"): accept the single longest schema key inside.
+            inside = sorted({k for c, k in self._canon.items() if c and c in ck}, key=len, reverse=True)
+            if len(inside) == 1:
+                found = inside[0]
+        self._key_cache[key] = found
+        return found
+
+    def normalize(self, obj: Any, ctx: Optional[RuleContext] = None) -> Any:
+        """Schema keys only, defaults filled, common shape slips fixed; non-objects are returned unchanged."""
+        if not isinstance(obj, dict):
+            return obj
+        ctx = ctx or RuleContext()
+        out: Dict[str, Any] = {}
+        for key, value in obj.items():
+            if key in self._key_cache and self._key_cache[key] == key:
+                out[key] = value
+        for key, value in obj.items():
+            target = self._schema_key(str(key))
+            if target is not None and target not in out:
+                out[target] = value
+
+        for f in self.fields:
+            value = out.get(f.name)
+            if f.kind == "array":
+                if isinstance(value, str):
+                    value = [value]
+                if not isinstance(value, list):
+                    value = []
+                if f.item_kind == "string":
+                    value = [v.strip() for v in value if isinstance(v, str) and v.strip()]
+                elif f.item_kind == "object":
+                    value = [v for v in value if isinstance(v, dict)]
+            elif f.kind == "string":
+                if value is None:
+                    value = ""
+                elif f.enum and isinstance(value, str) and value.strip().lower() in f.enum:
+                    value = value.strip().lower()
+            elif f.kind == "object" and not isinstance(value, dict):
+                value = {}
+            if value in ("", [], None) and f.name in ctx.defaults:
+                value = ctx.defaults[f.name]
+            if value is None:
+                value = list(_EMPTY[f.kind]) if f.kind == "array" else _EMPTY.get(f.kind, "")
+            out[f.name] = value
+        out.update(ctx.pinned)
+
+        if self.check_category and isinstance(out.get("target_category"), str):
+            out["target_category"] = normalize_category_path(out["target_category"])
+        if self.check_file_name and isinstance(out.get("file_name"), str):
+            out["file_name"] = out["file_name"].strip()
+        if self.min_evidence and "evidence" in out:
+            out["evidence"] = self._normalize_evidence(out, ctx)
+        return out
+
+    def _normalize_evidence(self, obj: Dict[str, Any], ctx: RuleContext) -> List[str]:
+        """Evidence items found in the haystack, sorted; the context's fallback when too few of them match."""
+        matched = sorted({t for t in map(_evidence_token, obj["evidence"]) if t and ctx.has_evidence(t)})
+        if len(matched) < self.min_evidence:
+            fallback = ctx.fallback_evidence(obj) if callable(ctx.fallback_evidence) else ctx.fallback_evidence
+            fallback = [t for t in dict.fromkeys(fallback) if t and ctx.has_evidence(t)]
+            if len(fallback) >= self.min_evidence:
+                matched = fallback[: self.min_evidence]
+        return matched[: self.max_evidence] if self.max_evidence else matched
+
+    def errors(self, obj: Any, ctx: Optional[RuleContext] = None) -> List[str]:
+        """Every rule `obj` (as returned by normalize) breaks; empty when it is valid."""
+        if not isinstance(obj, dict):
+            return ["output must be a JSON object"]
+        ctx = ctx or RuleContext()
+        errors: List[str] = []
+        for f in self.fields:
+            value = obj.get(f.name)
+            if f.kind == "string" and not isinstance(value, str):
+                errors.append(f"{f.name} must be a string")
+            elif f.kind in ("number", "integer") and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                errors.append(f"{f.name} must be a number")
+            elif f.enum and value not in f.enum:
+                errors.append(f"{f.name} must be one of: {'/'.join(f.enum)}")
+
+        for key, allowed in ctx.choices.items():
+            values = obj.get(key)
+            if not isinstance(values, list) or not values:
+                errors.append(f"{key} must be a non-empty list")
+            elif any(v not in allowed for v in values):
+                errors.append(f"{key} items must be one of the provided values")
+
+        if self.check_file_name:
+            file_name = obj.get("file_name") if isinstance(obj.get("file_name"), str) else ""
+            if not file_name.endswith(".md"):
+                errors.append("file_name must end with .md")
+            if not self.allow_index and file_name == "index.md":
+                errors.append("file_name must not be index.md")
+            if any(x in file_name for x in ("/", "\\", "..")):
+                errors.append("file_name must be a plain filename (no path)")
+        if self.check_category:
+            category = obj.get("target_category") if isinstance(obj.get("target_category"), str) else ""
+            if not category:
+                errors.append("target_category is required")
+            elif not is_safe_category_path(category):
+                errors.append("target_category must be a safe relative path under docs root (e.g. plugin_system/api)")
+
+        if self.frontmatter:
+            content = obj.get("content")
+            if not isinstance(content, str) or not content.strip():
+                errors.append("content must be a non-empty string")
+            else:
+                if not content.lstrip().startswith("---"):
+                    errors.append("content must start with YAML frontmatter ('---')")
+                errors.extend(f"content must include section: {s}" for s in self.sections if s not in content)
+
+        if self.min_evidence:
+            evidence = obj.get("evidence")
+            found = {t for t in map(_evidence_token, evidence if isinstance(evidence, list) else ()) if t}
+            if sum(1 for t in found if ctx.has_evidence(t)) < self.min_evidence:
+                errors.append(
+                    f"evidence must include at least {self.min_evidence} items quoted verbatim from the provided context"
+                    " or the repository"
+                )
+        return errors
+
+    def validate(self, obj: Any, ctx: Optional[RuleContext] = None) -> Dict[str, Any]:
+        """normalize() then errors(); raises RuleViolation with all of them."""
+        obj = self.normalize(obj, ctx)
+        errors = self.errors(obj, ctx)
+        if errors:
+            raise RuleViolation(errors)
+        return obj
+
+    def check_batch(
+        self, objs: Sequence[Any], ctx: Union[None, RuleContext, Sequence[RuleContext]] = None
+    ) -> List[Tuple[Any, List[str]]]:
+        """(normalized object, errors) for each output; `ctx` is shared or one per output."""
+        ctxs = ctx if isinstance(ctx, (list, tuple)) else [ctx] * len(objs)
+        if isinstance(ctx, RuleContext) and self.min_evidence:
+            # Resolve the evidence of the whole batch in one go.
+            ctx.verify(
+                _evidence_token(t)
+                for obj in objs
+                if isinstance(obj, dict) and isinstance(obj.get("evidence"), list)
+                for t in obj["evidence"]
+            )
+        out: List[Tuple[Any, List[str]]] = []
+        for obj, c in zip(objs, ctxs):
+            obj = self.normalize(obj, c)
+            out.append((obj, self.errors(obj, c)))
+        return out
+
+    def batch_errors(self, objs: Any, ctx: Optional[RuleContext] = None) -> List[str]:
+        """Errors of a JSON array of outputs, each prefixed with its index."""
+        if not isinstance(objs, list):
+            return ["output must be a JSON array"]
+        return [f"[{i}] {e}" for i, (_, errors) in enumerate(self.check_batch(objs, ctx)) for e in errors]
+
+
+def compile_rules(
+    name: str,
+    schema: Mapping[str, Any],
+    *,
+    sections: Sequence[str] = (),
+    frontmatter: bool = False,
+    check_category: bool = False,
+    check_file_name: bool = False,
+    allow_index: bool = True,
+    min_evidence: int = 0,
+    max_evidence: int = 0,
+) -> OutputRules:
+    """Rules for the objects of `schema` (an object schema, or an array schema of them).
+
+    sections / frontmatter: what `content` must contain; check_category / check_file_name: target_category and
+    file_name must form a safe docs path; min_evidence: evidence items that must appear in RuleContext.haystack.
+    """
+    if schema.get("type") == "array":
+        schema = schema.get("items") or {}
+    fields = []
+    for key, sub in (schema.get("properties") or {}).items():
+        items = sub.get("items") if isinstance(sub.get("items"), dict) else {}
+        fields.append(
+            _Field(
+                name=key,
+                kind=str(sub.get("type") or ""),
+                item_kind=str(items.get("type") or ""),
+                enum=tuple(sub.get("enum") or ()),
+            )
+        )
+    return OutputRules(
+        name,
+        fields,
+        sections=sections,
+        frontmatter=frontmatter,
+        check_category=check_category,
+        check_file_name=check_file_name,
+        allow_index=allow_index,
+        min_evidence=min_evidence,
+        max_evidence=max_evidence,
+    )
@@ -0,0 +1,188 @@
+"""Dependency-ordered runner for the bootstrap pipeline, with per-node checkpoints on disk.
+
+A node is an async job factory plus the names of the nodes whose results it needs. Nodes run on one event loop
+as soon as their dependencies are done, at most `limit` at a time, and ready nodes start in the order they were
+added. A node can grow the graph once its result is known (the RepoMap adds one node per directory chunk, the
+plan one node per page) through an `expand` callback. The callback also runs for a result restored from a
+checkpoint, so a resumed run rebuilds the same graph.
+
+With a CheckpointStore, every non-None result is written to disk as soon as its node finishes, and a node with a
+checkpoint is not run again. None (an LLM call that failed after its retries) is not stored, so a resumed run
+retries it. If a node raises, the nodes still in flight are cancelled and the exception propagates; every result
+finished so far is already on disk.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class CheckpointStore:
+    """Results of finished pipeline nodes for one upstream head, one JSON file per node under `root`."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.loaded = 0
+        self.saved = 0
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, "manifest.json")
+
+    def _node_path(self, name: str) -> str:
+        slug = re.sub(r"[^\w.-]+", "_", name)[:80]
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.root, "nodes", f"{slug}-{digest}.json")
+
+    def saved_head(self) -> str:
+        """Head sha the stored checkpoints were computed for ("" when there are none)."""
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                return str(json.load(f).get("head_sha") or "")
+        except (OSError, ValueError, AttributeError):
+            return ""
+
+    def reset(self, head_sha: str) -> None:
+        """Drop every checkpoint and start an empty set for head_sha."""
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "nodes"), exist_ok=True)
+        self._write(self._manifest_path(), {"head_sha": head_sha, "created_at": time.time()})
+
+    def load(self, name: str) -> Tuple[bool, Any]:
+        try:
+            with open(self._node_path(name), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Missing, or torn by a killed job: run the node again.
+            return False, None
+        if not isinstance(data, dict) or data.get("node") != name:
+            return False, None
+        self.loaded += 1
+        return True, data.get("output")
+
+    def save(self, name: str, output: Any) -> None:
+        self._write(self._node_path(name), {"node": name, "output": output})
+        self.saved += 1
+
+    @staticmethod
+    def _write(path: str, data: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+@dataclass
+class _Node:
+    name: str
+    run: Callable[[], Awaitable[Any]]
+    deps: Tuple[str, ...]
+    checkpoint: bool
+    expand: Optional[Callable[[Any], None]]
+    checked: bool = False  # the store was already asked for this node
+
+
+class Pipeline:
+    """A DAG of async jobs; see the module docstring."""
+
+    def __init__(self, *, limit: int, store: Optional[CheckpointStore] = None):
+        self.limit = max(1, int(limit))
+        self.store = store
+        self.results: Dict[str, Any] = {}
+        self.ran = 0
+        self.restored = 0
+        self._nodes: Dict[str, _Node] = {}
+        self._order: Dict[str, int] = {}
+        self._pending: List[str] = []
+
+    def add(
+        self,
+        name: str,
+        run: Callable[[], Awaitable[Any]],
+        *,
+        deps: Sequence[str] = (),
+        checkpoint: bool = True,
+        expand: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        """Add a node; its dependencies must already be in the graph, which keeps it acyclic."""
+        if name in self._nodes:
+            raise ValueError(f"duplicate pipeline node: {name}")
+        unknown = [d for d in deps if d not in self._nodes]
+        if unknown:
+            raise ValueError(f"pipeline node {name} depends on unknown nodes: {unknown}")
+        self._nodes[name] = _Node(name, run, tuple(deps), checkpoint, expand)
+        self._order[name] = len(self._order)
+        self._pending.append(name)
+
+    def result(self, name: str) -> Any:
+        return self.results.get(name)
+
+    def _finish(self, name: str, output: Any, *, restored: bool) -> None:
+        node = self._nodes[name]
+        self.results[name] = output
+        if restored:
+            self.restored += 1
+        else:
+            self.ran += 1
+            if node.checkpoint and self.store is not None and output is not None:
+                self.store.save(name, output)
+        if node.expand is not None:
+            node.expand(output)
+
+    def _start_ready(self, running: Dict["asyncio.Future[Any]", str]) -> None:
+        i = 0
+        while i < len(self._pending):
+            node = self._nodes[self._pending[i]]
+            if any(d not in self.results for d in node.deps):
+                i += 1
+                continue
+            if node.checkpoint and self.store is not None and not node.checked:
+                node.checked = True
+                found, output = self.store.load(node.name)
+                if found:
+                    del self._pending[i]
+                    self._finish(node.name, output, restored=True)
+                    i = 0  # nodes before this one may depend on it
+                    continue
+            if len(running) >= self.limit:
+                i += 1
+                continue
+            del self._pending[i]
+            running[asyncio.ensure_future(node.run())] = node.name
+
+    async def run(self) -> Dict[str, Any]:
+        """Run every node; returns the results by node name."""
+        running: Dict["asyncio.Future[Any]", str] = {}
+        try:
+            while True:
+                self._start_ready(running)
+                if not running:
+                    break
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                error: Optional[BaseException] = None
+                for task in sorted(finished, key=lambda t: self._order[running[t]]):
+                    name = running.pop(task)
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    else:
+                        self._finish(name, task.result(), restored=False)
+                if error is not None:
+                    raise error
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        return self.results
+
+    def summary(self) -> str:
+        s = f"nodes={len(self.results)} ran={self.ran} restored={self.restored}"
+        if self.store is not None:
+            s += f" checkpoints_saved={self.store.saved}"
+        return s
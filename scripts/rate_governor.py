@@ -0,0 +1,304 @@
+import asyncio
+import functools
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Optional, Tuple
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait according to Retry-After / retry-after-ms (None when absent or unparsable)."""
+    headers = {str(k).lower(): str(v) for k, v in (headers or {}).items()}
+    raw_ms = headers.get("retry-after-ms")
+    if raw_ms:
+        try:
+            return max(0.0, float(raw_ms) / 1000.0)
+        except ValueError:
+            pass
+    raw = (headers.get("retry-after") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def parse_reset_duration(raw: str) -> Optional[float]:
+    """Parse x-ratelimit-reset-* values such as "1s", "6m0s", "20ms" or a bare number of seconds."""
+    raw = (raw or "").strip().lower()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", raw)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(v) * scale[u] for v, u in parts)
+
+
+def default_governor_path() -> str:
+    # A host-wide location, so separate checkouts/processes using the same key coordinate.
+    return os.path.join(tempfile.gettempdir(), "llm_rate_governor.sqlite3")
+
+
+class RateGovernor:
+    """Request/token-per-minute buckets plus an AIMD concurrency window, shared through SQLite.
+
+    State is keyed by (API key hash, base URL), so every process on the host that uses the same key draws
+    from the same buckets. In-flight calls hold leases that expire on their own if a process dies.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        api_key: str,
+        base_url: str,
+        rpm: int = 0,
+        tpm: int = 0,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        lease_seconds: float = 900.0,
+        default_cooldown: float = 10.0,
+    ):
+        self.path = path
+        digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        self.key = f"{digest}|{(base_url or '').strip().rstrip('/')}"
+        self.rpm = max(0, int(rpm))
+        self.tpm = max(0, int(tpm))
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.lease_seconds = float(lease_seconds)
+        self.default_cooldown = float(default_cooldown)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL, blocked_until REAL, window REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, key TEXT, expires REAL)")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _load(self, conn: sqlite3.Connection, now: float) -> Tuple[float, float, float, float]:
+        """Return (requests, tokens, blocked_until, window) refilled up to `now`."""
+        row = conn.execute(
+            "SELECT requests, tokens, updated, blocked_until, window FROM buckets WHERE key = ?", (self.key,)
+        ).fetchone()
+        if row is None:
+            return float(self.rpm), float(self.tpm), 0.0, float(self.max_concurrency)
+        requests, tokens, updated, blocked_until, window = row
+        elapsed = max(0.0, now - float(updated))
+        if self.rpm:
+            requests = min(float(self.rpm), float(requests) + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            tokens = min(float(self.tpm), float(tokens) + elapsed * self.tpm / 60.0)
+        if elapsed > 600:
+            # A decrease learned long ago says little about the provider's current load.
+            window = float(self.max_concurrency)
+        window = min(float(self.max_concurrency), max(float(self.min_concurrency), float(window)))
+        return float(requests), float(tokens), float(blocked_until), window
+
+    def _store(
+        self, conn: sqlite3.Connection, now: float, requests: float, tokens: float, blocked_until: float, window: float
+    ) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, requests, tokens, updated, blocked_until, window) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key, requests, tokens, now, blocked_until, window),
+        )
+
+    def _try_acquire(self, est_tokens: int) -> Tuple[Optional[str], float]:
+        """Take a lease if the buckets and window allow it; otherwise return how long to wait."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            requests, tokens, blocked_until, window = self._load(conn, now)
+            active = conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (self.key,)).fetchone()[0]
+
+            wait = 0.0
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif active >= int(window):
+                wait = 0.25
+            elif self.rpm and requests < 1:
+                wait = (1 - requests) * 60.0 / self.rpm
+            elif self.tpm:
+                need = min(float(est_tokens), float(self.tpm))
+                if tokens < need:
+                    wait = (need - tokens) * 60.0 / self.tpm
+
+            if wait > 0:
+                conn.execute("ROLLBACK")
+                return None, wait
+
+            if self.rpm:
+                requests -= 1
+            if self.tpm:
+                tokens -= float(est_tokens)
+            lease = uuid.uuid4().hex
+            conn.execute("INSERT INTO leases (id, key, expires) VALUES (?, ?, ?)", (lease, self.key, now + self.lease_seconds))
+            self._store(conn, now, requests, tokens, blocked_until, window)
+            conn.execute("COMMIT")
+            return lease, 0.0
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def acquire(self, est_tokens: int) -> Tuple[str, float]:
+        """Block until a call may start; returns (lease, seconds waited)."""
+        started = time.monotonic()
+        while True:
+            lease, wait = self._try_acquire(est_tokens)
+            if lease:
+                return lease, time.monotonic() - started
+            time.sleep(min(wait, 5.0))
+
+    async def aacquire(self, est_tokens: int) -> Tuple[str, float]:
+        """acquire() for the event loop; each attempt runs in a worker thread because BEGIN IMMEDIATE can
+        wait up to the SQLite busy timeout while another process holds the write lock."""
+        started = time.monotonic()
+        while True:
+            attempt = asyncio.ensure_future(asyncio.to_thread(self._try_acquire, est_tokens))
+            try:
+                lease, wait = await asyncio.shield(attempt)
+            except asyncio.CancelledError:
+                # The worker thread may still commit a lease that nobody would return for lease_seconds.
+                attempt.add_done_callback(functools.partial(self._return_abandoned, est_tokens))
+                raise
+            if lease:
+                return lease, time.monotonic() - started
+            await asyncio.sleep(min(wait, 5.0))
+
+    def _return_abandoned(self, est_tokens: int, attempt: "asyncio.Future[Tuple[Optional[str], float]]") -> None:
+        if attempt.cancelled() or attempt.exception() is not None:
+            return
+        lease = attempt.result()[0]
+        if lease:
+            asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.release, lease, est_tokens=est_tokens, outcome="cancelled")
+            )
+
+    def release(
+        self,
+        lease: Optional[str],
+        *,
+        est_tokens: int,
+        actual_tokens: Optional[int] = None,
+        headers: Optional[Dict[str, str]] = None,
+        outcome: str = "ok",
+    ) -> float:
+        """Return the lease and fold the outcome ("ok", "rate_limited", "error" or "cancelled") into the shared state.
+
+        "cancelled" is a lease taken for a call that was never sent: its request and token estimate are refunded.
+
+        Returns the cooldown applied to everyone sharing the key (0 if none).
+        """
+        headers = {str(k).lower(): str(v) for k, v in (headers or {}).items()}
+        now = time.time()
+        cooldown = 0.0
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if lease:
+                conn.execute("DELETE FROM leases WHERE id = ?", (lease,))
+            requests, tokens, blocked_until, window = self._load(conn, now)
+
+            if outcome == "rate_limited":
+                # Multiplicative decrease, and everyone sharing the key pauses for Retry-After.
+                window = max(float(self.min_concurrency), window / 2.0)
+                cooldown = parse_retry_after(headers)
+                if cooldown is None:
+                    cooldown = parse_reset_duration(headers.get("x-ratelimit-reset-requests", "")) or self.default_cooldown
+                blocked_until = max(blocked_until, now + cooldown)
+                requests = min(requests, 0.0)
+            elif outcome == "ok":
+                # Additive increase: roughly +1 per window's worth of successful calls.
+                window = min(float(self.max_concurrency), window + 1.0 / max(window, 1.0))
+                if self.tpm and actual_tokens is not None:
+                    tokens = min(float(self.tpm), tokens + float(est_tokens) - float(actual_tokens))
+            elif outcome == "cancelled":
+                if self.rpm:
+                    requests = min(float(self.rpm), requests + 1.0)
+                if self.tpm:
+                    tokens = min(float(self.tpm), tokens + float(est_tokens))
+
+            # Trust the provider's own view of the remaining budget when it reports one.
+            for name, reset_name, is_requests in (
+                ("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests", True),
+                ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens", False),
+            ):
+                try:
+                    remaining = float(headers[name])
+                except (KeyError, ValueError):
+                    continue
+                if is_requests and self.rpm:
+                    requests = min(requests, remaining)
+                elif not is_requests and self.tpm:
+                    tokens = min(tokens, remaining)
+                if remaining <= 0:
+                    reset = parse_reset_duration(headers.get(reset_name, ""))
+                    if reset:
+                        blocked_until = max(blocked_until, now + reset)
+                        cooldown = max(cooldown, reset)
+
+            self._store(conn, now, requests, tokens, blocked_until, window)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return cooldown
+
+    async def arelease(
+        self,
+        lease: Optional[str],
+        *,
+        est_tokens: int,
+        actual_tokens: Optional[int] = None,
+        headers: Optional[Dict[str, str]] = None,
+        outcome: str = "ok",
+    ) -> float:
+        """release() in a worker thread, for the same reason as aacquire()."""
+        return await asyncio.to_thread(
+            self.release,
+            lease,
+            est_tokens=est_tokens,
+            actual_tokens=actual_tokens,
+            headers=headers,
+            outcome=outcome,
+        )
+
+    def window(self) -> float:
+        conn = self._connect()
+        try:
+            return self._load(conn, time.time())[3]
+        finally:
+            conn.close()
@@ -4,7 +4,7 @@ from llm_client import (
     build_gemini_generate_content_url,
     build_openai_chat_completions_url,
     detect_api_style,
-    generate_text,
+    generate_response,
 )
 
 
@@ -15,7 +15,7 @@ def mask_sensitive(text: str, key: str) -> str:
 
 
 def test_api() -> None:
-    print("=== LLM API Connectivity Test (curl) ===")
+    print(f"=== LLM API Connectivity Test ({config.LLM_HTTP_TRANSPORT}) ===")
 
     api_key = config.GEMINI_API_KEY
     base_url = config.BASE_URL.rstrip("/")
@@ -46,9 +46,9 @@ def test_api() -> None:
     print(f"  - API Version: {api_version}")
     print(f"  - Model: {model_name}")
 
-    print("\n[Sending Request via curl...]")
+    print(f"\n[Sending Request via {config.LLM_HTTP_TRANSPORT}...]")
     try:
-        text = generate_text(
+        response = generate_response(
             api_key=api_key,
             base_url=base_url,
             model_name=model_name,
@@ -58,9 +58,11 @@ def test_api() -> None:
             api_version=api_version,
             api_style=api_style,
             timeout_seconds=60,
+            transport=config.LLM_HTTP_TRANSPORT,
         )
         print("\n[Response Text]")
-        print(mask_sensitive(text, api_key))
+        print(mask_sensitive(response.text, api_key))
+        print(f"\nLatency: {response.latency_seconds:.3f}s")
         print("\nConnectivity test PASSED!")
     except HttpError as e:
         print(f"\nConnectivity test FAILED: HTTP {e.status_code}")
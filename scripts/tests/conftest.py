@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The scripts are run as top-level modules (python scripts/main.py), so import them the same way.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# DocGenerator refuses to start without a key; nothing in the tests talks to a real endpoint.
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+
+@pytest.fixture
+def generator_env(tmp_path, monkeypatch):
+    """Keep a DocGenerator away from shared state: no response cache, no governor, profile and stores in tmp_path."""
+    from config import config
+
+    monkeypatch.setenv("LLM_CACHE", "0")
+    monkeypatch.setenv("LLM_RATE_GOVERNOR", "0")
+    monkeypatch.setenv("LLM_CAPABILITY_PROBE", "0")
+    monkeypatch.setenv("BOOTSTRAP_ANALYSIS_CACHE_DIR", str(tmp_path / "dir_analyses"))
+    # The LLM profile lives next to STATE_FILE.
+    monkeypatch.setattr(config, "STATE_FILE", str(tmp_path / "state.json"))
+    return tmp_path
+
+
+@pytest.fixture
+def generator(generator_env):
+    from doc_gen import DocGenerator
+
+    return DocGenerator()
+
+
+class LoopTicker:
+    """Counts 10ms ticks of the running event loop, to show that an await inside the block did not block it."""
+
+    def __init__(self):
+        self.ticks = 0
+        self._task = None
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(0.01)
+            self.ticks += 1
+
+    async def __aenter__(self):
+        self._task = asyncio.ensure_future(self._tick())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+
+
+@pytest.fixture
+def loop_ticker():
+    return LoopTicker
+
+
+class FakeClock:
+    """Stands in for the `time` module of the code under test; advance() moves time() and monotonic() together."""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock():
+    return FakeClock()
@@ -0,0 +1,31 @@
+import pytest
+
+from config import config
+from doc_gen import DocGenerator
+
+
+@pytest.fixture
+def make_generator(generator_env, monkeypatch):
+    def make(branch: str) -> DocGenerator:
+        monkeypatch.setattr(config, "UPSTREAM_BRANCH", branch)
+        return DocGenerator()
+
+    return make
+
+
+def _key(gen: DocGenerator, **overrides) -> str:
+    kwargs = {"unit": "file", "path": "src/a.py", "content_key": "abc", "max_context_tokens": 40000}
+    kwargs.update(overrides)
+    return gen.analysis_cache_key(**kwargs)
+
+
+def test_key_is_shared_between_branches(make_generator):
+    assert _key(make_generator("main")) == _key(make_generator("dev"))
+
+
+def test_key_follows_content_and_unit(make_generator):
+    gen = make_generator("main")
+    assert _key(gen) != _key(gen, content_key="abd")
+    assert _key(gen) != _key(gen, unit="dir")
+    assert _key(gen) != _key(gen, max_context_tokens=20000)
+    assert _key(gen, content_key="") is None
@@ -0,0 +1,32 @@
+import doc_gen
+from doc_gen import DocGenerator
+from llm_endpoints import Endpoint, EndpointPool
+
+
+def _job(label: str) -> "DocGenerator._LLMJob":
+    request = {
+        "prompt": f"analyze {label}, reply in JSON",
+        "system_instruction": None,
+        "temperature": 0.0,
+        "max_tokens": 100,
+        "response_schema": None,
+        "response_schema_name": "",
+        "task": "dir_analysis",
+    }
+    return DocGenerator._LLMJob(label=label, request=request, context={})
+
+
+def test_batch_mode_on_gemini_falls_back_to_direct_calls(generator, monkeypatch):
+    gemini = Endpoint(name="primary", base_url="https://generativelanguage.googleapis.com", api_key="k", api_style="gemini")
+    generator.endpoints = EndpointPool([gemini])
+
+    def no_batch_line(*args, **kwargs):
+        raise AssertionError("no batch line may be built for a Gemini endpoint")
+
+    async def direct(job, parse):
+        return f"direct:{job.label}"
+
+    monkeypatch.setattr(doc_gen, "build_batch_line", no_batch_line)
+    monkeypatch.setattr(generator, "_arun_job", direct)
+    results = generator._run_batch([_job("a"), _job("b")], lambda raw, job: raw, fallback_limit=2)
+    assert results == ["direct:a", "direct:b"]
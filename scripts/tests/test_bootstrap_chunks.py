@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from main import MainController
+from output_rules import RuleViolation
+
+
+def _spec(files_block: str, index: int = 1, total: int = 2) -> dict:
+    return {"dir_path": "src", "chunk_index": index, "chunk_total": total, "files_block": files_block}
+
+
+def test_chunk_ref_is_stable_for_the_same_packing():
+    assert MainController._chunk_ref("src", _spec("a.py\nb.py")) == MainController._chunk_ref("src", _spec("a.py\nb.py"))
+
+
+def test_chunk_ref_changes_when_the_packing_changes():
+    # A resumed run that packs the directory differently must not restore chunk #1 of the old packing.
+    old = MainController._chunk_ref("src", _spec("a.py\nb.py"))
+    assert MainController._chunk_ref("src", _spec("a.py")) != old
+    assert MainController._chunk_ref("src", _spec("a.py\nb.py", total=3)) != old
+    assert old.startswith("src#1-")
+
+
+def test_per_file_packing_caps_the_files_of_a_chunk(generator, tmp_path):
+    files = [f"src/m{i}.py" for i in range(5)]
+    for path in files:
+        (tmp_path / path).parent.mkdir(exist_ok=True)
+        (tmp_path / path).write_text(f"def f{path[-4]}():\n    return 1\n", encoding="utf-8")
+    controller = MainController.__new__(MainController)
+    controller.doc_gen = generator
+    chunks = controller._build_directory_chunks(
+        repo_dir=str(tmp_path), dir_path="src", files=files, max_context_tokens=40000, overhead_tokens=0, max_files=2
+    )
+    assert [ch["files"] for ch in chunks] == [files[0:2], files[2:4], files[4:]]
+    assert chunks[1]["files_block"].startswith("Directory: src\nChunk: 2/3\nFiles in this chunk:\n- src/m2.py\n")
+
+
+def test_packed_answer_is_split_per_file(generator):
+    files = ["src/a.py", "src/b.py"]
+    files_block = "Files in this chunk:\n- src/a.py\n- src/b.py\n--- File: src/a.py ---\ndef a(): ...\n--- File: src/b.py ---\n"
+    job = generator._dir_analysis_job(
+        repo_map={}, dir_path="src", chunk_index=1, chunk_total=1, files_block=files_block, files=files
+    )
+
+    def item(summary, named=None):
+        return {"files": named or [], "summary": summary, "evidence": ["def a(): ...", "src/a.py"]}
+
+    # Objects are matched by the file they name; the one that names none takes the remaining file.
+    raw = json.dumps([item("b", ["src/b.py"]), item("a")])
+    out = generator._parse_file_analyses(raw, job)
+    assert {path: a["summary"] for path, a in out.items()} == {"src/a.py": "a", "src/b.py": "b"}
+    assert out["src/a.py"]["files"] == ["src/a.py"] and out["src/a.py"]["dir"] == "src"
+
+    # A file left out fails the whole answer, so the repair turn asks for it.
+    with pytest.raises(RuleViolation) as info:
+        generator._parse_file_analyses(json.dumps([item("a", ["src/a.py"])]), job)
+    assert "src/b.py" in str(info.value.errors)
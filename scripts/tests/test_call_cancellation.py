@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from llm_endpoints import Endpoint, EndpointPool
+
+CALL_ARGS = {
+    "prompt": "hello",
+    "system_instruction": None,
+    "temperature": 0.0,
+    "max_tokens": 50,
+    "response_schema": None,
+    "response_schema_name": "",
+    "cache_prefix": None,
+    "task": "",
+}
+
+
+@pytest.fixture
+def pool(generator):
+    pool = EndpointPool(
+        [
+            Endpoint(name="a", base_url="https://api.openai.com/v1", api_key="k"),
+            Endpoint(name="b", base_url="https://api.openai.com/v1", api_key="k"),
+        ]
+    )
+    generator.endpoints = pool
+    return pool
+
+
+def _cancel_after(coro, seconds: float) -> None:
+    async def main():
+        task = asyncio.ensure_future(coro)
+        await asyncio.sleep(seconds)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+
+def test_cancel_while_waiting_for_the_governor_releases_the_endpoint(generator, pool, monkeypatch):
+    async def stuck_governor(endpoint, est_tokens):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(generator, "_agovernor_acquire", stuck_governor)
+    _cancel_after(generator._acall_with_retries(dict(CALL_ARGS)), 0.05)
+    assert all(h.in_flight == 0 for h in pool._health.values())
+    assert all(h.failures == 0 for h in pool._health.values())
+
+
+def test_cancelled_probe_does_not_exclude_the_endpoint_for_good(generator, pool, monkeypatch):
+    async def stuck_governor(endpoint, est_tokens):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(generator, "_agovernor_acquire", stuck_governor)
+    for health in pool._health.values():
+        health.probing = True
+    _cancel_after(generator._acall_with_retries(dict(CALL_ARGS)), 0.05)
+    assert not any(h.probe_in_flight for h in pool._health.values())
+
+
+class _FireAtOnce:
+    """Hedge policy stub: hedge after 10ms, and note when the hedge is fired."""
+
+    def __init__(self):
+        self.fired = asyncio.Event()
+
+    def deadline(self):
+        return 0.01
+
+    def try_fire(self):
+        self.fired.set()
+        return True
+
+
+def test_hedge_cancelled_before_it_starts_holds_no_endpoint(generator, pool, monkeypatch):
+    async def stuck_governor(endpoint, est_tokens):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(generator, "_agovernor_acquire", stuck_governor)
+    generator.hedge = _FireAtOnce()
+
+    async def main():
+        call = asyncio.ensure_future(generator._acall_with_retries(dict(CALL_ARGS)))
+        await generator.hedge.fired.wait()
+        # Like a loop shutdown: every task is cancelled, the just-created hedge before its first step.
+        others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in others:
+            task.cancel()
+        await asyncio.gather(*others, return_exceptions=True)
+        assert call.cancelled()
+
+    asyncio.run(main())
+    assert all(h.in_flight == 0 for h in pool._health.values())
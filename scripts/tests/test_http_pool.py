@@ -0,0 +1,66 @@
+import asyncio
+import gc
+import threading
+
+import llm_client
+
+
+async def _client():
+    return llm_client._get_async_http_client()
+
+
+def test_close_http_pool_closes_clients_of_idle_loops():
+    loop = asyncio.new_event_loop()
+    try:
+        client = loop.run_until_complete(_client())
+        llm_client.close_http_pool()
+        assert client.is_closed
+        assert loop not in llm_client._ASYNC_HTTP_CLIENTS
+    finally:
+        loop.close()
+
+
+def test_close_http_pool_closes_clients_of_loops_running_in_other_threads():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        client = asyncio.run_coroutine_threadsafe(_client(), loop).result(5)
+        llm_client.close_http_pool()
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), loop).result(5)
+        assert client.is_closed
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+
+
+def test_close_http_pool_on_the_running_loop_keeps_the_close_task_alive():
+    async def main():
+        client = await _client()
+        llm_client.close_http_pool()
+        assert len(llm_client._CLOSING_TASKS) == 1
+        gc.collect()
+        await asyncio.sleep(0.05)
+        return client
+
+    client = asyncio.run(main())
+    assert client.is_closed
+    assert not llm_client._CLOSING_TASKS
+
+
+def test_close_http_pool_inside_another_loop_warns_and_closes_when_the_idle_loop_runs(capsys):
+    idle = asyncio.new_event_loop()
+    try:
+        client = idle.run_until_complete(_client())
+
+        async def close_from_another_loop():
+            llm_client.close_http_pool()
+
+        asyncio.run(close_from_another_loop())
+        assert "aclose_http_pool()" in capsys.readouterr().out
+        assert not client.is_closed
+        idle.run_until_complete(asyncio.sleep(0.05))
+        assert client.is_closed
+    finally:
+        idle.close()
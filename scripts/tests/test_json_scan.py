@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from json_scan import JsonScanError, scan_json
+
+
+def test_clean_json_with_surrounding_prose():
+    assert scan_json('结果如下：\n```json\n{"a": [1, 2.5, "x"], "b": null}\n```\n以上。') == {
+        "a": [1, 2.5, "x"],
+        "b": None,
+    }
+
+
+def test_trailing_commas():
+    assert scan_json('{"a": [1, 2,], "b": {"c": 3,},}') == {"a": [1, 2], "b": {"c": 3}}
+
+
+def test_smart_quotes_as_delimiters():
+    assert scan_json("{“title”: “概览”}") == {"title": "概览"}
+
+
+def test_full_width_colon_and_comma():
+    assert scan_json('{"a"：1，"b"：[2，3]}') == {"a": 1, "b": [2, 3]}
+
+
+def test_python_literals_single_quotes_and_unquoted_keys():
+    assert scan_json("{'ok': True, missing: None, flags: [False]}") == {
+        "ok": True,
+        "missing": None,
+        "flags": [False],
+    }
+
+
+def test_raw_newline_inside_string():
+    assert scan_json('{"text": "line 1\nline 2"}') == {"text": "line 1\nline 2"}
+
+
+def test_prose_brackets_are_skipped():
+    text = '见 [注] 与 {dir} 目录说明，输出：{"pages": [{"path": "a.md"}]}'
+    assert scan_json(text) == {"pages": [{"path": "a.md"}]}
+
+
+def test_surrogate_pair_escape_in_python_path():
+    # Single quotes and the unknown "\q" escape both bypass the C decoder.
+    assert scan_json("{'emoji': '\\ud83d\\ude00'}") == {"emoji": "\U0001F600"}
+    assert scan_json('{"emoji": "\\ud83d\\ude00 \\q"}') == {"emoji": "\U0001F600 \\q"}
+
+
+def test_unterminated_string_is_an_error():
+    with pytest.raises(JsonScanError):
+        scan_json('{"summary": "the output was cut off here')
+
+
+def test_truncated_value_is_not_completed():
+    with pytest.raises(JsonScanError):
+        scan_json('{"pages": [{"path": "a.md"}, {"path": "b.md"')
+
+
+def test_no_json_at_all():
+    with pytest.raises(JsonScanError) as info:
+        scan_json("抱歉，我无法完成这个请求。")
+    assert info.value.pos == -1
+
+
+def test_many_unmatched_brackets_fail_fast():
+    started = time.monotonic()
+    with pytest.raises(JsonScanError):
+        scan_json("[" * 50000)
+    assert time.monotonic() - started < 2.0
+
+
+def test_fragment_inside_a_broken_value_is_not_returned():
+    with pytest.raises(JsonScanError):
+        scan_json("[" * 1000 + ' {"a": 1}')
+
+
+def test_scan_resumes_after_a_broken_value():
+    assert scan_json('草稿 {"a": [1, 2} 修正后：{"b": 2}') == {"b": 2}
@@ -0,0 +1,32 @@
+import os
+import time
+
+from llm_cache import ResponseCache
+
+
+def test_evict_expires_by_creation_time_even_when_recently_hit(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=0, ttl_seconds=60)
+    cache.put("aa01", {"text": "old", "created_at": time.time() - 120})
+    cache.put("aa02", {"text": "fresh"})
+    # A lookup of the expired entry is a miss, and the hit on the fresh one bumps its mtime.
+    assert cache.get("aa01") is None
+    cache.put("aa01", {"text": "old", "created_at": time.time() - 120})
+    os.utime(cache._path("aa01"), None)
+    assert cache.get("aa02") is not None
+
+    assert cache.evict() == 1
+    assert not os.path.exists(cache._path("aa01"))
+    assert cache.get("aa02")["text"] == "fresh"
+
+
+def test_evict_drops_least_recently_used_over_max_bytes(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1, ttl_seconds=0)
+    cache.put("bb01", {"text": "a"})
+    cache.put("bb02", {"text": "b"})
+    past = time.time() - 100
+    os.utime(cache._path("bb01"), (past, past))
+    size = os.path.getsize(cache._path("bb02"))
+    cache.max_bytes = size
+    assert cache.evict() == 1
+    assert cache.get("bb01") is None
+    assert cache.get("bb02") is not None
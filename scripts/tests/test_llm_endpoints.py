@@ -0,0 +1,53 @@
+import pytest
+
+import llm_endpoints
+from llm_endpoints import Endpoint, EndpointPool
+
+
+@pytest.fixture
+def pool(fake_clock, monkeypatch):
+    monkeypatch.setattr(llm_endpoints, "time", fake_clock)
+    endpoints = [Endpoint(name="a", base_url="https://a", api_key="k"), Endpoint(name="b", base_url="https://b", api_key="k")]
+    return EndpointPool(endpoints, base_drain_seconds=10, max_drain_seconds=100, seed=1)
+
+
+def _health(pool: EndpointPool, name: str):
+    return pool._health[name]
+
+
+def test_failed_endpoint_is_drained_and_traffic_moves(pool, fake_clock):
+    a = pool.get("a")
+    assert pool.release(pool.acquire(only="a"), failed=True) == 10
+    assert all(pool.acquire().name == "b" for _ in range(20))
+    assert _health(pool, "a").drained_until == fake_clock.now + 10
+    assert not pool.has_alternative(pool.get("b")) and pool.has_alternative(a)
+
+
+def test_probe_after_drain_readmits_on_success(pool, fake_clock):
+    pool.release(pool.acquire(only="a"), failed=True)
+    fake_clock.advance(11)
+    probe = pool.acquire(only="a")
+    assert _health(pool, "a").probe_in_flight
+    # Only one trial call at a time: others go to b while the probe is out.
+    assert all(pool.acquire().name == "b" for _ in range(10))
+    pool.release(probe, latency_seconds=0.5)
+    health = _health(pool, "a")
+    assert not health.probing and not health.probe_in_flight and health.drain_seconds == 0
+
+
+def test_failed_probe_doubles_the_drain(pool, fake_clock):
+    pool.release(pool.acquire(only="a"), failed=True)
+    fake_clock.advance(11)
+    assert pool.release(pool.acquire(only="a"), failed=True) == 20
+    fake_clock.advance(21)
+    assert pool.release(pool.acquire(only="a"), failed=True) == 40
+
+
+def test_retry_after_sets_the_drain(pool):
+    assert pool.release(pool.acquire(only="a"), failed=True, status_code=429, headers={"Retry-After": "30"}) == 30
+
+
+def test_all_drained_falls_back_to_first_to_recover(pool, fake_clock):
+    pool.release(pool.acquire(only="a"), failed=True, headers={"Retry-After": "50"})
+    pool.release(pool.acquire(only="b"), failed=True)
+    assert pool.acquire().name == "b"
@@ -0,0 +1,49 @@
+import doc_gen
+from llm_client import HttpError, LLMResponse
+from llm_profile import LLMProfileStore
+
+
+def test_update_capability_reports_changes(tmp_path):
+    store = LLMProfileStore(str(tmp_path / "profile.json"))
+    assert store.update_capability("https://x", "m", json_schema=True)
+    assert not store.update_capability("https://x", "m", json_schema=True)
+    assert not store.update_capability("https://x", "m", json_schema=None)
+    assert store.update_capability("https://x", "m", json_schema=False)
+
+
+def test_structured_calls_save_only_on_capability_change(generator, monkeypatch):
+    saves = []
+    monkeypatch.setattr(generator.profile, "save", lambda: saves.append(1))
+
+    for _ in range(3):
+        generator._learn_capabilities(LLMResponse(text="{}", response_format="json_schema"), "https://x", "m")
+    assert len(saves) == 1
+
+    def failing_save():
+        raise OSError("disk full")
+
+    monkeypatch.setattr(generator.profile, "save", failing_save)
+    # A profile write error must not fail a call that already succeeded.
+    generator._learn_capabilities(
+        LLMResponse(text="{}", response_format="json_object", rejected_formats=["json_schema"]), "https://x", "m"
+    )
+
+
+def _probe_with(generator, monkeypatch, error):
+    def fail(**kwargs):
+        raise error
+
+    monkeypatch.setattr(doc_gen, "generate_response", fail)
+    endpoint = generator.endpoints.primary
+    generator._probe_endpoint_capabilities(endpoint, "m")
+    return generator.profile.capability(endpoint.base_url, "m")
+
+
+def test_probe_ignores_errors_unrelated_to_response_format(generator, monkeypatch):
+    cap = _probe_with(generator, monkeypatch, HttpError(400, "Bad Request"))
+    assert "json_schema" not in cap and "json_object" not in cap
+
+
+def test_probe_records_rejected_response_format(generator, monkeypatch):
+    cap = _probe_with(generator, monkeypatch, HttpError(400, '{"error": "response_format json_schema is not supported"}'))
+    assert cap["json_schema"] is False and cap["json_object"] is False
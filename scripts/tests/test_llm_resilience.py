@@ -0,0 +1,55 @@
+import pytest
+
+import llm_resilience
+from llm_resilience import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def breaker(fake_clock, monkeypatch):
+    monkeypatch.setattr(llm_resilience, "time", fake_clock)
+    return CircuitBreaker(failure_threshold=3, reset_seconds=10, max_reset_seconds=30)
+
+
+def _open(breaker: CircuitBreaker) -> float:
+    opened = 0.0
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        opened = breaker.record_failure()
+    return opened
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.record_success()  # a success resets the count
+    assert _open(breaker) == 10
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_half_open_lets_one_trial_through_and_closes_on_success(breaker, fake_clock):
+    _open(breaker)
+    fake_clock.advance(10)
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # the trial is still in flight
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call()
+
+
+def test_failed_trial_reopens_for_twice_as_long_up_to_the_cap(breaker, fake_clock):
+    _open(breaker)
+    for expected in (20, 30, 30):
+        fake_clock.advance(100)
+        breaker.before_call()
+        assert breaker.record_failure() == expected
+
+
+def test_cancelled_trial_allows_a_new_one(breaker, fake_clock):
+    _open(breaker)
+    fake_clock.advance(10)
+    breaker.before_call()
+    breaker.record_neutral()
+    breaker.before_call()
@@ -0,0 +1,20 @@
+import pytest
+
+import llm_client
+from config import config
+from doc_gen import DocGenerator
+
+
+def test_stream_is_turned_off_with_a_warning_under_curl(generator_env, monkeypatch, capsys):
+    monkeypatch.setenv("LLM_STREAM", "1")
+    monkeypatch.setattr(config, "LLM_HTTP_TRANSPORT", "curl")
+    gen = DocGenerator()
+    assert gen.stream is False
+    assert "LLM_STREAM=1" in capsys.readouterr().out
+
+
+def test_client_rejects_stream_under_curl():
+    with pytest.raises(ValueError, match="httpx"):
+        llm_client.generate_response(
+            api_key="k", base_url="https://x", model_name="m", prompt="p", transport="curl", stream=True
+        )
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from pipeline_dag import CheckpointStore, Pipeline
+
+
+def _build(store, calls, *, fail=None):
+    """plan -> one node per item it returns -> summary over all of them."""
+    pipeline = Pipeline(limit=2, store=store)
+
+    def job(name, value):
+        async def run():
+            calls.append(name)
+            if name == fail:
+                raise RuntimeError("simulated crash")
+            if name == "flaky":
+                return None
+            return value
+
+        return run
+
+    def expand(items):
+        names = []
+        for item in items:
+            pipeline.add(f"item:{item}", job(f"item:{item}", item * 10), deps=["plan"])
+            names.append(f"item:{item}")
+        pipeline.add("flaky", job("flaky", None), deps=["plan"])
+
+        async def summary():
+            calls.append("summary")
+            return sum(pipeline.result(n) for n in names)
+
+        pipeline.add("summary", summary, deps=names, checkpoint=False)
+
+    pipeline.add("plan", job("plan", [1, 2, 3]), expand=expand)
+    return pipeline
+
+
+def test_resume_restores_finished_nodes_and_rebuilds_the_graph(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    store.reset("sha1")
+    first = []
+    with pytest.raises(RuntimeError):
+        asyncio.run(_build(store, first, fail="item:3").run())
+    assert "item:3" in first
+
+    second = []
+    pipeline = _build(CheckpointStore(str(tmp_path)), second)
+    results = asyncio.run(pipeline.run())
+    assert results["summary"] == 60
+    # plan comes back from its checkpoint and still expands the graph; finished items are not run again.
+    assert "plan" not in second
+    assert "item:3" in second and "summary" in second
+    assert not ({"item:1", "item:2"} & set(second) & set(first))
+    # A None result is not checkpointed, so it is retried.
+    assert "flaky" in second
+
+
+def test_reset_for_a_new_head_drops_checkpoints(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    store.reset("sha1")
+    asyncio.run(_build(store, []).run())
+    assert store.saved_head() == "sha1"
+
+    store.reset("sha2")
+    calls = []
+    asyncio.run(_build(store, calls).run())
+    assert "plan" in calls and "item:1" in calls
+
+
+def test_torn_checkpoint_is_rerun(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    store.reset("sha1")
+    asyncio.run(_build(store, []).run())
+    with open(store._node_path("item:2"), "w", encoding="utf-8") as f:
+        f.write('{"node": "item:2", "out')
+    calls = []
+    asyncio.run(_build(store, calls).run())
+    assert "item:2" in calls and "item:1" not in calls
+
+
+def test_unknown_dependency_is_rejected():
+    pipeline = Pipeline(limit=1)
+    with pytest.raises(ValueError):
+        pipeline.add("a", lambda: None, deps=["missing"])
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import pytest
+
+import doc_gen
+from doc_gen import DocGenerator
+from llm_endpoints import Endpoint
+
+
+@pytest.fixture
+def gen(generator_env, monkeypatch) -> DocGenerator:
+    monkeypatch.setenv("LLM_PROMPT_CACHE", "1")
+    monkeypatch.setattr(doc_gen, "_GEMINI_CACHE_MIN_TOKENS", 1)
+    return DocGenerator()
+
+
+def test_async_cache_creation_is_shared_and_does_not_block_the_loop(gen, monkeypatch, loop_ticker):
+    created = []
+
+    def slow_create(**kwargs):
+        created.append(kwargs["text"])
+        time.sleep(0.3)
+        return "cachedContents/abc", {"total_tokens": 10}
+
+    monkeypatch.setattr(doc_gen, "create_gemini_cached_content", slow_create)
+    endpoint = Endpoint(name="gemini", base_url="https://generativelanguage.googleapis.com", api_key="k")
+    prefix = "shared prefix "
+
+    async def one(i: int):
+        request = {"model_name": "gemini-x", "system_instruction": None, "prompt": f"{prefix}question {i}"}
+        await gen._aapply_prompt_cache(request, endpoint, prefix)
+        return request
+
+    async def main():
+        async with loop_ticker() as ticker:
+            requests = await asyncio.gather(*(one(i) for i in range(5)))
+        return requests, ticker.ticks
+
+    requests, ticks = asyncio.run(main())
+    assert created == [prefix]
+    assert ticks >= 10  # the loop kept running while the entry was created
+    assert [r["prompt"] for r in requests] == [f"question {i}" for i in range(5)]
+    assert all(r["cached_content"] == "cachedContents/abc" for r in requests)
@@ -0,0 +1,58 @@
+import asyncio
+import sqlite3
+import threading
+
+from rate_governor import RateGovernor
+
+
+def test_async_acquire_and_release_do_not_block_the_loop_on_a_locked_db(tmp_path, loop_ticker):
+    path = str(tmp_path / "governor.sqlite")
+    governor = RateGovernor(path, api_key="k", base_url="https://x")
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+    def hold_write_lock_for(seconds: float) -> None:
+        holder.execute("BEGIN IMMEDIATE")
+        threading.Timer(seconds, holder.rollback).start()
+
+    async def main():
+        async with loop_ticker() as acquiring:
+            hold_write_lock_for(0.3)
+            lease, _ = await governor.aacquire(100)
+        async with loop_ticker() as releasing:
+            hold_write_lock_for(0.3)
+            await governor.arelease(lease, est_tokens=100, actual_tokens=80)
+        return lease, acquiring.ticks, releasing.ticks
+
+    try:
+        lease, during_acquire, during_release = asyncio.run(main())
+    finally:
+        holder.close()
+    assert lease
+    # The loop kept running while each call waited for the other connection's write lock.
+    assert during_acquire >= 10
+    assert during_release >= 10
+
+
+def test_cancelled_acquire_returns_the_lease_taken_by_its_worker_thread(tmp_path):
+    path = str(tmp_path / "governor.sqlite")
+    governor = RateGovernor(path, api_key="k", base_url="https://x", rpm=60)
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+
+    async def main():
+        task = asyncio.ensure_future(governor.aacquire(100))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        # The worker thread is still blocked on the write lock; once it gets it, it commits a lease.
+        holder.rollback()
+        await asyncio.sleep(0.3)
+        assert task.cancelled()
+
+    try:
+        asyncio.run(main())
+        leases = holder.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+        requests = holder.execute("SELECT requests FROM buckets").fetchone()[0]
+    finally:
+        holder.close()
+    assert leases == 0
+    assert requests == 60  # the request taken for the abandoned lease was refunded
@@ -0,0 +1,118 @@
+import math
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Han, kana, hangul, CJK punctuation and full-width forms: roughly one BPE token (or less) per character.
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+# family -> (tokens per CJK character, UTF-8 bytes per token for everything else).
+# Rough ratios for Chinese prose and Python source, biased slightly high so budgets err on the side of fitting.
+_FAMILY_PROFILES: Dict[str, Tuple[float, float]] = {
+    "o200k": (0.8, 3.6),  # gpt-4o / gpt-4.1 / gpt-5 / o-series
+    "cl100k": (1.3, 3.4),  # gpt-4 / gpt-3.5
+    "gemini": (0.8, 3.6),
+    "claude": (1.3, 3.2),
+    "qwen": (0.75, 3.4),
+    "deepseek": (0.7, 3.4),
+    "glm": (0.7, 3.4),
+    "default": (1.0, 3.2),
+}
+
+_FAMILY_PATTERNS: List[Tuple[str, str]] = [
+    (r"gpt-4o|gpt-4\.1|gpt-5|chatgpt|(^|[/-])o[134]($|-)", "o200k"),
+    (r"gpt-4|gpt-3\.5", "cl100k"),
+    (r"gemini|gemma", "gemini"),
+    (r"claude", "claude"),
+    (r"qwen|qwq", "qwen"),
+    (r"deepseek", "deepseek"),
+    (r"glm|chatglm", "glm"),
+]
+
+# Used only to translate legacy *_CHARS settings into token budgets.
+LEGACY_CHARS_PER_TOKEN = 3.0
+
+
+def model_family(model_name: str) -> str:
+    name = (model_name or "").strip().lower()
+    for pattern, family in _FAMILY_PATTERNS:
+        if re.search(pattern, name):
+            return family
+    return "default"
+
+
+class TokenEstimator:
+    """Fast local approximation of a model's token count (no tokenizer download, linear in the text).
+
+    `scale` corrects the family profile for the concrete endpoint; it is learned from reported prompt_tokens.
+    """
+
+    def __init__(self, model_name: str = "", scale: float = 1.0):
+        self.family = model_family(model_name)
+        self.cjk_tokens_per_char, self.bytes_per_token = _FAMILY_PROFILES[self.family]
+        self.scale = min(2.0, max(0.5, float(scale or 1.0)))
+
+    def estimate(self, text: Optional[str]) -> float:
+        """Unrounded estimate, for summing many small pieces (e.g. line by line)."""
+        if not text:
+            return 0.0
+        if text.isascii():
+            raw = len(text) / self.bytes_per_token
+        else:
+            rest = _CJK_RE.sub("", text)
+            cjk = len(text) - len(rest)
+            raw = cjk * self.cjk_tokens_per_char + len(rest.encode("utf-8", errors="replace")) / self.bytes_per_token
+        return raw * self.scale
+
+    def count(self, text: Optional[str]) -> int:
+        return int(math.ceil(self.estimate(text)))
+
+    def truncate(self, text: Optional[str], max_tokens: int) -> str:
+        """Longest prefix of `text` that fits in `max_tokens` (whole text when it already fits)."""
+        text = text or ""
+        max_tokens = max(0, int(max_tokens))
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        end = int(len(text) * max_tokens / total)
+        while end > 0 and self.count(text[:end]) > max_tokens:
+            end = int(end * 0.95)
+        return text[:end]
+
+    def split(self, text: Optional[str], max_tokens: int) -> List[str]:
+        """Split `text` into consecutive parts of at most `max_tokens`, preferring line boundaries."""
+        text = text or ""
+        max_tokens = max(1, int(max_tokens))
+        # No character costs less than 1/bytes_per_token, so a longer window can never fit.
+        window = int(max_tokens * self.bytes_per_token / self.scale) + 16
+        parts: List[str] = []
+        start = 0
+        while start < len(text):
+            piece = self.truncate(text[start : start + window], max_tokens) or text[start : start + 1]
+            if start + len(piece) < len(text):
+                cut = piece.rfind("\n")
+                if cut > len(piece) // 2:
+                    piece = piece[: cut + 1]
+            parts.append(piece)
+            start += len(piece)
+        return parts
+
+    def observe(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Fold a provider-reported prompt token count into the scale correction."""
+        if estimated_tokens <= 0 or actual_tokens <= 0:
+            return
+        ratio = float(actual_tokens) / (float(estimated_tokens) / self.scale)
+        self.scale = min(2.0, max(0.5, 0.8 * self.scale + 0.2 * ratio))
+
+
+def resolve_token_budget(token_env: str, char_env: str, default_tokens: int, *, minimum: int = 1) -> int:
+    """Read a token budget from `token_env`, falling back to a legacy character budget in `char_env`."""
+    for env, per_unit in ((token_env, 1.0), (char_env, 1.0 / LEGACY_CHARS_PER_TOKEN)):
+        raw = (os.getenv(env) or "").strip() if env else ""
+        if not raw:
+            continue
+        try:
+            return max(minimum, int(int(raw) * per_unit))
+        except ValueError:
+            continue
+    return max(minimum, int(default_tokens))